@@ -0,0 +1,297 @@
+"""Normalisation des adresses et contrôle de cohérence adresse -> code postal.
+
+Chaque adresse est découpée en numéro, suffixe (bis, ter, A...), type de
+voie et nom de voie, puis réduite à une forme canonique (minuscules, sans
+accents ni articles, abréviations développées) : "60 A rue d'Aubagne" et
+"60a Rue d Aubagne" ont la même forme canonique, et donc le même
+identifiant (empreinte de la forme canonique).
+
+L'index des adresses regroupe, pour chaque identifiant, les variantes
+d'écriture, les codes postaux et les dates de première et dernière liste.
+Une adresse associée à plusieurs codes postaux est un conflit, détecté par
+un simple groupby, sans table de corrections manuelles.
+
+Utilisation :
+    python adresses.py --processed_dir data/processed
+"""
+
+import argparse
+import hashlib
+from pathlib import Path
+import re
+import unicodedata
+
+import pandas as pd
+
+import instrument
+from storage import FORMATS, read_snapshots, write_liste
+
+# types de voie, et leurs abréviations
+TYPES_VOIE = {
+    "rue": "rue",
+    "boulevard": "boulevard",
+    # coquilles rencontrées sur le site
+    "oulevard": "boulevard",
+    "bouleverd": "boulevard",
+    "bouvevard": "boulevard",
+    "avanue": "avenue",
+    "impassse": "impasse",
+    "travers": "traverse",
+    "bd": "boulevard",
+    "bld": "boulevard",
+    "bvd": "boulevard",
+    "avenue": "avenue",
+    "av": "avenue",
+    "ave": "avenue",
+    "place": "place",
+    "pl": "place",
+    "cours": "cours",
+    "chemin": "chemin",
+    "ch": "chemin",
+    "impasse": "impasse",
+    "imp": "impasse",
+    "traverse": "traverse",
+    "tse": "traverse",
+    "montee": "montée",
+    "allee": "allée",
+    "allees": "allées",
+    "quai": "quai",
+    "square": "square",
+    "route": "route",
+    "rte": "route",
+    "passage": "passage",
+    "plan": "plan",
+    "rond-point": "rond-point",
+    "cite": "cité",
+    "parc": "parc",
+    "domaine": "domaine",
+    "corniche": "corniche",
+}
+# suffixes de numéro
+SUFFIXES = {"bis": "bis", "b": "bis", "ter": "ter", "t": "ter", "quater": "quater"}
+# mots ignorés dans la forme canonique du nom de voie
+STOPWORDS = {"de", "du", "des", "la", "le", "les", "l", "d"}
+# abréviations développées dans la forme canonique du nom de voie
+ABBREV = {"st": "saint", "ste": "sainte", "gal": "general", "mal": "marechal"}
+
+# adresse normalisée (tirets remplacés par des espaces) : numéro, éventuellement
+# suivi d'autres numéros ("79-81", "79 au 85", "41/43", "2 bis/ter"), suffixe,
+# type et nom de voie, code postal en fin d'adresse
+RE_ADRESSE = re.compile(
+    r"^(?:immeuble\s+)?"
+    r"(?:(?P<numero>\d+)(?:\s*(?P<suffixe>bis|ter|quater|[a-f])\b(?!\s*\d))?"
+    r"(?:(?:\s*(?:au|a|et|[,/_&+])\s*|\s+)(?:\d+(?:\s*(?:bis|ter|[a-f])\b)?|bis|ter)\b)*"
+    r"\s*,?\s*)?"
+    r"(?:(?P<type_voie>"
+    + "|".join(sorted(map(re.escape, TYPES_VOIE), key=len, reverse=True))
+    + r")\b\.?\s*)?"
+    r"(?P<nom_voie>.*?)"
+    r"(?:\s+(?P<code_postal>130\d\d))?\s*[–]?\s*$"
+)
+# caractères invisibles (espace de largeur nulle...)
+RE_INVISIBLE = re.compile("[​‌‍﻿]")
+
+
+def normalize_text(text):
+    """Minuscules, sans accents, apostrophes et tirets remplacés par des espaces"""
+    text = unicodedata.normalize("NFKD", RE_INVISIBLE.sub("", text))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r"[’'`\-]", " ", text)
+    return " ".join(text.split())
+
+
+def _split_one(adresse):
+    """Découpe une adresse, voir `split_adresses`"""
+    # adresses séparées par un tiret : "Angle avenue X - rue Y"
+    adresse = re.split(r"\s[-–]\s(?!\d)", adresse)[0]
+    m_adr = RE_ADRESSE.match(normalize_text(adresse))
+    numero, suffixe, type_voie, nom_voie, code_postal = m_adr.group(
+        "numero", "suffixe", "type_voie", "nom_voie", "code_postal"
+    )
+    if numero is not None:
+        numero = str(int(numero))
+    if suffixe is not None:
+        suffixe = SUFFIXES.get(suffixe, suffixe)
+    if type_voie is not None:
+        type_voie = TYPES_VOIE[type_voie]
+    # le nom de voie s'arrête à la 1re autre adresse ("et", "/", ",")
+    nom_voie = re.split(r"\s+(?:et|/)\s+|,", nom_voie)[0].strip(" -–")
+    words = [ABBREV.get(w, w) for w in nom_voie.split() if w not in STOPWORDS]
+    canon = " ".join(
+        x for x in (numero, suffixe, type_voie, " ".join(words)) if x is not None
+    )
+    return numero, suffixe, type_voie, nom_voie or None, code_postal, canon
+
+
+@instrument.profiled
+def split_adresses(s_adresse):
+    """Découpe les adresses d'une colonne, et calcule leur forme canonique.
+
+    Chaque adresse distincte n'est analysée qu'une fois.
+
+    Parameters
+    ----------
+    s_adresse : Series
+        Adresses
+
+    Returns
+    -------
+    df_adr : DataFrame
+        Numéro, suffixe (bis, ter...), type de voie, nom de voie (normalisé),
+        code postal écrit dans l'adresse, forme canonique et identifiant
+        (empreinte de la forme canonique), alignés sur `s_adresse`.
+    """
+    codes, uniques = pd.factorize(s_adresse)
+    cols = ["numero", "suffixe", "type_voie", "nom_voie", "code_postal_adresse"]
+    df_uniq = pd.DataFrame(
+        [_split_one(adresse) for adresse in uniques],
+        columns=cols + ["adresse_canon"],
+        dtype="string",
+    )
+    df_uniq["adresse_id"] = pd.Series(
+        [
+            hashlib.blake2b(canon.encode("utf-8"), digest_size=8).hexdigest()
+            for canon in df_uniq["adresse_canon"]
+        ],
+        dtype="string",
+    )
+    # valeur manquante (code -1) : dernière ligne, vide
+    df_uniq.loc[len(df_uniq)] = pd.NA
+    df_adr = df_uniq.iloc[codes].set_axis(s_adresse.index)
+    return df_adr
+
+
+@instrument.profiled
+def check_cp_conflicts(df, count_col=None):
+    """Repère les adresses associées à plusieurs codes postaux.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste(s) des documents : adresse, code_postal
+    count_col : str, optional
+        Colonne du nombre de lignes de chaque couple (adresse, code_postal),
+        si `df` est déjà agrégé (voir `count_cp_pairs`).
+
+    Returns
+    -------
+    df_conflicts : DataFrame
+        Pour chaque adresse canonique en conflit : ses variantes d'écriture,
+        ses codes postaux et le nombre de lignes pour chacun.
+    """
+    df_adr = split_adresses(df["adresse"])
+    df_cp = pd.DataFrame(
+        {
+            "adresse_id": df_adr["adresse_id"],
+            "adresse_canon": df_adr["adresse_canon"],
+            "adresse": df["adresse"],
+            "code_postal": df["code_postal"],
+            "n": df[count_col] if count_col is not None else 1,
+        }
+    ).dropna(subset=["adresse_id", "code_postal"])
+    n_cp = df_cp.groupby("adresse_id")["code_postal"].nunique()
+    df_cp = df_cp[df_cp["adresse_id"].isin(n_cp.index[n_cp > 1])]
+    if df_cp.empty:
+        return pd.DataFrame(
+            columns=["adresse_id", "adresse_canon", "variantes", "codes_postaux"]
+        )
+    counts = df_cp.groupby(["adresse_id", "code_postal"])["n"].sum()
+    df_conflicts = df_cp.groupby("adresse_id").agg(
+        adresse_canon=("adresse_canon", "first"),
+        variantes=("adresse", lambda s: " | ".join(sorted(s.unique()))),
+    )
+    df_conflicts["codes_postaux"] = [
+        " | ".join(f"{cp} ({n})" for cp, n in counts[adr_id].items())
+        for adr_id in df_conflicts.index
+    ]
+    return df_conflicts.reset_index()
+
+
+def count_cp_pairs(df, counts=None):
+    """Compte les couples (adresse, code postal) d'une liste, lue par morceaux.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Morceau de la liste des documents : adresse, code_postal
+    counts : Series, optional
+        Comptes des morceaux précédents
+
+    Returns
+    -------
+    counts : Series
+        Nombre de lignes par couple (adresse, code_postal), cumulé ; sa
+        taille ne dépend que du nombre d'adresses distinctes.
+    """
+    new = df.groupby(["adresse", "code_postal"]).size()
+    return new if counts is None else counts.add(new, fill_value=0).astype(int)
+
+
+def build_address_index(df_all):
+    """Index des adresses canoniques, sur toutes les listes.
+
+    Parameters
+    ----------
+    df_all : DataFrame
+        Listes des documents, avec la colonne "snapshot" (voir
+        `storage.read_snapshots`)
+
+    Returns
+    -------
+    df_index : DataFrame
+        Pour chaque adresse canonique : forme canonique et découpage,
+        variantes d'écriture, codes postaux, nombre de lignes, dates de
+        première et de dernière liste.
+    """
+    df_adr = split_adresses(df_all["adresse"])
+    df = pd.concat(
+        [df_adr, df_all[["adresse", "code_postal", "snapshot"]]], axis=1
+    ).dropna(subset=["adresse_id"])
+    df_index = df.groupby("adresse_id").agg(
+        adresse_canon=("adresse_canon", "first"),
+        numero=("numero", "first"),
+        suffixe=("suffixe", "first"),
+        type_voie=("type_voie", "first"),
+        nom_voie=("nom_voie", "first"),
+        variantes=("adresse", lambda s: " | ".join(sorted(s.unique()))),
+        codes_postaux=(
+            "code_postal",
+            lambda s: " | ".join(sorted(s.dropna().unique())),
+        ),
+        n_lignes=("adresse", "size"),
+        first_seen=("snapshot", "min"),
+        last_seen=("snapshot", "max"),
+    )
+    for col in ("first_seen", "last_seen"):
+        df_index[col] = df_index[col].dt.strftime("%Y-%m-%d")
+    return df_index.reset_index().sort_values("adresse_canon", ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--processed_dir", help="Dossier des listes traitées", default="data/processed"
+    )
+    parser.add_argument(
+        "--out_dir", help="Dossier de sortie de l'index", default="data/interim"
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args, "adresses")
+    #
+    df_all = read_snapshots(args.processed_dir, typed=False)
+    df_all["snapshot"] = pd.to_datetime(df_all["snapshot"])
+    df_index = build_address_index(df_all)
+    write_liste(df_index, Path(args.out_dir) / "adresses", fmt=args.format)
+    # conflits adresse -> code postal, sur toutes les listes
+    df_conflicts = check_cp_conflicts(df_all)
+    print(f"{len(df_index)} adresses, {len(df_conflicts)} en conflit de code postal")
+    with pd.option_context("display.max_colwidth", None):
+        print(df_conflicts[["variantes", "codes_postaux"]].to_string(index=False))
+    instrument.stop()
@@ -0,0 +1,406 @@
+"""Mesure le temps de chaque étape de traitement, sur les listes réelles et
+sur des listes synthétiques plus grandes.
+
+Les listes synthétiques sont obtenues en dupliquant la liste réelle la plus
+récente (x10, x100, x1000) : chaque copie change les numéros de rue des
+adresses, items et URL, et décale les dates des noms de documents, pour
+garder une diversité réaliste de textes distincts.
+
+Le temps de démarrage de la commande unique (`mrs_arretes.py`) est mesuré
+de la même façon, dans un nouvel interpréteur ; son aide ne doit charger
+aucun module lourd (pandas, requests...), réservés aux sous-commandes.
+
+Les résultats sont enregistrés en JSON (un fichier par exécution) et
+comparés à une exécution de référence, par défaut la précédente : une
+étape nettement plus lente est signalée comme régression.
+
+Utilisation :
+    python bench_pipeline.py --scales 10 100
+    python bench_pipeline.py --compare bench_results/2021-08-05T12-00-00.json
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import platform
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import enrich_liste_arretes as enrich
+import fix_liste_arretes as fix
+import mrs_arretes
+from storage import list_snapshots, read_liste
+
+# dossier des listes brutes
+RAW_DIR = "data/raw"
+# dossier des résultats
+RESULTS_DIR = "bench_results"
+# facteurs d'agrandissement par défaut
+SCALES = [10, 100]
+# nombre de répétitions de chaque mesure
+REPEAT = 3
+# ralentissement relatif au-delà duquel une étape est signalée
+THRESHOLD = 0.2
+# écart absolu (en secondes) en-deçà duquel une différence est du bruit
+NOISE_FLOOR = 0.01
+
+# étapes mesurées : (entrée, fonction) ; l'entrée est la liste brute ("raw"),
+# après corrections manuelles ("manual") ou après correction ("fix")
+STAGES = {
+    "apply_manual_fixes": ("raw", fix.apply_manual_fixes),
+    "clean": ("manual", fix.clean),
+    "fix_liste": ("raw", fix.fix_liste),
+    "predict_doc_classes": (
+        "fix",
+        lambda df: enrich.predict_doc_classes(df["nom_doc"]),
+    ),
+    "guess_doc_class": ("fix", lambda df: enrich.guess_doc_class(df["url"].dropna())),
+    "extract_date_nomdoc": ("fix", enrich.extract_date_nomdoc),
+    "enrich_liste": ("fix", enrich.enrich_liste),
+}
+
+# démarrages mesurés : arguments de la commande unique
+STARTUP_COMMANDS = [["--help"], ["fix", "--help"], ["enrich", "--help"]]
+# modules lourds, chargés seulement par les sous-commandes qui les utilisent
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "requests", "lxml", "selenium"]
+
+# numéro en tête d'adresse, d'item ou de nom de fichier
+RE_NUM = re.compile(r"^\d+")
+# date au format jj/mm/aaaa
+RE_DATE = re.compile(r"\b(\d{2})/(\d{2})/(\d{4})\b")
+# numéro d'arrêté dans une URL, p. ex. "_2020_00807"
+RE_URL_NUM = re.compile(r"(?<=_)\d{5}(?=[_.])")
+
+
+def _map_uniques(s, func):
+    """Applique une fonction à chaque valeur distincte d'une colonne"""
+    table = {x: func(x) for x in pd.unique(s.dropna())}
+    return s.map(table).astype("string")
+
+
+def synth_liste(df, factor, seed=0):
+    """Agrandit une liste réelle en une liste synthétique `factor` fois plus longue.
+
+    La 1re copie est la liste réelle. Dans la copie k, le numéro de rue n
+    devient (n + 7k) mod 300 + 1, dans les adresses, items et URL, et
+    chaque nom de document distinct a ses dates décalées d'un nombre de
+    jours aléatoire (70 % des noms) ou est gardé tel quel (30 %).
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste brute des documents
+    factor : int
+        Facteur d'agrandissement
+    seed : int
+        Graine du générateur aléatoire
+
+    Returns
+    -------
+    df_synth : DataFrame
+        Liste synthétique
+    """
+    rng = np.random.default_rng(seed)
+    dfs = [df]
+    for k in range(1, factor):
+
+        def renum(text):
+            return RE_NUM.sub(lambda m: str((int(m.group(0)) + 7 * k) % 300 + 1), text)
+
+        def renum_url(url):
+            head, _, name = url.rpartition("/")
+            name = RE_URL_NUM.sub(
+                lambda m: f"{(int(m.group(0)) + 37 * k) % 100000:05d}", name
+            )
+            return head + "/" + renum(name)
+
+        def shift_dates(text):
+            if rng.random() < 0.3:
+                return text
+            delta = timedelta(days=int(rng.integers(-3650, 3650)))
+
+            def shift(m):
+                try:
+                    d = datetime(int(m.group(3)), int(m.group(2)), int(m.group(1)))
+                except ValueError:
+                    return m.group(0)
+                return (d + delta).strftime("%d/%m/%Y")
+
+            return RE_DATE.sub(shift, text)
+
+        df_k = df.copy()
+        for col, func in (
+            ("adresse", renum),
+            ("item", renum),
+            ("url", renum_url),
+            ("nom_doc", shift_dates),
+        ):
+            if col in df_k.columns:
+                df_k[col] = _map_uniques(df_k[col], func)
+        dfs.append(df_k)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def stage_inputs(df_raw):
+    """Entrées des étapes, calculées une fois à partir de la liste brute"""
+    df_manual = fix.apply_manual_fixes(df_raw.copy())
+    df_fix = fix.clean(df_manual.copy())
+    return {"raw": df_raw, "manual": df_manual, "fix": df_fix}
+
+
+def time_stage(func, df, repeat=REPEAT):
+    """Mesure le temps d'exécution d'une étape, sur une copie de son entrée.
+
+    Returns
+    -------
+    times : List[float]
+        Durée de chaque répétition, en secondes
+    """
+    times = []
+    for _ in range(repeat):
+        df_in = df.copy()
+        t0 = time.perf_counter()
+        func(df_in)
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def bench_liste(name, df_raw, stages, repeat=REPEAT):
+    """Mesure toutes les étapes sur une liste.
+
+    Parameters
+    ----------
+    name : str
+        Nom de la liste, p. ex. "2021-08-05" ou "2021-08-05x100"
+    df_raw : DataFrame
+        Liste brute des documents
+    stages : List[str]
+        Etapes à mesurer
+    repeat : int
+        Nombre de répétitions de chaque mesure
+
+    Returns
+    -------
+    results : List[dict]
+        Résultat de chaque étape
+    """
+    inputs = stage_inputs(df_raw)
+    results = []
+    for stage in stages:
+        input_name, func = STAGES[stage]
+        res = {"stage": stage, "input": name, "rows": len(df_raw)}
+        try:
+            times = time_stage(func, inputs[input_name], repeat=repeat)
+        except Exception as exc:
+            # p. ex. format d'une liste ancienne non géré par l'étape
+            res["error"] = f"{type(exc).__name__}: {exc}"
+            print(f"{name:>16} {stage:<22} ERREUR {res['error']}")
+        else:
+            res["min_s"] = min(times)
+            res["median_s"] = float(np.median(times))
+            res["rows_per_s"] = len(df_raw) / max(res["min_s"], 1e-9)
+            print(f"{name:>16} {stage:<22} {res['min_s']:9.4f} s")
+        results.append(res)
+    return results
+
+
+def bench_startup(commands=STARTUP_COMMANDS, repeat=REPEAT):
+    """Mesure le temps de démarrage de la commande unique.
+
+    Chaque mesure lance un nouvel interpréteur : elle comprend le
+    démarrage de Python et les imports de la sous-commande.
+
+    Returns
+    -------
+    results : List[dict]
+        Résultat de chaque commande, comme une étape "startup"
+    """
+    results = []
+    for argv in commands:
+        name = " ".join(["mrs-arretes"] + argv)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            subprocess.run(
+                [sys.executable, mrs_arretes.__file__] + argv,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            times.append(time.perf_counter() - t0)
+        res = {"stage": "startup", "input": name, "rows": 0}
+        res["min_s"] = min(times)
+        res["median_s"] = float(np.median(times))
+        print(f"{name:>25} {res['min_s']:9.4f} s")
+        results.append(res)
+    return results
+
+
+def eager_imports(modules=HEAVY_MODULES):
+    """Modules lourds chargés par l'analyse des arguments de la commande unique.
+
+    Returns
+    -------
+    loaded : List[str]
+        Modules lourds chargés, liste vide si tous les imports sont tardifs
+    """
+    code = (
+        "import sys, mrs_arretes; mrs_arretes.build_parser(); "
+        f"print(*[m for m in {modules!r} if m in sys.modules])"
+    )
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=Path(mrs_arretes.__file__).parent,
+    ).stdout.split()
+
+
+def _git_commit():
+    """Commit courant, s'il y en a un"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, threshold=THRESHOLD):
+    """Compare des résultats à ceux d'une exécution de référence.
+
+    Parameters
+    ----------
+    results : List[dict]
+        Résultats de l'exécution courante
+    baseline : List[dict]
+        Résultats de l'exécution de référence
+    threshold : float
+        Ralentissement relatif au-delà duquel une étape est signalée
+
+    Returns
+    -------
+    regressions : List[dict]
+        Etapes plus lentes que la référence, avec le rapport des temps
+    """
+    base = {(r["stage"], r["input"]): r for r in baseline if "min_s" in r}
+    regressions = []
+    for res in results:
+        ref = base.get((res["stage"], res["input"]))
+        if ref is None or "min_s" not in res:
+            continue
+        ratio = res["min_s"] / max(ref["min_s"], 1e-9)
+        slower = res["min_s"] - ref["min_s"] > NOISE_FLOOR
+        flag = "REGRESSION" if ratio > 1 + threshold and slower else ""
+        print(
+            f"{res['input']:>16} {res['stage']:<22} {ref['min_s']:9.4f} s"
+            f" -> {res['min_s']:9.4f} s  x{ratio:5.2f} {flag}"
+        )
+        if flag:
+            regressions.append(dict(res, baseline_s=ref["min_s"], ratio=ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--raw_dir", help="Dossier des listes brutes réelles", default=RAW_DIR
+    )
+    parser.add_argument(
+        "--scales",
+        help="Facteurs d'agrandissement de la liste la plus récente",
+        type=int,
+        nargs="*",
+        default=SCALES,
+    )
+    parser.add_argument(
+        "--stages",
+        help="Etapes à mesurer (par défaut : toutes)",
+        nargs="+",
+        choices=list(STAGES),
+        default=list(STAGES),
+    )
+    parser.add_argument(
+        "--repeat", help="Nombre de répétitions", type=int, default=REPEAT
+    )
+    parser.add_argument(
+        "--out_dir", help="Dossier des résultats JSON", default=RESULTS_DIR
+    )
+    parser.add_argument(
+        "--compare",
+        help="Résultats de référence (par défaut : l'exécution précédente)",
+    )
+    parser.add_argument(
+        "--threshold",
+        help="Ralentissement relatif signalé comme régression",
+        type=float,
+        default=THRESHOLD,
+    )
+    parser.add_argument(
+        "--no_startup",
+        help="Ne pas mesurer le démarrage de la commande unique",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    #
+    fps_raw = list_snapshots(args.raw_dir)
+    results = []
+    for snapshot, fp in fps_raw.items():
+        results.extend(bench_liste(snapshot, read_liste(fp), args.stages, args.repeat))
+    # listes synthétiques, à partir de la liste la plus récente
+    snapshot, fp = list(fps_raw.items())[-1]
+    df_last = read_liste(fp)
+    for factor in args.scales:
+        df_synth = synth_liste(df_last, factor)
+        results.extend(
+            bench_liste(f"{snapshot}x{factor}", df_synth, args.stages, args.repeat)
+        )
+    # démarrage de la commande unique
+    loaded = []
+    if not args.no_startup:
+        results.extend(bench_startup(repeat=args.repeat))
+        loaded = eager_imports()
+        if loaded:
+            print(f"ERREUR modules lourds chargés au démarrage : {', '.join(loaded)}")
+    # résultats
+    run = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "pyarrow": enrich.STR_DTYPE == "string[pyarrow]",
+        "machine": platform.platform(),
+        "repeat": args.repeat,
+        "eager_imports": loaded,
+        "results": results,
+    }
+    out_dir = Path(args.out_dir)
+    fps_prev = sorted(out_dir.glob("*.json"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    fp_out = out_dir / (run["created"].replace(":", "-") + ".json")
+    with open(fp_out, mode="w", encoding="utf-8") as f_out:
+        json.dump(run, f_out, ensure_ascii=False, indent=1)
+    print(f"Résultats : {fp_out}")
+    # comparaison à la référence
+    fp_base = (
+        Path(args.compare) if args.compare else (fps_prev[-1] if fps_prev else None)
+    )
+    regressions = []
+    if fp_base is not None:
+        with open(fp_base, encoding="utf-8") as f_base:
+            baseline = json.load(f_base)
+        print(f"Comparaison à {fp_base} (commit {baseline.get('commit')})")
+        regressions = compare_results(results, baseline["results"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} régression(s)")
+    if regressions or loaded:
+        sys.exit(1)
@@ -0,0 +1,312 @@
+"""Empreintes et caches pour éviter de refaire des traitements déjà faits.
+
+Une étape n'a pas besoin d'être relancée si ni son entrée, ni ses règles
+(expressions régulières, tables de corrections manuelles...) n'ont changé.
+
+D'une liste à la suivante, la plupart des textes (nom_doc, item, url) sont
+les mêmes : le cache mémo garde sur disque le résultat des fonctions de
+classification et d'extraction pour chaque texte déjà vu, sous une clé qui
+combine le texte et la version des règles.
+"""
+
+import hashlib
+import inspect
+import os
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+# fichier du cache mémo
+MEMO_DB = ".cache/memo.sqlite"
+# nombre maximal d'entrées du cache mémo, au-delà on supprime les moins récentes
+MEMO_MAX_ENTRIES = 500_000
+# nombre de versions des règles gardées en cache pour chaque fonction
+MEMO_MAX_VERSIONS = 4
+# dossier des modules du dépôt
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# nombre maximal de clés par requête SQL
+_SQL_BATCH = 500
+
+
+def hash_df(df):
+    """Calcule l'empreinte du contenu d'un DataFrame.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Tableau de données
+
+    Returns
+    -------
+    digest : str
+        Empreinte SHA-256 des noms de colonnes et des valeurs.
+    """
+    h = hashlib.sha256()
+    h.update(repr(list(df.columns)).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def _local_deps(module, deps):
+    """Ajoute à `deps` un module du dépôt et, récursivement, ceux qu'il importe"""
+    fp = os.path.abspath(getattr(module, "__file__", None) or "")
+    if os.path.dirname(fp) != REPO_DIR or not os.path.isfile(fp) or fp in deps:
+        return
+    deps[fp] = module
+    for value in vars(module).values():
+        if inspect.ismodule(value):
+            _local_deps(value, deps)
+        elif isinstance(getattr(value, "__module__", None), str):
+            # fonction ou classe importée d'un autre module
+            if value.__module__ in sys.modules:
+                _local_deps(sys.modules[value.__module__], deps)
+
+
+def rules_version(*modules):
+    """Calcule la version des règles d'une ou plusieurs étapes de traitement.
+
+    Les règles (expressions régulières, tables de corrections, code des
+    fonctions) sont définies dans les modules des étapes et dans les modules
+    du dépôt qu'ils importent (`rule_tables`, `adresses`...), donc la version
+    est l'empreinte du code source de ces modules.
+
+    Parameters
+    ----------
+    *modules : module
+        Modules des étapes de traitement
+
+    Returns
+    -------
+    digest : str
+        Empreinte SHA-256 du code source des modules et de leurs dépendances.
+    """
+    deps = {}
+    for module in modules:
+        _local_deps(module, deps)
+    h = hashlib.sha256()
+    for fp in sorted(deps):
+        h.update(inspect.getsource(deps[fp]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def hash_str(*parts):
+    """Calcule l'empreinte d'une suite de chaînes de caractères"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class MemoCache:
+    """Cache mémo sur disque (SQLite) de fonctions texte -> texte.
+
+    Chaque entrée est indexée par le nom de la fonction, la version de ses
+    règles et le texte en entrée. Pour chaque fonction, seules les entrées
+    des `max_versions` versions les plus récemment utilisées sont gardées :
+    passer d'une branche à l'autre ne vide pas le cache. Au-delà de
+    `max_entries` entrées, les moins récemment utilisées sont supprimées.
+
+    Parameters
+    ----------
+    fp_db : str
+        Chemin du fichier SQLite
+    max_entries : int
+        Nombre maximal d'entrées
+    max_versions : int
+        Nombre maximal de versions des règles gardées pour chaque fonction
+    """
+
+    def __init__(
+        self,
+        fp_db=MEMO_DB,
+        max_entries=MEMO_MAX_ENTRIES,
+        max_versions=MEMO_MAX_VERSIONS,
+    ):
+        if os.path.dirname(fp_db):
+            os.makedirs(os.path.dirname(fp_db), exist_ok=True)
+        self.max_entries = max_entries
+        self.max_versions = max_versions
+        self.conn = sqlite3.connect(fp_db)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS memo ("
+            " func TEXT, version TEXT, key TEXT, value TEXT, last_used REAL,"
+            " PRIMARY KEY (func, version, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS memo_lru ON memo (last_used)")
+        self._checked = set()
+        # résultats des fonctions enveloppées, à écrire à la fermeture
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _invalidate(self, name, version):
+        """Supprime les entrées d'une fonction calculées avec des règles anciennes.
+
+        La version courante et les `max_versions - 1` autres versions les plus
+        récemment utilisées sont gardées.
+        """
+        if (name, version) not in self._checked:
+            self.conn.execute(
+                "DELETE FROM memo WHERE func = ? AND version != ? AND version NOT IN"
+                " (SELECT version FROM memo WHERE func = ? AND version != ?"
+                " GROUP BY version ORDER BY MAX(last_used) DESC LIMIT ?)",
+                (name, version, name, version, self.max_versions - 1),
+            )
+            self._checked.add((name, version))
+
+    def get_many(self, name, version, keys):
+        """Résultats en cache pour une liste de textes.
+
+        Parameters
+        ----------
+        name : str
+            Nom de la fonction
+        version : str
+            Version des règles de la fonction
+        keys : List[str]
+            Textes en entrée
+
+        Returns
+        -------
+        known : Dict[str, str]
+            Résultat pour chaque texte déjà en cache (None pour une valeur
+            manquante).
+        """
+        self._invalidate(name, version)
+        known = {}
+        now = time.time()
+        for i in range(0, len(keys), _SQL_BATCH):
+            batch = keys[i : i + _SQL_BATCH]
+            marks = ",".join("?" * len(batch))
+            params = [name, version] + batch
+            known.update(
+                self.conn.execute(
+                    "SELECT key, value FROM memo WHERE func = ? AND version = ?"
+                    f" AND key IN ({marks})",
+                    params,
+                )
+            )
+            self.conn.execute(
+                "UPDATE memo SET last_used = ? WHERE func = ? AND version = ?"
+                f" AND key IN ({marks})",
+                [now] + params,
+            )
+        return known
+
+    def put_many(self, name, version, items):
+        """Met en cache les résultats d'une fonction.
+
+        Parameters
+        ----------
+        name : str
+            Nom de la fonction
+        version : str
+            Version des règles de la fonction
+        items : Dict[str, str]
+            Résultat pour chaque texte en entrée
+        """
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)",
+            [(name, version, key, value, now) for key, value in items.items()],
+        )
+
+    def map_column(self, name, version, s_in, func):
+        """Applique une fonction vectorisée à une colonne, via le cache.
+
+        La fonction n'est appelée que sur les textes distincts absents du cache.
+
+        Parameters
+        ----------
+        name : str
+            Nom de la fonction
+        version : str
+            Version des règles de la fonction
+        s_in : Series
+            Textes en entrée
+        func : Callable[[Series], Series]
+            Fonction vectorisée, qui renvoie un résultat aligné sur son entrée
+
+        Returns
+        -------
+        s_out : Series
+            Résultat pour chaque texte, aligné sur `s_in`.
+        """
+        keys = [str(x) for x in pd.unique(s_in.dropna())]
+        known = self.get_many(name, version, keys)
+        missing = [key for key in keys if key not in known]
+        if missing:
+            values = func(pd.Series(missing, dtype="string"))
+            new = {
+                key: (None if pd.isna(value) else str(value))
+                for key, value in zip(missing, values)
+            }
+            self.put_many(name, version, new)
+            known.update(new)
+        s_out = s_in.map(known).astype(object)
+        # les valeurs manquantes ne sont pas mises en cache
+        na = s_in.isna()
+        if na.any():
+            s_out[na] = list(func(s_in[na]))
+        return s_out
+
+    def wrap(self, name, version, func):
+        """Enveloppe une fonction texte -> texte, appelée un texte à la fois.
+
+        Les entrées de la fonction sont chargées en mémoire à la création
+        de l'enveloppe, les nouveaux résultats sont écrits à la fermeture
+        du cache.
+
+        Parameters
+        ----------
+        name : str
+            Nom de la fonction
+        version : str
+            Version des règles de la fonction
+        func : Callable[[str], str]
+            Fonction
+
+        Returns
+        -------
+        memo_func : Callable[[str], str]
+            Fonction avec cache
+        """
+        self._invalidate(name, version)
+        known = dict(
+            self.conn.execute(
+                "SELECT key, value FROM memo WHERE func = ? AND version = ?",
+                (name, version),
+            )
+        )
+        new = {}
+        self._pending.append((name, version, new))
+
+        def memo_func(key):
+            if key in known:
+                return known[key]
+            value = func(key)
+            known[key] = new[key] = value
+            return value
+
+        return memo_func
+
+    def close(self):
+        """Ecrit les résultats en attente, applique la limite de taille et ferme"""
+        for name, version, new in self._pending:
+            self.put_many(name, version, new)
+        n_entries = self.conn.execute("SELECT COUNT(*) FROM memo").fetchone()[0]
+        if n_entries > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM memo WHERE rowid IN"
+                " (SELECT rowid FROM memo ORDER BY last_used LIMIT ?)",
+                (n_entries - self.max_entries,),
+            )
+        self.conn.commit()
+        self.conn.close()
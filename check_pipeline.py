@@ -0,0 +1,488 @@
+"""Vérifie que les variantes d'une étape donnent les mêmes résultats.
+
+Chaque vérification traite toutes les listes (brutes ou corrigées) par
+deux chemins qui doivent être équivalents, et compare les résultats ligne à
+ligne :
+
+- "parquet" : l'enrichissement d'une liste corrigée relue en Parquet est
+  identique à celui de la même liste relue en CSV ;
+- "classes" : la classification des documents (textes des liens et URL),
+  vectorisée ou ligne à ligne, est identique à celle de la cascade de
+  `elif` d'origine, recopiée ici avec ses motifs comme référence
+  indépendante des tables de règles, sur les listes corrigées de
+  data/interim ;
+- "html" : l'analyse sans navigateur d'une page enregistrée (réduite), dans
+  data/fixtures, donne les lignes relevées par le script Selenium sur la
+  même page (fichier CSV de même nom) ;
+- "download" : le téléchargement (`download_arretes.download_docs`), face à
+  un serveur HTTP local : URLs en double, limite par hôte, chemins des
+  fichiers, requêtes conditionnelles (304) et reprise des téléchargements
+  interrompus (206, 416).
+
+Les vérifications sans entrée se lancent une seule fois, sur leurs propres
+données. Le dépôt n'a pas de suite de tests : ce script en tient lieu, à lancer
+après toute modification du stockage ou des règles. Il se termine en
+erreur si une vérification échoue.
+
+Utilisation :
+    python check_pipeline.py
+    python check_pipeline.py --checks classes
+"""
+
+import argparse
+import contextlib
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib.util
+import io
+import json
+import os
+from pathlib import Path
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+import pandas as pd
+
+import download_arretes
+import enrich_liste_arretes as enrich
+import fix_liste_arretes as fix
+from storage import list_snapshots, read_liste, write_liste
+
+# dossier des listes brutes
+RAW_DIR = "data/raw"
+# dossier des listes corrigées
+INTERIM_DIR = "data/interim"
+# dossier des pages enregistrées et des lignes attendues
+FIXTURES_DIR = Path(__file__).resolve().parent / "data" / "fixtures"
+# nombre maximal de lignes différentes affichées par vérification
+MAX_SHOWN = 5
+
+
+def diff_frames(df_a, df_b):
+    """Lignes qui diffèrent entre deux listes de même forme.
+
+    Returns
+    -------
+    df_diff : DataFrame
+        Lignes de `df_a` et `df_b` qui diffèrent, côte à côte ; vide si les
+        deux listes sont identiques (valeurs manquantes comprises).
+    """
+    if list(df_a.columns) != list(df_b.columns) or len(df_a) != len(df_b):
+        raise ValueError(
+            f"Formes différentes : {list(df_a.columns)} x {len(df_a)}, "
+            f"{list(df_b.columns)} x {len(df_b)}"
+        )
+    df_a = df_a.reset_index(drop=True).astype("string")
+    df_b = df_b.reset_index(drop=True).astype("string")
+    same = (df_a == df_b).fillna(False) | (df_a.isna() & df_b.isna())
+    rows = ~same.all(axis=1)
+    return pd.concat([df_a[rows], df_b[rows]], axis=1, keys=["a", "b"])
+
+
+def check_parquet(df_raw):
+    """Enrichissement d'une liste corrigée relue en CSV, puis en Parquet"""
+    df_fix = fix.fix_liste(df_raw)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fp_fix = Path(tmp_dir) / "liste_fix"
+        write_liste(df_fix, fp_fix, fmt="both")
+        df_csv = enrich.enrich_liste(read_liste(fp_fix.with_suffix(".csv")))
+        df_pq = enrich.enrich_liste(read_liste(fp_fix.with_suffix(".parquet")))
+    return diff_frames(df_csv, df_pq)
+
+
+# classification de référence : cascade et motifs d'origine, recopiés tels
+# quels ; une erreur de motif ou d'ordre dans les tables de règles
+# (`DOC_CLASS_RULES`, `URL_CLASS_RULES`) fait échouer la vérification
+M_MLP = re.compile(r"mai[ln][- ]?l[ée]v[ée]e partiel(le)?", re.IGNORECASE)
+M_ML = re.compile(r"mai[ln][- ]?l[ée]v[ée]e", re.IGNORECASE)
+M_ABRO = re.compile(r"abrogati", re.IGNORECASE)
+M_EVAC = re.compile(r"[ée]vacuation", re.IGNORECASE)
+M_REINTEG_P = re.compile(r"r[ée]int[ée]gration partielle", re.IGNORECASE)
+M_REINTEG = re.compile(r"r[ée]int[ée]gration", re.IGNORECASE)
+M_MODIF = re.compile(r"modificati", re.IGNORECASE)
+M_PERIL_ORD = re.compile(r"p[ée]?ril ordinaire", re.IGNORECASE)
+M_PERIL_GI = re.compile(r"p[ée]?ril grave (et )?im[m]?in[n]?ent", re.IGNORECASE)
+M_PERIL_IMM = re.compile(r"p[ée]?ril imminent", re.IGNORECASE)
+M_PERIM = re.compile(r"périmètre[s]? de (sécurité|protection)", re.IGNORECASE)
+M_INTER_OCCUP = re.compile(r"(inte[r]?diction.*)?d'occup", re.IGNORECASE)
+M_MSU = re.compile(r"mi[s]?e en séc(ur|ru)it[t]?é urgente", re.IGNORECASE)
+M_MISE_SECU = re.compile(r"mi[s]?e en séc(ur|ru)it[t]?é", re.IGNORECASE)
+M_PS = re.compile(r"[/_-]ps[/_-]", re.IGNORECASE)
+M_PO = re.compile(r"[/_-]po[/_-]", re.IGNORECASE)
+M_PI = re.compile(r"[/_-]pi[/_-]", re.IGNORECASE)
+M_PGI = re.compile(r"[/_-]pgi[/_-]", re.IGNORECASE)
+
+
+def reference_doc_class(doc_text):
+    """Classe d'un document d'après le texte du lien (cascade d'origine)"""
+    if M_MLP.search(doc_text):
+        doc_class = "Arrêtés de mainlevée partielle"
+    elif M_ML.search(doc_text):
+        doc_class = "Arrêtés de mainlevée"
+    elif M_ABRO.search(doc_text):
+        doc_class = "Abrogations"
+    elif M_REINTEG_P.search(doc_text):
+        doc_class = "Arrêtés de réintégration partielle"
+    elif M_REINTEG.search(doc_text):
+        doc_class = "Arrêtés de réintégration"
+    elif M_EVAC.search(doc_text):
+        doc_class = "Arrêtés d'évacuation"
+    elif M_MODIF.search(doc_text):
+        doc_class = "Arrêtés modificatifs"
+    elif M_PERIL_ORD.search(doc_text):
+        doc_class = "Arrêtés de péril ordinaire"
+    elif M_PERIL_IMM.search(doc_text):
+        doc_class = "Arrêtés de péril imminent"
+    elif M_PERIL_GI.search(doc_text):
+        doc_class = "Arrêtés de péril grave et imminent"
+    elif "insécurité" in doc_text:
+        doc_class = "Arrêtés d'insécurité imminente des équipements communs"
+    elif M_INTER_OCCUP.search(doc_text):
+        doc_class = "Arrêtés d'interdiction d'occuper"
+    elif "police générale" in doc_text:
+        doc_class = "Arrêtés de police générale"
+    elif "évacuation" in doc_text or "réintégration" in doc_text:
+        doc_class = "Arrêtés d'évacuation et de réintégration"
+    elif "diagnostic d'ouvrages" in doc_text:
+        doc_class = "Diagnostics d'ouvrages"
+    elif M_PERIM.search(doc_text) is not None:
+        doc_class = "Arrêtés de périmètres de sécurité sur voie publique"
+    elif "déconstruction" in doc_text:
+        doc_class = "Arrêtés de déconstruction"
+    elif M_MSU.search(doc_text):
+        doc_class = "Arrêtés de mise en sécurité urgente"
+    elif M_MISE_SECU.search(doc_text):
+        doc_class = "Arrêtés de mise en sécurité"
+    else:
+        doc_class = "?"
+    return doc_class
+
+
+def reference_url_class(url):
+    """Classe d'un document d'après son URL (cascade d'origine)"""
+    if M_PGI.search(url):
+        doc_class = "Arrêtés de péril grave et imminent"
+    elif M_PI.search(url):
+        doc_class = "Arrêtés de péril imminent"
+    elif M_PO.search(url):
+        doc_class = "Arrêtés de péril ordinaire"
+    elif M_PS.search(url):
+        doc_class = "Arrêtés de péril simple"
+    elif "mlpi" in url:
+        doc_class = "Arrêtés de mainlevée"
+    elif "pni" in url:
+        doc_class = "Arrêtés de péril non imminent"
+    elif "msu" in url:
+        doc_class = "Arrêtés de mise en sécurité urgente"
+    elif "ml" in url:
+        doc_class = "Arrêtés de mainlevée"
+    elif "occup" in url:
+        doc_class = "Arrêtés d'interdiction d'occuper"
+    elif "police" in url:
+        doc_class = "Arrêtés de police générale"
+    elif "perimetre" in url:
+        doc_class = "Arrêtés de périmètres de sécurité sur voie publique"
+    else:
+        doc_class = "Arrêtés de péril grave et imminent"
+    return doc_class
+
+
+def check_classes(df_fix):
+    """Classification des textes des liens et des URL, comparée à la référence"""
+    s_nom_doc = df_fix["nom_doc"].fillna("")
+    s_url = df_fix["url"].dropna()
+    df_rules = pd.DataFrame(
+        {
+            "nom_doc": s_nom_doc,
+            "classe_doc": enrich.predict_doc_classes(s_nom_doc),
+            "classe_doc_ligne": s_nom_doc.apply(enrich.predict_doc_class),
+            "classe_url": enrich.guess_doc_class(s_url),
+        }
+    )
+    s_ref_doc = s_nom_doc.apply(reference_doc_class)
+    df_ref = pd.DataFrame(
+        {
+            "nom_doc": s_nom_doc,
+            "classe_doc": s_ref_doc,
+            "classe_doc_ligne": s_ref_doc,
+            "classe_url": s_url.apply(reference_url_class),
+        }
+    )
+    return diff_frames(df_rules, df_ref)
+
+
+def _load_script(fp):
+    """Charge un script dont le nom n'est pas un nom de module (tirets)"""
+    spec = importlib.util.spec_from_file_location(Path(fp).stem.replace("-", "_"), fp)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def check_html():
+    """Analyse sans navigateur des pages enregistrées, comparée aux lignes attendues"""
+    get_liste = _load_script(
+        Path(__file__).resolve().parent / "get_liste_arretes_2021-06.py"
+    )
+    dfs_parsed = []
+    dfs_expected = []
+    for fp_html in sorted(FIXTURES_DIR.glob("*.html")):
+        df_expected = read_liste(fp_html.with_suffix(".csv"))
+        with open(fp_html, encoding="utf-8") as f_in:
+            html = f_in.read()
+        # sans l'affichage de la progression
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = get_liste.parse_arretes_html(html, get_liste.URL)
+        df_parsed = pd.DataFrame(rows, columns=df_expected.columns, dtype="string")
+        dfs_parsed.append(df_parsed.mask(df_parsed == ""))
+        dfs_expected.append(df_expected)
+    if not dfs_expected:
+        raise ValueError(f"Aucune page enregistrée dans {FIXTURES_DIR}")
+    return diff_frames(pd.concat(dfs_parsed), pd.concat(dfs_expected))
+
+
+def doc_etag(data):
+    """ETag d'un document du serveur local"""
+    return f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+
+
+class DocServer(ThreadingHTTPServer):
+    """Serveur HTTP local des documents, qui note les requêtes reçues.
+
+    Les réponses gèrent les en-têtes If-None-Match (304), Range et If-Range
+    (206, 416) comme le site de la ville. Les documents dont le chemin
+    contient "bad-range" répondent à une reprise par un morceau qui ne
+    commence pas au début demandé.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, docs, delay=0.0):
+        super().__init__(("127.0.0.1", 0), DocHandler)
+        self.docs = docs
+        self.delay = delay
+        self.requests = []
+        self.n_active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class DocHandler(BaseHTTPRequestHandler):
+    """Réponses du serveur local des documents"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.n_active += 1
+            server.max_active = max(server.max_active, server.n_active)
+        try:
+            time.sleep(server.delay)
+            self._respond()
+        finally:
+            with server.lock:
+                server.n_active -= 1
+
+    def _respond(self):
+        data = self.server.docs.get(self.path)
+        etag = doc_etag(data) if data is not None else None
+        rng = self.headers.get("Range")
+        if data is None:
+            status = 404
+        elif self.headers.get("If-None-Match") == etag:
+            status = 304
+        elif rng is not None and self.headers.get("If-Range") == etag:
+            start = int(rng.split("=")[1].rstrip("-"))
+            status = 416 if start >= len(data) else 206
+        else:
+            status = 200
+        self.server.requests.append((self.path, rng, status))
+        self.send_response(status)
+        if data is None or status == 304:
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_header("ETag", etag)
+        if status == 416:
+            self.send_header("Content-Range", f"bytes */{len(data)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = data
+        if status == 206:
+            if "bad-range" in self.path:
+                start = 1
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}"
+            )
+            body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def check_download():
+    """Téléchargements face à un serveur HTTP local"""
+    rng = random.Random(0)
+    docs = {f"/files/{i % 3}/doc-{i}.pdf": rng.randbytes(100_000 + i) for i in range(8)}
+    # téléchargements interrompus : fichier partiel de la moitié, du
+    # document entier (416), ou repris par un morceau décalé
+    resumed = {
+        "/files/part/half.pdf": 50_000,
+        "/files/part/full.pdf": 120_000,
+        "/files/part/bad-range.pdf": 50_000,
+    }
+    for path in resumed:
+        docs[path] = rng.randbytes(120_000)
+    max_per_host = 2
+    errors = []
+
+    def _check(case, ok, detail):
+        if not ok:
+            errors.append((case, detail))
+
+    server = DocServer(docs, delay=0.05)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = download_arretes.make_session()
+    # pas de proxy vers le serveur local
+    session.trust_env = False
+    try:
+        # sans l'affichage de la progression
+        with contextlib.redirect_stdout(
+            io.StringIO()
+        ), tempfile.TemporaryDirectory() as dl_dir:
+            urls = [server.base_url + path for path in docs if path not in resumed]
+            url_404 = server.base_url + "/files/0/absent.pdf"
+            manifest = {}
+            urls_404 = download_arretes.download_docs(
+                urls + urls[::-1] + [url_404],
+                dl_dir,
+                max_per_host=max_per_host,
+                session=session,
+                manifest=manifest,
+            )
+            n_gets = {}
+            for path, _, _ in server.requests:
+                n_gets[path] = n_gets.get(path, 0) + 1
+            _check("doublons", set(n_gets.values()) == {1}, f"requêtes : {n_gets}")
+            _check(
+                "limite par hôte",
+                server.max_active == max_per_host,
+                f"{server.max_active} requêtes simultanées",
+            )
+            _check("injoignable", urls_404 == {url_404}, f"{sorted(urls_404)}")
+            for url in urls:
+                fp = Path(dl_dir) / url.split("/")[-2] / url.split("/")[-1]
+                _check(
+                    "chemins",
+                    fp.is_file() and fp.read_bytes() == docs[urlsplit(url).path],
+                    f"{fp} absent ou différent",
+                )
+            # 2e passage : requêtes conditionnelles
+            server.requests.clear()
+            download_arretes.download_docs(
+                urls, dl_dir, session=session, manifest=manifest
+            )
+            statuses = {status for _, _, status in server.requests}
+            _check("304", statuses == {304}, f"réponses : {sorted(statuses)}")
+            # reprise des téléchargements interrompus
+            server.requests.clear()
+            for path, part_size in resumed.items():
+                full_fp = os.path.join(dl_dir, *path.split("/")[-2:])
+                os.makedirs(os.path.dirname(full_fp), exist_ok=True)
+                with open(full_fp + ".part", mode="wb") as f_out:
+                    f_out.write(docs[path][:part_size])
+                etag = doc_etag(docs[path])
+                with open(
+                    full_fp + download_arretes.PART_META_SUFFIX, mode="w"
+                ) as f_meta:
+                    json.dump({"etag": etag, "last_modified": None}, f_meta)
+            download_arretes.download_docs(
+                [server.base_url + path for path in resumed],
+                dl_dir,
+                session=session,
+                manifest=manifest,
+            )
+            for path, expected in [
+                ("/files/part/half.pdf", [206]),
+                ("/files/part/full.pdf", [416, 200]),
+                ("/files/part/bad-range.pdf", [206, 200]),
+            ]:
+                got = [status for p, _, status in server.requests if p == path]
+                full_fp = Path(dl_dir, *path.split("/")[-2:])
+                _check(
+                    f"reprise {path}",
+                    got == expected
+                    and full_fp.read_bytes() == docs[path]
+                    and not full_fp.with_name(full_fp.name + ".part").exists(),
+                    f"réponses : {got}",
+                )
+    finally:
+        server.shutdown()
+        server.server_close()
+    return pd.DataFrame(errors, columns=["cas", "erreur"])
+
+
+# vérifications : (entrée, fonction) ; l'entrée est la liste brute ("raw"), la
+# liste corrigée de data/interim ("fix") ou rien (None, vérification lancée une
+# fois) ; la fonction renvoie les lignes différentes
+CHECKS = {
+    "parquet": ("raw", check_parquet),
+    "classes": ("fix", check_classes),
+    "html": (None, check_html),
+    "download": (None, check_download),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw_dir", help="Dossier des listes brutes", default=RAW_DIR)
+    parser.add_argument(
+        "--interim_dir", help="Dossier des listes corrigées", default=INTERIM_DIR
+    )
+    parser.add_argument(
+        "--checks",
+        help="Vérifications à lancer (par défaut : toutes)",
+        nargs="+",
+        choices=list(CHECKS),
+        default=list(CHECKS),
+    )
+    args = parser.parse_args()
+    #
+    fps = {
+        "raw": list_snapshots(args.raw_dir),
+        "fix": list_snapshots(args.interim_dir, suffix="_fix"),
+        None: {"-": None},
+    }
+    n_failed = 0
+    for name in args.checks:
+        input_name, func = CHECKS[name]
+        for snapshot, fp in fps[input_name].items():
+            try:
+                df_diff = func() if fp is None else func(read_liste(fp))
+            except ValueError as exc:
+                n_failed += 1
+                print(f"{snapshot:<10} {name:<10} ERREUR {exc}")
+                continue
+            if df_diff.empty:
+                print(f"{snapshot:<10} {name:<10} OK")
+                continue
+            n_failed += 1
+            print(
+                f"{snapshot:<10} {name:<10} ERREUR {len(df_diff)} ligne(s) différente(s)"
+            )
+            with pd.option_context("display.max_colwidth", 60):
+                print(df_diff.head(MAX_SHOWN).to_string())
+    if n_failed:
+        sys.exit(1)
@@ -0,0 +1,329 @@
+"""Stockage des documents par contenu (empreinte SHA-256).
+
+Chaque document est stocké une seule fois, dans un fichier nommé par son
+empreinte SHA-256 (".store/ab/abcdef..." dans le dossier des documents).
+Les chemins habituels des documents (2 derniers segments de l'URL, voir
+`download_arretes.doc_path`) sont des liens physiques vers ces fichiers :
+des documents identiques sous des chemins différents n'occupent la place
+que d'un seul fichier, et un chemin effacé est restauré depuis le stock
+sans re-téléchargement.
+
+Un index associe à chaque chemin l'empreinte, la taille et la date de
+modification de son fichier, ce qui permet de connaître l'empreinte d'un
+document sans le relire et de vérifier l'intégrité du stock sans rien
+re-télécharger.
+
+Un document mis à jour est écrit dans un nouveau fichier, qui remplace le
+lien du chemin : le fichier du stock n'est pas modifié. Les fichiers du
+stock partagent leurs données (inode) avec les chemins des documents et
+gardent donc leurs droits ; seules les copies, faites quand le système de
+fichiers ne permet pas les liens physiques, sont en lecture seule.
+
+Utilisation :
+    python doc_store.py ingest --doc_dir data/arretes
+    python doc_store.py verify --doc_dir data/arretes
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+
+# dossier du stock, dans le dossier des documents
+STORE_NAME = ".store"
+# nom de l'index chemin -> empreinte, dans le dossier du stock
+INDEX_NAME = "index.json"
+# droits des copies du stock (lecture seule)
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+# taille des morceaux lus pour le calcul des empreintes (en octets)
+CHUNK_SIZE = 64 * 1024
+
+# verrou des écritures de l'index par les threads de téléchargement
+_index_lock = threading.Lock()
+
+
+def update_hash(h, fp):
+    """Met à jour une empreinte avec le contenu d'un fichier, lu par morceaux"""
+    with open(fp, mode="rb") as f_in:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h
+
+
+def file_sha256(fp):
+    """Calcule l'empreinte SHA-256 d'un fichier"""
+    return update_hash(hashlib.sha256(), fp).hexdigest()
+
+
+def store_dir(doc_dir):
+    """Dossier du stock d'un dossier de documents"""
+    return os.path.join(doc_dir, STORE_NAME)
+
+
+def blob_path(doc_dir, digest):
+    """Chemin du fichier du stock pour une empreinte"""
+    return os.path.join(store_dir(doc_dir), digest[:2], digest)
+
+
+def load_index(doc_dir):
+    """Charge l'index du stock.
+
+    Parameters
+    ----------
+    doc_dir : str
+        Dossier des documents
+
+    Returns
+    -------
+    index : Dict[str, dict]
+        Pour chaque chemin relatif : empreinte SHA-256, taille et date de
+        modification (ns) du fichier. Dictionnaire vide si l'index n'existe
+        pas encore.
+    """
+    fp_index = os.path.join(store_dir(doc_dir), INDEX_NAME)
+    if not os.path.exists(fp_index):
+        return {}
+    with open(fp_index, encoding="utf-8") as f_in:
+        return json.load(f_in)
+
+
+def save_index(index, doc_dir):
+    """Enregistre l'index du stock, de façon atomique"""
+    fp_index = os.path.join(store_dir(doc_dir), INDEX_NAME)
+    os.makedirs(os.path.dirname(fp_index), exist_ok=True)
+    fp_tmp = fp_index + ".tmp"
+    with open(fp_tmp, mode="w", encoding="utf-8") as f_out:
+        json.dump(index, f_out, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(fp_tmp, fp_index)
+
+
+def _link(src, dst):
+    """Remplace `dst` par un lien physique vers `src`, de façon atomique.
+
+    Si le système de fichiers ne permet pas les liens physiques, `dst` est
+    une copie de `src`.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    dst_tmp = f"{dst}.{threading.get_ident()}.link"
+    try:
+        os.link(src, dst_tmp)
+    except OSError:
+        shutil.copyfile(src, dst_tmp)
+    os.replace(dst_tmp, dst)
+
+
+def add_file(doc_dir, fp, digest=None, index=None):
+    """Range un document dans le stock, et remplace son chemin par un lien.
+
+    Si le stock contient déjà un document identique, le fichier est
+    remplacé par un lien vers ce document : les doublons n'occupent pas de
+    place supplémentaire.
+
+    Parameters
+    ----------
+    doc_dir : str
+        Dossier des documents
+    fp : str
+        Chemin relatif du document, dans `doc_dir`
+    digest : str, optional
+        Empreinte SHA-256 du document, si elle est déjà connue
+    index : Dict[str, dict], optional
+        Index du stock, mis à jour en place
+
+    Returns
+    -------
+    digest : str
+        Empreinte SHA-256 du document
+    """
+    full_fp = os.path.join(doc_dir, fp)
+    if digest is None:
+        digest = file_sha256(full_fp)
+    fp_blob = blob_path(doc_dir, digest)
+    os.makedirs(os.path.dirname(fp_blob), exist_ok=True)
+    try:
+        # nouveau contenu : le fichier devient celui du stock
+        os.link(full_fp, fp_blob)
+    except FileExistsError:
+        # contenu déjà stocké : le fichier est remplacé par un lien
+        if not os.path.samefile(full_fp, fp_blob):
+            _link(fp_blob, full_fp)
+    except OSError:
+        # pas de liens physiques : le stock garde une copie, en lecture
+        # seule ; un fichier lié reste modifiable, comme le document
+        shutil.copyfile(full_fp, fp_blob + ".tmp")
+        os.chmod(fp_blob + ".tmp", READ_ONLY)
+        os.replace(fp_blob + ".tmp", fp_blob)
+    if index is not None:
+        st = os.stat(full_fp)
+        with _index_lock:
+            index[fp] = {
+                "sha256": digest,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+            }
+    return digest
+
+
+def restore(doc_dir, fp, digest):
+    """Restaure un chemin depuis le stock, sans re-téléchargement.
+
+    Returns
+    -------
+    restored : bool
+        True si le stock contient le document
+    """
+    fp_blob = blob_path(doc_dir, digest)
+    if not os.path.exists(fp_blob):
+        return False
+    _link(fp_blob, os.path.join(doc_dir, fp))
+    return True
+
+
+def known_digest(doc_dir, fp, index):
+    """Empreinte d'un document, lue dans l'index si le fichier n'a pas changé.
+
+    Parameters
+    ----------
+    doc_dir : str
+        Dossier des documents
+    fp : str
+        Chemin relatif du document
+    index : Dict[str, dict]
+        Index du stock
+
+    Returns
+    -------
+    digest : str
+        Empreinte SHA-256 du document, calculée si le fichier est absent de
+        l'index ou a changé depuis (taille ou date de modification).
+    """
+    full_fp = os.path.join(doc_dir, fp)
+    entry = index.get(fp)
+    if entry is not None:
+        st = os.stat(full_fp)
+        if (st.st_size, st.st_mtime_ns) == (entry["size"], entry["mtime_ns"]):
+            return entry["sha256"]
+    return file_sha256(full_fp)
+
+
+def iter_docs(doc_dir):
+    """Chemins relatifs des documents, hors stock et fichiers temporaires.
+
+    Les documents sont rangés dans des sous-dossiers (voir
+    `download_arretes.doc_path`) : les fichiers à la racine (manifeste des
+    téléchargements) sont ignorés.
+    """
+    for dirpath, dirnames, filenames in os.walk(doc_dir):
+        if dirpath == doc_dir:
+            dirnames[:] = [d for d in dirnames if d != STORE_NAME]
+            continue
+        for fname in filenames:
+            if fname.endswith((".part", ".part.json", ".tmp", ".link")):
+                continue
+            yield os.path.relpath(os.path.join(dirpath, fname), doc_dir).replace(
+                os.sep, "/"
+            )
+
+
+def ingest(doc_dir):
+    """Range dans le stock tous les documents du dossier.
+
+    Sert à la migration d'un dossier de documents existant ; les
+    téléchargements suivants rangent eux-mêmes les nouveaux documents.
+
+    Parameters
+    ----------
+    doc_dir : str
+        Dossier des documents
+
+    Returns
+    -------
+    n_docs : int
+        Nombre de documents
+    n_blobs : int
+        Nombre de documents distincts dans le stock
+    """
+    index = load_index(doc_dir)
+    for fp in iter_docs(doc_dir):
+        digest = known_digest(doc_dir, fp, index)
+        add_file(doc_dir, fp, digest=digest, index=index)
+    # chemins disparus
+    for fp in set(index) - set(iter_docs(doc_dir)):
+        del index[fp]
+    save_index(index, doc_dir)
+    return len(index), len({entry["sha256"] for entry in index.values()})
+
+
+def verify(doc_dir, index=None):
+    """Vérifie l'intégrité du stock et des chemins des documents.
+
+    Chaque fichier du stock est relu et son empreinte comparée à son nom ;
+    chaque chemin de l'index doit être un lien vers le fichier du stock de
+    son empreinte.
+
+    Parameters
+    ----------
+    doc_dir : str
+        Dossier des documents
+    index : Dict[str, dict], optional
+        Index du stock ; par défaut, celui du dossier
+
+    Returns
+    -------
+    errors : List[str]
+        Problèmes détectés, liste vide si tout est correct
+    """
+    if index is None:
+        index = load_index(doc_dir)
+    errors = []
+    root = store_dir(doc_dir)
+    for dirpath, _, filenames in os.walk(root):
+        if dirpath == root:
+            continue
+        for digest in filenames:
+            if digest.endswith(".tmp"):
+                # copie interrompue, remplacée à la prochaine copie
+                continue
+            if file_sha256(os.path.join(dirpath, digest)) != digest:
+                errors.append(f"stock altéré : {digest}")
+    for fp, entry in sorted(index.items()):
+        full_fp = os.path.join(doc_dir, fp)
+        fp_blob = blob_path(doc_dir, entry["sha256"])
+        if not os.path.exists(fp_blob):
+            errors.append(f"absent du stock : {fp} ({entry['sha256']})")
+        elif not os.path.exists(full_fp):
+            errors.append(f"chemin absent (restaurable) : {fp}")
+        elif (
+            not os.path.samefile(full_fp, fp_blob)
+            and file_sha256(full_fp) != entry["sha256"]
+        ):
+            errors.append(f"chemin modifié : {fp}")
+    return errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--doc_dir", help="Dossier de stockage des documents", default="data/arretes"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "ingest", help="Ranger dans le stock les documents déjà téléchargés"
+    )
+    subparsers.add_parser("verify", help="Vérifier l'intégrité du stock")
+    args = parser.parse_args()
+    #
+    doc_dir = os.path.abspath(args.doc_dir)
+    if args.command == "ingest":
+        n_docs, n_blobs = ingest(doc_dir)
+        print(f"{n_docs} documents, {n_blobs} distincts")
+    else:
+        errors = verify(doc_dir)
+        for error in errors:
+            print(f"ERR: {error}")
+        print(f"{len(errors)} problèmes")
+        sys.exit(1 if errors else 0)
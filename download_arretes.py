@@ -1,16 +1,463 @@
 """Télécharger les documents à partir d'une liste d'URL.
 
 Si un fichier du même nom a déjà été téléchargé, on s'abstient
-de le re-télécharger.
+de le re-télécharger : on demande seulement au serveur si le document
+a changé (requête conditionnelle, en-têtes ETag et Last-Modified).
+
+Chaque document est téléchargé par morceaux dans un fichier temporaire
+".part", renommé une fois le téléchargement terminé. Un téléchargement
+interrompu reprend là où il s'était arrêté (en-tête Range), si le document
+n'a pas changé entre-temps (en-tête If-Range, avec les validateurs du
+fichier partiel gardés à côté de lui).
+Un manifeste (JSON) garde pour chaque URL la taille, l'empreinte SHA-256,
+les validateurs HTTP et la date du dernier téléchargement du document.
+
+Les documents sont rangés dans un stock par contenu (voir doc_store.py) :
+un document identique à un document déjà téléchargé n'occupe pas de place
+supplémentaire, et un fichier effacé est restauré depuis le stock.
+
+Les documents sont téléchargés en parallèle par un pool de threads qui
+partagent une même session HTTP, donc un même pool de connexions.
+Le nombre de téléchargements simultanés est limité globalement et
+par hôte, pour ne pas surcharger le site de la ville.
 """
 
 import argparse
-from datetime import date
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from email.utils import formatdate
+import hashlib
+import json
 from pathlib import Path
 import os.path
+import threading
+from urllib.parse import urlsplit
 
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+import doc_store
+from doc_store import update_hash, file_sha256
+import instrument
+from storage import FORMATS, read_liste, write_liste
+
+# nombre maximal de téléchargements simultanés
+MAX_WORKERS = 8
+# nombre maximal de téléchargements simultanés vers un même hôte
+MAX_PER_HOST = 4
+# délai maximal d'attente d'une réponse du serveur (en secondes)
+TIMEOUT = 60
+# taille des morceaux lus et écrits lors du téléchargement (en octets)
+CHUNK_SIZE = 64 * 1024
+# nom du manifeste des téléchargements, dans le dossier des documents
+MANIFEST_NAME = "manifest.json"
+# suffixe des validateurs HTTP d'un fichier partiel, gardés à côté de lui
+PART_META_SUFFIX = ".part.json"
+
+
+def doc_path(url):
+    """Chemin relatif du fichier local d'un document.
+
+    Parameters
+    ----------
+    url : str
+        URL du document
+
+    Returns
+    -------
+    fp : str
+        Chemin relatif, formé des 2 derniers segments de l'URL.
+    """
+    return "/".join(url.split("/")[-2:])
+
+
+def make_session(max_workers=MAX_WORKERS):
+    """Crée une session HTTP dont le pool de connexions est partagé par les threads.
+
+    Parameters
+    ----------
+    max_workers : int
+        Nombre de threads qui utiliseront la session.
+
+    Returns
+    -------
+    session : requests.Session
+        Session HTTP.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def load_manifest(fp_manifest):
+    """Charge le manifeste des téléchargements.
+
+    Parameters
+    ----------
+    fp_manifest : str
+        Chemin du manifeste
+
+    Returns
+    -------
+    manifest : Dict[str, dict]
+        Pour chaque URL : chemin relatif, taille, empreinte SHA-256,
+        validateurs HTTP (ETag, Last-Modified) et date du téléchargement.
+        Dictionnaire vide si le manifeste n'existe pas encore.
+    """
+    if not os.path.exists(fp_manifest):
+        return {}
+    with open(fp_manifest, encoding="utf-8") as f_in:
+        return json.load(f_in)
+
+
+def save_manifest(manifest, fp_manifest):
+    """Enregistre le manifeste des téléchargements, de façon atomique.
+
+    Parameters
+    ----------
+    manifest : Dict[str, dict]
+        Manifeste
+    fp_manifest : str
+        Chemin du manifeste
+    """
+    fp_tmp = fp_manifest + ".tmp"
+    with open(fp_tmp, mode="w", encoding="utf-8") as f_out:
+        json.dump(manifest, f_out, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(fp_tmp, fp_manifest)
+
+
+def _remove_part(full_fp):
+    """Efface le fichier partiel d'un document et ses validateurs"""
+    for fp in (full_fp + ".part", full_fp + PART_META_SUFFIX):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
+def _if_range(fp_meta):
+    """Validateur de l'en-tête If-Range d'un fichier partiel, None s'il n'y en a pas
+
+    Seul un ETag fort convient ; à défaut, on se rabat sur Last-Modified.
+    """
+    if not os.path.exists(fp_meta):
+        return None
+    try:
+        with open(fp_meta, encoding="utf-8") as f_in:
+            validators = json.load(f_in)
+    except ValueError:
+        # fichier des validateurs tronqué
+        return None
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def fetch_doc(session, url, full_fp, entry=None):
+    """Télécharge un document, ou vérifie qu'il n'a pas changé.
+
+    Si le fichier existe déjà, la requête est conditionnelle et le serveur
+    ne renvoie le document que s'il a changé. Si un fichier partiel ".part"
+    existe, le téléchargement reprend à la fin de ce fichier, à condition
+    que le document n'ait pas changé depuis le début du téléchargement :
+    un fichier partiel sans validateur, ou plus grand que le document, est
+    effacé et le document téléchargé entièrement.
+
+    Parameters
+    ----------
+    session : requests.Session
+        Session HTTP
+    url : str
+        URL du document
+    full_fp : str
+        Chemin du fichier de destination
+    entry : dict, optional
+        Entrée du manifeste pour cette URL, si elle existe.
+
+    Returns
+    -------
+    entry : dict or None
+        Entrée du manifeste mise à jour, None si le document n'a pas pu
+        être téléchargé.
+    """
+    fp_part = full_fp + ".part"
+    fp_meta = full_fp + PART_META_SUFFIX
+    headers = {}
+    if os.path.exists(full_fp):
+        # requête conditionnelle
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        elif entry is None:
+            # fichier téléchargé avant la mise en place du manifeste
+            headers["If-Modified-Since"] = formatdate(
+                os.path.getmtime(full_fp), usegmt=True
+            )
+    # reprise d'un téléchargement interrompu
+    part_size = os.path.getsize(fp_part) if os.path.exists(fp_part) else 0
+    if part_size and not headers:
+        if_range = _if_range(fp_meta)
+        if if_range is None:
+            # impossible de savoir si le document a changé : on recommence
+            _remove_part(full_fp)
+            part_size = 0
+        else:
+            headers["Range"] = f"bytes={part_size}-"
+            headers["If-Range"] = if_range
+    #
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+            if res.status_code == 416 and "Range" in headers:
+                # fichier partiel aussi grand que le document : on recommence
+                res.close()
+                _remove_part(full_fp)
+                return fetch_doc(session, url, full_fp, entry)
+            res.raise_for_status()
+            if res.status_code == 304:
+                # le document n'a pas changé ; un éventuel fichier partiel
+                # (téléchargement interrompu d'une version précédente) est inutile
+                _remove_part(full_fp)
+                if entry is None:
+                    entry = {
+                        "path": doc_path(url),
+                        "size": os.path.getsize(full_fp),
+                        "sha256": file_sha256(full_fp),
+                        "etag": res.headers.get("ETag"),
+                        "last_modified": res.headers.get("Last-Modified"),
+                    }
+                return dict(entry, checked=datetime.now().isoformat(timespec="seconds"))
+            h = hashlib.sha256()
+            validators = {
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+            }
+            if res.status_code == 206:
+                if "Range" not in headers:
+                    # morceau d'un document qu'on n'a pas demandé par morceaux
+                    return None
+                if not res.headers.get("Content-Range", "").startswith(
+                    f"bytes {part_size}-"
+                ):
+                    # morceau qui ne suit pas le fichier partiel : on recommence
+                    res.close()
+                    _remove_part(full_fp)
+                    return fetch_doc(session, url, full_fp, entry)
+                # on complète le fichier partiel
+                update_hash(h, fp_part)
+                mode = "ab"
+            elif res.status_code == 200:
+                # le serveur renvoie le document complet : on garde ses
+                # validateurs, pour reprendre le téléchargement s'il est interrompu
+                mode = "wb"
+                with open(fp_meta, mode="w", encoding="utf-8") as f_meta:
+                    json.dump(validators, f_meta)
+            else:
+                # autre réponse sans le document (204...)
+                return None
+            with open(fp_part, mode=mode) as f_out:
+                for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                    h.update(chunk)
+                    f_out.write(chunk)
+    except requests.RequestException:
+        return None
+    # le fichier n'est visible à son emplacement final qu'une fois complet
+    os.replace(fp_part, full_fp)
+    _remove_part(full_fp)
+    now = datetime.now().isoformat(timespec="seconds")
+    entry = {
+        "path": doc_path(url),
+        "size": os.path.getsize(full_fp),
+        "sha256": h.hexdigest(),
+        "fetched": now,
+        "checked": now,
+    }
+    entry.update(validators)
+    return entry
+
+
+@instrument.profiled
+def download_docs(
+    urls,
+    dl_dir,
+    max_workers=MAX_WORKERS,
+    max_per_host=MAX_PER_HOST,
+    session=None,
+    manifest=None,
+    revalidate=True,
+    index=None,
+):
+    """Télécharge en parallèle une liste de documents.
+
+    Les URLs en double ne sont téléchargées qu'une fois. Les URLs qui
+    correspondent au même fichier local sont essayées successivement,
+    jusqu'au premier téléchargement réussi.
+
+    Parameters
+    ----------
+    urls : Iterable[str]
+        URLs des documents
+    dl_dir : str
+        Dossier de stockage des documents
+    max_workers : int
+        Nombre maximal de téléchargements simultanés
+    max_per_host : int
+        Nombre maximal de téléchargements simultanés vers un même hôte
+    session : requests.Session, optional
+        Session HTTP ; si None, une session est créée pour l'occasion.
+    manifest : Dict[str, dict], optional
+        Manifeste des téléchargements, mis à jour en place.
+    revalidate : bool
+        Si True, on demande au serveur si les documents déjà téléchargés
+        ont changé ; sinon on les garde tels quels.
+    index : Dict[str, dict], optional
+        Index du stock des documents (voir `doc_store.load_index`), mis à
+        jour en place.
+
+    Returns
+    -------
+    urls_404 : Set[str]
+        URLs qui ne répondent pas.
+    """
+    # dédoublonnage des URLs, regroupées par fichier local
+    fp_urls = defaultdict(list)
+    for url in dict.fromkeys(urls):
+        if not url:
+            continue
+        fp_urls[doc_path(url)].append(url)
+    #
+    if session is None:
+        session = make_session(max_workers)
+    if manifest is None:
+        manifest = {}
+    if index is None:
+        index = {}
+    # limite de téléchargements simultanés par hôte
+    host_sems = defaultdict(lambda: threading.BoundedSemaphore(max_per_host))
+    host_sems_lock = threading.Lock()
+
+    def _download(fp, urls_fp):
+        """Télécharge un fichier local, à partir d'une ou plusieurs URLs.
+
+        Une erreur d'écriture (disque plein, droits) n'interrompt que ce
+        fichier : ses URLs ne sont pas signalées comme injoignables.
+        """
+        urls_err = []
+        entries = {}
+        try:
+            _download_urls(fp, urls_fp, urls_err, entries)
+        except OSError as exc:
+            print(f"ERR: Impossible d'écrire {fp} : {exc}")
+        return urls_err, entries
+
+    def _download_urls(fp, urls_fp, urls_err, entries):
+        """Corps de `_download`, qui remplit `urls_err` et `entries` en place"""
+        full_fp = os.path.join(dl_dir, fp)
+        os.makedirs(os.path.dirname(full_fp), exist_ok=True)
+        if not os.path.exists(full_fp):
+            # fichier effacé mais document connu : restauré depuis le stock
+            for url in urls_fp:
+                entry = manifest.get(url)
+                if entry is not None and doc_store.restore(dl_dir, fp, entry["sha256"]):
+                    break
+        for url in urls_fp:
+            exists = os.path.exists(full_fp)
+            if exists and not revalidate:
+                # on ne télécharge pas le fichier si on l'a déjà
+                if fp not in index:
+                    doc_store.add_file(dl_dir, fp, index=index)
+                break
+            entry = manifest.get(url)
+            if (
+                exists
+                and entry is not None
+                and entry["size"] != os.path.getsize(full_fp)
+            ):
+                # fichier local altéré : on le re-télécharge entièrement
+                os.remove(full_fp)
+                exists = False
+                entry = None
+            print(url)  # TODO progress bar?
+            with host_sems_lock:
+                host_sem = host_sems[urlsplit(url).netloc]
+            with host_sem:
+                entry = fetch_doc(session, url, full_fp, entry)
+            if entry is not None:
+                doc_store.add_file(dl_dir, fp, digest=entry["sha256"], index=index)
+                entries[url] = entry
+                break
+            if exists:
+                # on garde la copie locale
+                print(f"WARN: Impossible de revalider {url}")
+                break
+            # FIXME stocker l'info de fichier manquant?
+            print(f"ERR: Impossible d'atteindre {url}")
+            urls_err.append(url)
+
+    urls_404 = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_download, fp, urls_fp) for fp, urls_fp in fp_urls.items()
+        ]
+        for future in futures:
+            urls_err, entries = future.result()
+            urls_404.update(urls_err)
+            manifest.update(entries)
+    return urls_404
+
+
+@instrument.profiled
+def download_liste(
+    df,
+    dl_dir,
+    max_workers=MAX_WORKERS,
+    max_per_host=MAX_PER_HOST,
+    revalidate=True,
+):
+    """Télécharge les documents d'une liste et efface les URLs qui ne répondent pas.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste enrichie des documents
+    dl_dir : str
+        Dossier de stockage des documents
+    max_workers : int
+        Nombre maximal de téléchargements simultanés
+    max_per_host : int
+        Nombre maximal de téléchargements simultanés vers un même hôte
+    revalidate : bool
+        Si True, on demande au serveur si les documents déjà téléchargés
+        ont changé.
+
+    Returns
+    -------
+    df : DataFrame
+        Liste des documents, sans les URLs qui ne répondent pas.
+    """
+    # manifeste des téléchargements
+    os.makedirs(dl_dir, exist_ok=True)
+    fp_manifest = os.path.join(dl_dir, MANIFEST_NAME)
+    manifest = load_manifest(fp_manifest)
+    index = doc_store.load_index(dl_dir)
+    # URLs qui ne répondent pas
+    try:
+        urls_404 = download_docs(
+            df["url"].dropna(),
+            dl_dir,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            manifest=manifest,
+            revalidate=revalidate,
+            index=index,
+        )
+    finally:
+        save_manifest(manifest, fp_manifest)
+        doc_store.save_index(index, dl_dir)
+    df.loc[df["url"].isin(urls_404), "url"] = ""
+    return df
 
 
 if __name__ == "__main__":
@@ -30,37 +477,46 @@ if __name__ == "__main__":
     parser.add_argument(
         "--doc_dir", help="Dossier de stockage des documents", default="data/arretes"
     )
+    parser.add_argument(
+        "--max_workers",
+        help="Nombre maximal de téléchargements simultanés",
+        type=int,
+        default=MAX_WORKERS,
+    )
+    parser.add_argument(
+        "--max_per_host",
+        help="Nombre maximal de téléchargements simultanés vers un même hôte",
+        type=int,
+        default=MAX_PER_HOST,
+    )
+    parser.add_argument(
+        "--no_revalidate",
+        help="Ne pas vérifier auprès du serveur les documents déjà téléchargés",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args, "download_arretes")
     #
     dl_dir = os.path.abspath(args.doc_dir)
     # fichier interim => fichier traité
     fp_in = Path(args.liste_csv).resolve()
     fp_out = Path(args.out_dir) / Path(fp_in.name.rsplit("_", 1)[0] + fp_in.suffix)
     #
-    df = pd.read_csv(fp_in, dtype="string")
-    #
-    idc_urls_404 = []  # index des URLs qui ne répondent pas
-    for index, url in df["url"].dropna().items():
-        fp = "/".join(url.split("/")[-2:])
-        full_fp = os.path.join(dl_dir, fp)
-        os.makedirs(os.path.dirname(full_fp), exist_ok=True)
-        if os.path.exists(full_fp):
-            # on ne télécharge pas le fichier si on l'a déjà
-            continue
-        print(url)  # TODO progress bar?
-        res = requests.get(url)
-        try:
-            res.raise_for_status()
-        except:
-            # FIXME stocker l'info de fichier manquant?
-            print(f"ERR: Impossible d'atteindre {url}")
-            idc_urls_404.append(index)
-            continue
-        else:
-            with open(full_fp, mode="wb") as f_out:
-                f_out.write(res.content)
-    df.loc[idc_urls_404, "url"] = ""
+    df = read_liste(fp_in)
+    df = download_liste(
+        df,
+        dl_dir,
+        max_workers=args.max_workers,
+        max_per_host=args.max_per_host,
+        revalidate=not args.no_revalidate,
+    )
     # on exporte le dataframe corrigé, en gardant le même format que précemment
-    # y compris les retours à la ligne du dialecte Excel du CSV Writer :
-    # https://docs.python.org/3/library/csv.html#csv.Dialect.lineterminator
-    df.to_csv(fp_out, sep=",", index=False, line_terminator="\r\n")
+    write_liste(df, fp_out, fmt=args.format)
+    instrument.stop()
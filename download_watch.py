@@ -0,0 +1,317 @@
+"""Attente de la fin des téléchargements du navigateur, sans scruter le dossier.
+
+Pendant un téléchargement, Firefox écrit dans un fichier ".part" et Chrome
+dans un fichier ".crdownload", renommé une fois le téléchargement terminé.
+Un observateur (`DownloadWatcher`) tient à jour la liste des fichiers du
+dossier de téléchargement à partir des événements inotify (Linux, via
+ctypes) : le dossier n'est lu qu'une fois, à la création de l'observateur,
+et chaque vérification se fait en temps constant. Sans inotify (autre
+système, libc introuvable), l'observateur relit le dossier à intervalles
+réguliers.
+
+Utilisation :
+    with DownloadWatcher(dl_dir) as watcher:
+        ...  # lancer les téléchargements
+        watcher.wait("doc.pdf", timeout=60)
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import os
+import select
+import struct
+import sys
+import time
+
+# suffixes des fichiers en cours de téléchargement (Firefox, Chrome)
+TEMP_SUFFIXES = (".part", ".crdownload")
+# délai maximal d'attente d'un téléchargement (en secondes)
+TIMEOUT = 60
+# intervalle entre deux lectures du dossier, sans inotify (en secondes)
+POLL_INTERVAL = 0.5
+
+# constantes inotify (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# en-tête d'un événement : wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_inotify():
+    """Fonctions inotify de la libc, None si elles sont indisponibles"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [
+            ctypes.c_int,
+            ctypes.c_char_p,
+            ctypes.c_uint32,
+        ]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_inotify()
+
+
+def is_temp(fname):
+    """True si le fichier est un téléchargement en cours"""
+    return fname.endswith(TEMP_SUFFIXES)
+
+
+def is_download(fname):
+    """True si le fichier est un document téléchargé (motif '*.*', hors temporaires)"""
+    return "." in fname and not is_temp(fname)
+
+
+def has_magic(fname):
+    """True si le nom est un motif ('*', '?' ou '[...]') et non un nom littéral"""
+    return any(c in fname for c in "*?[")
+
+
+def match_finished(fnames, pattern):
+    """Vérifie, sur une liste de noms, si un téléchargement correspondant au
+    motif est terminé.
+
+    Parameters
+    ----------
+    fnames : iterable of str
+        Noms des fichiers du dossier
+    pattern : str
+        Motif du nom du fichier téléchargé (syntaxe de `Path.glob`)
+
+    Returns
+    -------
+    finished : bool
+        True si au moins un fichier correspond au motif et qu'aucun fichier
+        temporaire ne correspond au motif suivi de ".part" ou ".crdownload".
+    """
+    temp_patterns = [pattern + suffix for suffix in TEMP_SUFFIXES]
+    n_done = 0
+    for name in fnames:
+        if any(fnmatch.fnmatchcase(name, p) for p in temp_patterns):
+            return False
+        n_done += fnmatch.fnmatchcase(name, pattern)
+    return n_done >= 1
+
+
+def is_download_finished(temp_folder, fname=None):
+    """Vérifie, une fois, si un téléchargement est terminé.
+
+    Parameters
+    ----------
+    temp_folder : str
+        Dossier de téléchargement
+    fname : str, optional
+        Nom ou motif (ex. "*.pdf") du fichier téléchargé ; si None,
+        n'importe quel fichier ('*.*').
+
+    Returns
+    -------
+    finished : bool
+        True si le fichier (ou au moins un fichier) est téléchargé et
+        qu'aucun téléchargement n'est en cours.
+    """
+    if fname is not None and has_magic(fname):
+        with os.scandir(temp_folder) as entries:
+            return match_finished((entry.name for entry in entries), fname)
+    if fname is not None:
+        # nom littéral : quelques appels stat, quel que soit le nombre de
+        # fichiers du dossier
+        return os.path.isfile(os.path.join(temp_folder, fname)) and not any(
+            os.path.exists(os.path.join(temp_folder, fname + suffix))
+            for suffix in TEMP_SUFFIXES
+        )
+    # une seule lecture du dossier, interrompue au 1er téléchargement en cours
+    n_done = 0
+    with os.scandir(temp_folder) as entries:
+        for entry in entries:
+            if is_temp(entry.name):
+                return False
+            n_done += is_download(entry.name)
+    return n_done >= 1
+
+
+class DownloadWatcher:
+    """Observateur d'un dossier de téléchargement.
+
+    Parameters
+    ----------
+    folder : str
+        Dossier de téléchargement
+    use_inotify : bool
+        Si False, ne pas utiliser inotify même s'il est disponible.
+    """
+
+    def __init__(self, folder, use_inotify=True):
+        self.folder = folder
+        self._fd = None
+        if use_inotify and _libc is not None:
+            fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                wd = _libc.inotify_add_watch(fd, os.fsencode(folder), WATCH_MASK)
+                if wd >= 0:
+                    self._fd = fd
+                else:
+                    os.close(fd)
+        # la lecture du dossier suit la mise en place de la surveillance :
+        # aucun fichier créé entre les deux n'est manqué
+        self._scan()
+
+    @property
+    def uses_inotify(self):
+        """True si l'observateur utilise inotify"""
+        return self._fd is not None
+
+    def _scan(self):
+        """Lit le contenu du dossier"""
+        self.files = set(os.listdir(self.folder))
+        self._n_temp = sum(map(is_temp, self.files))
+        self._n_done = sum(map(is_download, self.files))
+
+    def _update(self, fname, present):
+        """Met à jour la liste des fichiers"""
+        if present == (fname in self.files):
+            return
+        if present:
+            self.files.add(fname)
+        else:
+            self.files.discard(fname)
+        delta = 1 if present else -1
+        self._n_temp += delta * is_temp(fname)
+        self._n_done += delta * is_download(fname)
+
+    def refresh(self):
+        """Met à jour la liste des fichiers, sans attendre.
+
+        Avec inotify, seuls les événements en attente sont lus ; sinon, le
+        dossier est relu.
+        """
+        if self._fd is None:
+            self._scan()
+        else:
+            self._read_events()
+
+    def _read_events(self):
+        """Lit les événements inotify disponibles et met à jour la liste"""
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            offset = 0
+            while offset < len(buf):
+                _, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(buf[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # événements perdus : on relit le dossier
+                    self._scan()
+                elif mask & (IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE):
+                    self._update(name, True)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._update(name, False)
+
+    def poll(self, timeout):
+        """Attend des changements dans le dossier, au plus `timeout` secondes"""
+        if self._fd is None:
+            time.sleep(min(timeout, POLL_INTERVAL))
+            return
+        # les événements seront lus par `refresh`
+        select.select([self._fd], [], [], max(timeout, 0))
+
+    def finished(self, fname=None):
+        """Vérifie si un téléchargement est terminé.
+
+        Mêmes conditions que `is_download_finished`, sur la liste des
+        fichiers tenue à jour par l'observateur : en temps constant pour un
+        nom littéral ou pour n'importe quel fichier, en un parcours de la
+        liste pour un motif.
+        """
+        self.refresh()
+        if fname is not None and has_magic(fname):
+            return match_finished(self.files, fname)
+        if fname is not None:
+            return fname in self.files and not any(
+                fname + suffix in self.files for suffix in TEMP_SUFFIXES
+            )
+        return self._n_temp == 0 and self._n_done >= 1
+
+    def wait(self, fname=None, timeout=TIMEOUT):
+        """Attend la fin d'un téléchargement.
+
+        Parameters
+        ----------
+        fname : str, optional
+            Nom ou motif (ex. "*.pdf") du fichier téléchargé ; si None,
+            n'importe quel fichier.
+        timeout : float
+            Délai maximal d'attente (en secondes)
+
+        Returns
+        -------
+        finished : bool
+            True si le téléchargement est terminé, False si le délai est
+            dépassé.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.finished(fname):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.poll(remaining)
+        return True
+
+    def close(self):
+        """Arrête la surveillance du dossier"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def wait_for_download(folder, fname=None, timeout=TIMEOUT):
+    """Attend la fin d'un téléchargement dans un dossier.
+
+    Pour attendre plusieurs téléchargements du même dossier, utiliser un
+    même `DownloadWatcher`.
+
+    Parameters
+    ----------
+    folder : str
+        Dossier de téléchargement
+    fname : str, optional
+        Nom ou motif (ex. "*.pdf") du fichier téléchargé ; si None,
+        n'importe quel fichier.
+    timeout : float
+        Délai maximal d'attente (en secondes)
+
+    Returns
+    -------
+    finished : bool
+        True si le téléchargement est terminé, False si le délai est dépassé.
+    """
+    with DownloadWatcher(folder) as watcher:
+        return watcher.wait(fname, timeout=timeout)
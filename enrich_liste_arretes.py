@@ -6,12 +6,28 @@ TODO
 
 
 import argparse
+import contextlib
 from datetime import date
 from pathlib import Path
 import re
+import sys
 
+import numpy as np
 import pandas as pd
 
+from cache_utils import MemoCache, rules_version
+import instrument
+from rule_tables import apply_rule_table, url_basename
+from storage import FORMATS, iter_liste, read_liste, write_liste, write_liste_chunks
+
+try:
+    import pyarrow  # noqa: F401
+
+    # recherche des motifs par le moteur d'expressions régulières d'Arrow
+    STR_DTYPE = "string[pyarrow]"
+except ImportError:
+    STR_DTYPE = "string"
+
 # arrêté de main-levée partielle
 RE_MLP = r"mai[ln][- ]?l[ée]v[ée]e partiel(le)?"
 M_MLP = re.compile(RE_MLP, re.IGNORECASE)
@@ -61,6 +77,41 @@ M_MISE_SECU = re.compile(RE_MISE_SECU, re.IGNORECASE)
 # - [ ] arrêtés à qualifier "arrêté du" ;
 # - [ ] "astreinte administrative"
 
+# règles de classification à partir du texte du lien, par ordre de priorité :
+# la classe d'un document est celle de la 1re règle dont le motif est trouvé
+DOC_CLASS_RULES = [
+    (M_MLP, "Arrêtés de mainlevée partielle"),
+    (M_ML, "Arrêtés de mainlevée"),
+    (M_ABRO, "Abrogations"),
+    (M_REINTEG_P, "Arrêtés de réintégration partielle"),
+    (M_REINTEG, "Arrêtés de réintégration"),
+    (M_EVAC, "Arrêtés d'évacuation"),
+    # TODO préciser modificatif de quoi
+    (M_MODIF, "Arrêtés modificatifs"),
+    (M_PERIL_ORD, "Arrêtés de péril ordinaire"),
+    (M_PERIL_IMM, "Arrêtés de péril imminent"),
+    (M_PERIL_GI, "Arrêtés de péril grave et imminent"),
+    # (M_PERIL, "Arrêtés de péril imminent"),
+    # heuristique : "péril" (sans plus de précision) est ici "péril imminent"
+    # TODO vérifier si cette heuristique tient
+    (
+        re.compile("insécurité"),
+        "Arrêtés d'insécurité imminente des équipements communs",
+    ),
+    (M_INTER_OCCUP, "Arrêtés d'interdiction d'occuper"),
+    (re.compile("police générale"), "Arrêtés de police générale"),
+    (
+        re.compile("évacuation|réintégration"),
+        "Arrêtés d'évacuation et de réintégration",
+    ),
+    (re.compile("diagnostic d'ouvrages"), "Diagnostics d'ouvrages"),
+    (M_PERIM, "Arrêtés de périmètres de sécurité sur voie publique"),
+    (re.compile("déconstruction"), "Arrêtés de déconstruction"),
+    # évolution réglementaire 2021
+    (M_MSU, "Arrêtés de mise en sécurité urgente"),
+    (M_MISE_SECU, "Arrêtés de mise en sécurité"),
+]
+
 
 def predict_doc_class(doc_text):
     """Prédit la classe d'un document, parmi les 8 possibles.
@@ -95,54 +146,87 @@ def predict_doc_class(doc_text):
     doc_class : str
         Classe du document (legacy)
     """
-    if M_MLP.search(doc_text):
-        doc_class = "Arrêtés de mainlevée partielle"
-    elif M_ML.search(doc_text):
-        doc_class = "Arrêtés de mainlevée"
-    elif M_ABRO.search(doc_text):
-        doc_class = "Abrogations"
-    elif M_REINTEG_P.search(doc_text):
-        doc_class = "Arrêtés de réintégration partielle"
-    elif M_REINTEG.search(doc_text):
-        doc_class = "Arrêtés de réintégration"
-    elif M_EVAC.search(doc_text):
-        doc_class = "Arrêtés d'évacuation"
-    elif M_MODIF.search(doc_text):
-        # TODO préciser modificatif de quoi
-        doc_class = "Arrêtés modificatifs"
-    elif M_PERIL_ORD.search(doc_text):
-        doc_class = "Arrêtés de péril ordinaire"
-    elif M_PERIL_IMM.search(doc_text):
-        doc_class = "Arrêtés de péril imminent"
-    elif M_PERIL_GI.search(doc_text):
-        doc_class = "Arrêtés de péril grave et imminent"
-    # elif M_PERIL.search(doc_text):
-    # heuristique : "péril" (sans plus de précision) est ici "péril imminent"
-    # TODO vérifier si cette heuristique tient
-    # doc_class = "Arrêtés de péril imminent"
-    elif "insécurité" in doc_text:
-        doc_class = "Arrêtés d'insécurité imminente des équipements communs"
-    elif M_INTER_OCCUP.search(doc_text):
-        doc_class = "Arrêtés d'interdiction d'occuper"
-    elif "police générale" in doc_text:
-        doc_class = "Arrêtés de police générale"
-    elif "évacuation" in doc_text or "réintégration" in doc_text:
-        doc_class = "Arrêtés d'évacuation et de réintégration"
-    elif "diagnostic d'ouvrages" in doc_text:
-        doc_class = "Diagnostics d'ouvrages"
-    elif M_PERIM.search(doc_text) is not None:
-        doc_class = "Arrêtés de périmètres de sécurité sur voie publique"
-    elif "déconstruction" in doc_text:
-        doc_class = "Arrêtés de déconstruction"
-    # évolution réglementaire 2021
-    elif M_MSU.search(doc_text):
-        doc_class = "Arrêtés de mise en sécurité urgente"
-    elif M_MISE_SECU.search(doc_text):
-        doc_class = "Arrêtés de mise en sécurité"
+    for m_rule, rule_class in DOC_CLASS_RULES:
+        if m_rule.search(doc_text):
+            return rule_class
     # classe inconnue => objectif : résorber le nombre d'occurrences
-    else:
-        doc_class = "?"
-    return doc_class
+    return "?"
+
+
+# échappement, classe de caractères ou ouverture d'un groupe capturant
+RE_GROUP_OPEN = re.compile(r"\\.|\[\^?\]?(?:\\.|[^\]\\])*\]|\((?!\?)", re.DOTALL)
+
+
+def _inline_flags(m_rule):
+    """Motif d'une expression régulière, avec ses options en ligne : (?i)...
+
+    Les groupes du motif ne servent qu'à la recherche : ils deviennent non
+    capturants, sans quoi pandas avertit qu'ils sont ignorés.
+    """
+    pattern = RE_GROUP_OPEN.sub(
+        lambda m_tok: "(?:" if m_tok.group() == "(" else m_tok.group(), m_rule.pattern
+    )
+    if m_rule.flags & re.IGNORECASE:
+        return "(?i)" + pattern
+    return pattern
+
+
+def first_matching_class(s_text, rules, default, na_value=None):
+    """Classe de la 1re règle qui s'applique, pour chaque texte d'une colonne.
+
+    Chaque motif est recherché une seule fois dans les textes distincts de
+    la colonne, puis les priorités sont résolues par un `np.select`.
+    Si pyarrow est installé, les motifs sont recherchés par le moteur
+    d'expressions régulières d'Arrow, sans boucle Python.
+
+    Parameters
+    ----------
+    s_text : Series
+        Textes à classer
+    rules : List[Tuple[re.Pattern, str]]
+        Règles (motif, classe), par ordre de priorité
+    default : str
+        Classe d'un texte auquel aucune règle ne s'applique
+    na_value : str, optional
+        Classe d'une valeur manquante
+
+    Returns
+    -------
+    classes : np.ndarray
+        Classe de chaque texte
+    """
+    # on ne traite qu'une fois chaque texte distinct
+    codes, uniques = pd.factorize(s_text)
+    s_uniques = pd.Series(uniques, dtype=STR_DTYPE)
+    conds = [
+        s_uniques.str.contains(_inline_flags(m_rule), regex=True).to_numpy(dtype=bool)
+        for m_rule, _ in rules
+    ]
+    choices = [rule_class for _, rule_class in rules]
+    classes = np.select(conds, choices, default=default).astype(object)
+    # les valeurs manquantes ont le code -1, soit le dernier élément
+    classes = np.append(classes, na_value)
+    return classes[codes]
+
+
+@instrument.profiled
+def predict_doc_classes(s_doc_text):
+    """Prédit la classe de chaque document d'une colonne.
+
+    Version vectorisée de `predict_doc_class`.
+
+    Parameters
+    ----------
+    s_doc_text : Series
+        Textes des liens vers les docs
+
+    Returns
+    -------
+    s_doc_class : Series
+        Classes des documents (legacy), "?" si aucune règle ne s'applique.
+    """
+    classes = first_matching_class(s_doc_text, DOC_CLASS_RULES, "?", na_value="?")
+    return pd.Series(classes, index=s_doc_text.index, dtype="string")
 
 
 # péril simple
@@ -159,63 +243,64 @@ RE_PGI = r"[/_-]pgi[/_-]"
 M_PGI = re.compile(RE_PGI, re.IGNORECASE)
 
 
-def guess_doc_class(s_row):
-    """Devine la classe d'un document.
+# règles de classification à partir de l'URL, par ordre de priorité
+URL_CLASS_RULES = [
+    # péril grave et imminent
+    (M_PGI, "Arrêtés de péril grave et imminent"),
+    # péril imminent
+    (M_PI, "Arrêtés de péril imminent"),
+    # péril ordinaire
+    (M_PO, "Arrêtés de péril ordinaire"),
+    # péril simple
+    (M_PS, "Arrêtés de péril simple"),
+    # mainlevée de péril imminent
+    # TODO préciser le péril imminent dans la classe ?
+    (re.compile("mlpi"), "Arrêtés de mainlevée"),
+    # péril non imminent
+    # FIXME ? garder une classe spécifique ?
+    (re.compile("pni"), "Arrêtés de péril non imminent"),
+    # mise en sécurité urgente (terminologie 2021)
+    # FIXME ? définir une classe plus spécifique ?
+    (re.compile("msu"), "Arrêtés de mise en sécurité urgente"),
+    # main-levée
+    (re.compile("ml"), "Arrêtés de mainlevée"),
+    # interdiction d'occuper
+    (re.compile("occup"), "Arrêtés d'interdiction d'occuper"),
+    # police générale
+    (re.compile("police"), "Arrêtés de police générale"),
+    # périmètre de sécurité
+    (re.compile("perimetre"), "Arrêtés de périmètres de sécurité sur voie publique"),
+]
+# 2021-07-26 : 199 occurrences "?"
+# heuristique => "péril grave et imminent"
+URL_CLASS_DEFAULT = "Arrêtés de péril grave et imminent"
+# classes possibles
+URL_CLASSES = list(
+    dict.fromkeys(
+        [rule_class for _, rule_class in URL_CLASS_RULES] + [URL_CLASS_DEFAULT]
+    )
+)
+
+
+@instrument.profiled
+def guess_doc_class(s_url):
+    """Devine la classe de chaque document d'une colonne.
 
     Actuellement à partir de son URL.
 
     Parameters
     ----------
-    s_row : Series
-        Ligne de la liste des documents.
+    s_url : Series
+        URLs des documents.
 
     Returns
     -------
-    doc_class : string
-        Classe du document
+    s_doc_class : Series
+        Classes des documents (catégorielle), valeur manquante si l'URL
+        est manquante.
     """
-    if M_PGI.search(s_row["url"]):
-        # péril grave et imminent
-        doc_class = "Arrêtés de péril grave et imminent"
-    elif M_PI.search(s_row["url"]):
-        # péril imminent
-        doc_class = "Arrêtés de péril imminent"
-    elif M_PO.search(s_row["url"]):
-        # péril ordinaire
-        doc_class = "Arrêtés de péril ordinaire"
-    elif M_PS.search(s_row["url"]):
-        # péril simple
-        doc_class = "Arrêtés de péril simple"
-    elif "mlpi" in s_row["url"]:
-        # mainlevée de péril imminent
-        # TODO préciser le péril imminent dans la classe ?
-        doc_class = "Arrêtés de mainlevée"
-    elif "pni" in s_row["url"]:
-        # péril non imminent
-        # FIXME ? garder une classe spécifique ?
-        doc_class = "Arrêtés de péril non imminent"
-    elif "msu" in s_row["url"]:
-        # mise en sécurité urgente (terminologie 2021)
-        # FIXME ? définir une classe plus spécifique ?
-        doc_class = "Arrêtés de mise en sécurité urgente"
-    elif "ml" in s_row["url"]:
-        # main-levée
-        doc_class = "Arrêtés de mainlevée"
-    elif "occup" in s_row["url"]:
-        # interdiction d'occuper
-        doc_class = "Arrêtés d'interdiction d'occuper"
-    elif "police" in s_row["url"]:
-        # police générale
-        doc_class = "Arrêtés de police générale"
-    elif "perimetre" in s_row["url"]:
-        # périmètre de sécurité
-        doc_class = "Arrêtés de périmètres de sécurité sur voie publique"
-    else:
-        # 2021-07-26 : 199 occurrences "?"
-        # heuristique => "péril grave et imminent"
-        # doc_class = "?"
-        doc_class = "Arrêtés de péril grave et imminent"
-    return doc_class
+    classes = first_matching_class(s_url, URL_CLASS_RULES, URL_CLASS_DEFAULT)
+    return pd.Series(pd.Categorical(classes, categories=URL_CLASSES), index=s_url.index)
 
 
 FIX_URL_DOC_CLASS = {
@@ -270,6 +355,7 @@ FIX_URL_DOC_CLASS = {
 }
 
 
+@instrument.profiled
 def fix_doc_class(df, verbose=False):
     """Corrige manuellement la classe d'un ensemble de documents.
 
@@ -283,8 +369,14 @@ def fix_doc_class(df, verbose=False):
     df : DataFrame
         Liste avec date corrigée le cas échéant, sinon date fournie en entrée.
     """
-    for url, doc_class in FIX_URL_DOC_CLASS.items():
-        df.loc[df["url"].str.endswith(url), "classe"] = doc_class
+    apply_rule_table(
+        df,
+        url_basename(df["url"]),
+        FIX_URL_DOC_CLASS,
+        "classe",
+        name="FIX_URL_DOC_CLASS",
+        verbose=verbose,
+    )
     if verbose:
         print("Entrées sans classe")
         with pd.option_context("max_colwidth", -1):
@@ -294,22 +386,158 @@ def fix_doc_class(df, verbose=False):
 
 # date
 
-RE_DATE_NOMDOC_Y4 = re.compile(r"(?P<date_link>\d{2}/\d{2}/\d{4})")
-RE_DATE_NOMDOC_Y2 = re.compile(r"(?P<date_link>\d{2}/\d{2}/\d{2})")
+RE_DATE_NOMDOC_Y4 = re.compile(r"(?P<jour>\d{2})/(?P<mois>\d{2})/(?P<annee>\d{4})")
+RE_DATE_NOMDOC_Y2 = re.compile(r"(?P<jour>\d{2})/(?P<mois>\d{2})/(?P<annee>\d{2})")
+# variantes : espaces ou zéros en trop ou en moins ("6/12/2018", "22 /05/2021",
+# "30/008/2019")
+RE_DATE_NUM = re.compile(
+    r"(?<!\d)(?P<jour>\d{1,2})\s*/\s*(?P<mois>\d{1,3})\s*/\s*(?P<annee>\d{4})(?!\d)"
+)
+# date en toutes lettres : "27 janvier 2021", "1er juin 2021", "18-juin-2021"
+RE_DATE_TXT = re.compile(
+    r"(?<!\d)(?P<jour>\d{1,2})(?:\s*er)?[\s_-]*"
+    r"(?P<mois>janvier|f[ée]vrier|mars|avril|mai|juin|juillet|ao[uû]t|septembre"
+    r"|octobre|novembre|d[ée]cembre)[\s_-]*(?P<annee>\d{4})(?!\d)",
+    re.IGNORECASE,
+)
+# motifs des dates dans le texte des liens, par priorité décroissante
+DATE_PATTERNS_NOMDOC = [RE_DATE_NOMDOC_Y4, RE_DATE_NOMDOC_Y2, RE_DATE_NUM, RE_DATE_TXT]
+# motifs des dates dans le nom des fichiers (les nombres sont des numéros
+# d'arrêtés, pas des dates)
+DATE_PATTERNS_URL = [RE_DATE_TXT]
+# mois en toutes lettres
+MOIS = {
+    "janvier": 1,
+    "fevrier": 2,
+    "février": 2,
+    "mars": 3,
+    "avril": 4,
+    "mai": 5,
+    "juin": 6,
+    "juillet": 7,
+    "aout": 8,
+    "août": 8,
+    "septembre": 9,
+    "octobre": 10,
+    "novembre": 11,
+    "decembre": 12,
+    "décembre": 12,
+}
+# format des dates dans les listes
+DATE_FMT = "%d/%m/%Y"
+
+
+def parse_dates_fr(s_text, patterns=DATE_PATTERNS_NOMDOC):
+    """Extrait la date de chaque texte d'une colonne, en type date.
 
+    Chaque motif est appliqué à toute la colonne (`str.extract`) ; on garde,
+    pour chaque texte, la date du 1er motif qui donne une date valide : une
+    date impossible ("89/10/2019", "30/23/2019") n'est pas retenue.
 
-def extract_date_nomdoc(df, verbose=False):
-    """Extrait la date du texte du document"""
-    # date au format attendu : dd/mm/yyyy
-    df.loc[:, "date_link"] = df["nom_doc"].str.extract(RE_DATE_NOMDOC_Y4, expand=False)
-    # date dans une variante courante : dd/mm/yy
-    s_date_y2 = (
-        df.loc[df["date_link"].isna(), "nom_doc"]
-        .str.extract(RE_DATE_NOMDOC_Y2, expand=False)
-        .str.rsplit("/", 1, expand=False)
-        .str.join("/20")
+    Parameters
+    ----------
+    s_text : Series
+        Textes
+    patterns : List[re.Pattern]
+        Motifs de dates, par priorité décroissante, avec les groupes
+        "jour", "mois" (numéro ou nom) et "annee" (2 ou 4 chiffres)
+
+    Returns
+    -------
+    s_date : Series
+        Dates (datetime64), NaT si aucune date valide n'est trouvée.
+    """
+    # chaque texte distinct n'est analysé qu'une fois
+    codes, uniques = pd.factorize(s_text)
+    s_in = pd.Series(uniques, dtype="string")
+    s_date = pd.Series(pd.NaT, index=s_in.index, dtype="datetime64[ns]")
+    for pattern in patterns:
+        todo = s_date.isna() & s_in.notna()
+        if not todo.any():
+            break
+        df_ymd = s_in[todo].str.extract(pattern).dropna()
+        if df_ymd.empty:
+            continue
+        # mois en toutes lettres, sinon numéro
+        s_mois = df_ymd["mois"].str.lower().map(MOIS).fillna(0).astype("int64")
+        num = s_mois == 0
+        s_mois[num] = df_ymd.loc[num, "mois"].astype("int64")
+        # année sur 2 chiffres : 20yy
+        s_annee = df_ymd["annee"].astype("int64")
+        s_annee = s_annee.where(s_annee >= 100, s_annee + 2000)
+        s_date.loc[df_ymd.index] = pd.to_datetime(
+            pd.DataFrame(
+                {
+                    "year": s_annee,
+                    "month": s_mois,
+                    "day": df_ymd["jour"].astype("int64"),
+                }
+            ),
+            errors="coerce",
+        )
+    # valeur manquante (code -1) : dernière valeur, vide
+    s_date = pd.concat([s_date, pd.Series([pd.NaT], dtype="datetime64[ns]")])
+    return pd.Series(s_date.to_numpy()[codes], index=s_text.index)
+
+
+def format_dates(s_date):
+    """Dates au format des listes (dd/mm/yyyy), chaque date distincte formatée une fois"""
+    codes, uniques = pd.factorize(s_date)
+    s_fmt = pd.Series(uniques.strftime(DATE_FMT).tolist() + [pd.NA], dtype="string")
+    return pd.Series(s_fmt.to_numpy()[codes], index=s_date.index, dtype="string")
+
+
+def extract_dates(s_nom_doc):
+    """Extrait la date de chaque texte de lien d'une colonne.
+
+    Parameters
+    ----------
+    s_nom_doc : Series
+        Textes des liens vers les docs
+
+    Returns
+    -------
+    s_date : Series
+        Dates au format dd/mm/yyyy, valeur manquante si aucune date n'est trouvée.
+    """
+    return format_dates(parse_dates_fr(s_nom_doc))
+
+
+def extract_dates_url(s_url):
+    """Extrait la date écrite dans le nom du fichier de chaque URL d'une colonne.
+
+    Parameters
+    ----------
+    s_url : Series
+        URL des docs
+
+    Returns
+    -------
+    s_date : Series
+        Dates au format dd/mm/yyyy, valeur manquante si aucune date n'est trouvée.
+    """
+    return format_dates(parse_dates_fr(url_basename(s_url), patterns=DATE_PATTERNS_URL))
+
+
+@instrument.profiled
+def extract_date_nomdoc(df, verbose=False, memo=None):
+    """Extrait la date du texte du document, à défaut du nom du fichier.
+
+    La provenance de la date est indiquée dans la colonne "date_source" :
+    texte du lien ("nom_doc") ou nom du fichier ("url").
+    """
+    df.loc[:, "date_link"] = _memo_apply(
+        memo, "extract_dates", df["nom_doc"], extract_dates
     )
-    df.loc[df["date_link"].isna(), "date_link"] = s_date_y2
+    df.loc[:, "date_source"] = pd.Series(
+        np.where(df["date_link"].notna(), "nom_doc", None), index=df.index
+    ).astype("string")
+    # pas de date dans le texte du lien : date dans le nom du fichier
+    missing = df["date_link"].isna() & df["url"].notna()
+    df.loc[missing, "date_link"] = _memo_apply(
+        memo, "extract_dates_url", df.loc[missing, "url"], extract_dates_url
+    )
+    df.loc[missing & df["date_link"].notna(), "date_source"] = "url"
     if verbose:
         print("Entrées sans date")
         with pd.option_context("max_colwidth", -1):
@@ -323,23 +551,11 @@ FIX_DATE_LINK = {
     "interdiction_occuper_2-bld-des-dames-13002_2019_02168.pdf": "19/06/2019",  # 289/10/2019
     "pgi_123-123b-rue-de-l-eveche-13002_2019_03385_vdm.pdf": "26/09/2019",  # 30/23/2019
     "10-place-jean-jaures-13001_arrete_modificatif_de_pi-2020_03143_vdm_1.pdf": "27/01/2021",  # "27 janvier 2021"
-    "59-place-jean-jaures_13006_arrete_astreinte_2021_01383_22-mai-2021.pdf": "22/05/2021",  # "22 /05/2021"
-    "80_rue_nationale_ppm_12_532_15-mars-2013.pdf": "15/03/2013",  # "15 mars 2013"
-    "8_rue_de_recolettes_13001_ppm_2021_00525.pdf": "16/02/2021",  # "16 février 2021"
     "55-57-rue-de-rome-13001_2019_01329.pdf": "23/04/2019",  # "23 avril 2019"
     "ppm_3-rue-vacon-13001_2020_00183_vdm.pdf": "23/01/2020",  # "23 /01/2020"
-    "ML-24-rue-Vacon-13001_2018_03193.pdf": "06/12/2018",  # "6/12/2018"
-    "deconstruction_8-rue-de-la-butte-13002_2019_03064_vdm.pdf": "30/08/2019",  # "30/008/2019"
-    "ml_22-26-rue-joliette-2019_03597_vdm.pdf": "14/10/2019",  # "14 octobre 2019"
     "27-bd-allemand-13003_2019_03860.pdf": "06/11/2019",  # "6/11/2019"
-    "5-rue-pasteur-heuze_13003_ppm_2021_00625.pdf": "25/02/2021",  # "25 février 2021"
-    "33-rue-clovis-hugues-13003_2021_01487.pdf": "01/06/2021",  # "1er juin 2021"
-    "23-25-rue-du-jet-deau-13003_modif_ps_2021_01728_18-juin-2021_ano.pdf": "18/06/2021",  # 18-juin-2021
     "51-bd-dahdah-13004-2019_04381.pdf": "12/12/2019",  # "12/012/2019"
-    "29-rue-nau-13006_2019_01232.pdf": "15/04/2019",  # "15 avril 2019"
-    "12-place-nd-du-mont-13006-ms_2021_01990_i.pdf": "08/07/2021",  # "8/07/2021"
     "po_28-rue-des-trois-rois-13006_2020_02117_vdm.pdf": "24/09/2020",  # "24/09"
-    "ppm-53-rue-roger-renzo-13008-n2020_02620.pdf": "09/11/2020",  # "9/11/2020"
     "ML-1-TRAVERSE-DE-LA-JULIETTE_2018_03192.pdf": "07/12/2018",  # "7/12/2018"
     "15-rue-du-jet-d-eau-13003_pgi_2019_02875.pdf": "14/08/2019",  # "14/08/20219"
     "7-rue-des-cartiers-13002_ppm-2021_00034.pdf": "07/01/2021",  # "07/11/2021"
@@ -349,6 +565,7 @@ FIX_DATE_LINK = {
 }
 
 
+@instrument.profiled
 def fix_date_nomdoc(df, verbose=False):
     """Corrige manuellement la date qui devrait être extraite du nom du doc.
 
@@ -363,8 +580,15 @@ def fix_date_nomdoc(df, verbose=False):
     df : DataFrame
         Liste avec date corrigée le cas échéant, sinon date fournie en entrée.
     """
-    for url, date_link in FIX_DATE_LINK.items():
-        df.loc[df["url"].str.endswith(url), "date_link"] = date_link
+    apply_rule_table(
+        df,
+        url_basename(df["url"]),
+        FIX_DATE_LINK,
+        "date_link",
+        name="FIX_DATE_LINK",
+        verbose=verbose,
+    )
+    df.loc[url_basename(df["url"]).isin(FIX_DATE_LINK), "date_source"] = "correction"
     if verbose:
         print("Entrées sans date")
         with pd.option_context("max_colwidth", -1):
@@ -372,6 +596,89 @@ def fix_date_nomdoc(df, verbose=False):
     return df
 
 
+def _memo_apply(memo, name, s_in, func):
+    """Applique une fonction vectorisée à une colonne, via le cache mémo s'il y en a un.
+
+    La version des règles est l'empreinte du code de ce module : le cache est
+    invalidé dès qu'une expression régulière ou une table de corrections change.
+    """
+    if memo is None:
+        return func(s_in)
+    version = rules_version(sys.modules[__name__])
+    return memo.map_column(name, version, s_in, func).astype("string")
+
+
+@instrument.profiled
+def enrich_liste(df, verbose=False, memo=None):
+    """Enrichit la liste d'arrêtés : classe et date de chaque document.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste corrigée des documents
+    verbose : bool
+        Si True, affiche les entrées sans classe ou sans date.
+    memo : cache_utils.MemoCache, optional
+        Cache mémo des classes et dates déjà calculées.
+
+    Returns
+    -------
+    df : DataFrame
+        Liste enrichie
+    """
+    df.loc[:, "classe"] = _memo_apply(
+        memo, "predict_doc_classes", df["nom_doc"], predict_doc_classes
+    )
+    # classe inconnue : on la devine à partir de l'URL
+    unknown = df["classe"] == "?"
+    df.loc[unknown, "classe"] = _memo_apply(
+        memo, "guess_doc_class", df.loc[unknown, "url"], guess_doc_class
+    ).astype("string")
+    df = fix_doc_class(df, verbose=verbose)
+    #
+    df = extract_date_nomdoc(df, memo=memo)
+    df = fix_date_nomdoc(df, verbose=verbose)
+    return df
+
+
+def enrich_liste_chunks(chunks, verbose=False, memo=None):
+    """Enrichit la liste d'arrêtés, morceau par morceau.
+
+    La classe et la date de chaque document ne dépendent que de sa ligne :
+    chaque morceau est enrichi comme la liste entière le serait.
+
+    Parameters
+    ----------
+    chunks : Iterable[DataFrame]
+        Morceaux de la liste corrigée des documents (voir `storage.iter_liste`)
+    verbose : bool
+        Si True, affiche les entrées sans classe ou sans date, sur toute la
+        liste, une fois le dernier morceau enrichi. Les règles inutilisées
+        ne sont affichées qu'en traitant la liste entière.
+    memo : cache_utils.MemoCache, optional
+        Cache mémo des classes et dates déjà calculées.
+
+    Yields
+    ------
+    df : DataFrame
+        Morceau de la liste enrichie
+    """
+    no_class = []
+    no_date = []
+    for df in chunks:
+        df = enrich_liste(df, verbose=False, memo=memo)
+        if verbose:
+            no_class.append(df.loc[df["classe"].isna(), ["nom_doc", "url"]])
+            no_date.append(df.loc[df["date_link"].isna(), ["nom_doc", "url"]])
+        yield df
+    if verbose and no_class:
+        with pd.option_context("max_colwidth", None):
+            print("Entrées sans classe")
+            print(pd.concat(no_class))
+            print("Entrées sans date")
+            print(pd.concat(no_date))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -382,23 +689,42 @@ if __name__ == "__main__":
         ),
     )
     parser.add_argument("--out_dir", help="Base output dir", default="data/interim")
+    parser.add_argument(
+        "--no_memo",
+        help="Ne pas utiliser le cache mémo des classes et dates déjà calculées",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Traiter la liste par morceaux de N lignes, en mémoire constante",
+        type=int,
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args, "enrich_liste_arretes")
     # fichier brut => fichier corrigé
     fp_in = Path(args.liste_csv).resolve()
     fp_out = Path(args.out_dir) / Path(
         fp_in.stem.rsplit("_", 1)[0] + "_enr" + fp_in.suffix
     )
-    # on ouvre le fichier bugué
-    df = pd.read_csv(fp_in, dtype="string")
-    df.loc[:, "classe"] = df["nom_doc"].apply(predict_doc_class)
-    df.loc[df["classe"] == "?", "classe"] = df.loc[df["classe"] == "?", :].apply(
-        guess_doc_class, axis=1
-    )
-    df = fix_doc_class(df, verbose=True)
-    #
-    df = extract_date_nomdoc(df)
-    df = fix_date_nomdoc(df, verbose=True)
-    # on exporte le dataframe corrigé, en gardant le même format que précemment
-    # y compris les retours à la ligne du dialecte Excel du CSV Writer :
-    # https://docs.python.org/3/library/csv.html#csv.Dialect.lineterminator
-    df.to_csv(fp_out, sep=",", index=False, line_terminator="\r\n")
+    with contextlib.ExitStack() as stack:
+        memo = None if args.no_memo else stack.enter_context(MemoCache())
+        if args.chunksize:
+            # lecture, enrichissement et écriture au fil des morceaux
+            chunks = enrich_liste_chunks(
+                iter_liste(fp_in, args.chunksize), verbose=True, memo=memo
+            )
+            write_liste_chunks(chunks, fp_out, fmt=args.format)
+        else:
+            # on ouvre le fichier bugué
+            df = read_liste(fp_in)
+            df = enrich_liste(df, verbose=True, memo=memo)
+            # on exporte le dataframe corrigé, en gardant le même format
+            write_liste(df, fp_out, fmt=args.format)
+    instrument.stop()
@@ -0,0 +1,296 @@
+"""Extrait le texte des arrêtés téléchargés (PDF).
+
+Le texte de chaque document est extrait par un pool de processus, sur tous
+les coeurs. Les textes sont mis en cache sous l'empreinte SHA-256 du
+fichier : un document inchangé n'est jamais ré-analysé, même s'il change
+d'URL. L'échec de l'analyse d'un fichier (PDF corrompu, analyse trop longue,
+crash du processus) est noté dans la sortie sans interrompre le traitement
+des autres.
+
+Le texte de chaque document de la liste est écrit à côté de la liste
+traitée, dans un fichier "_text".
+
+Nécessite pdfminer.six.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+import os
+from pathlib import Path
+import signal
+
+import pandas as pd
+
+from cache_utils import MemoCache
+import doc_store
+from download_arretes import doc_path
+import instrument
+from storage import FORMATS, read_liste, write_liste
+
+try:
+    import pdfminer
+    from pdfminer.high_level import extract_text
+
+    # version de l'extracteur : le cache est invalidé quand elle change
+    EXTRACTOR = f"pdfminer.six {pdfminer.__version__}"
+except ImportError:
+    extract_text = None
+    EXTRACTOR = None
+
+# fichier du cache des textes
+TEXT_DB = ".cache/text.sqlite"
+# nombre maximal de textes en cache
+TEXT_MAX_ENTRIES = 100_000
+# nom de la fonction dans le cache
+CACHE_NAME = "extract_text"
+# durée maximale de l'analyse d'un fichier (en secondes)
+TIMEOUT = 300
+
+
+def _on_alarm(signum, frame):
+    """Interrompt l'analyse d'un fichier trop longue"""
+    raise TimeoutError("analyse trop longue")
+
+
+def extract_pdf_text(fp, timeout=TIMEOUT):
+    """Extrait le texte d'un PDF ; appelée dans un processus du pool.
+
+    L'analyse est interrompue au bout de `timeout` secondes (par un signal
+    SIGALRM, sauf sous Windows) : un PDF sur lequel pdfminer boucle ne
+    bloque pas le processus.
+
+    Parameters
+    ----------
+    fp : str
+        Chemin du fichier PDF
+    timeout : float, optional
+        Durée maximale de l'analyse, en secondes (None : pas de limite)
+
+    Returns
+    -------
+    text : str or None
+        Texte du document, None en cas d'échec
+    error : str or None
+        Message d'erreur, None en cas de succès
+    """
+    use_alarm = bool(timeout) and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return extract_text(fp), None
+    except Exception as exc:
+        return None, f"{type(exc).__name__}: {exc}"
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _run_pool(fps, max_workers, timeout=TIMEOUT):
+    """Extrait le texte de plusieurs fichiers dans un pool de processus.
+
+    Returns
+    -------
+    results : Dict[str, Tuple[str, str]]
+        Texte et erreur pour chaque fichier traité
+    broken : List[str]
+        Fichiers non traités car un processus du pool s'est arrêté brutalement
+    """
+    results = {}
+    broken = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(extract_pdf_text, fp, timeout): fp for fp in fps}
+        for i, future in enumerate(as_completed(futures), start=1):
+            fp = futures[future]
+            try:
+                results[fp] = future.result()
+            except BrokenProcessPool:
+                broken.append(fp)
+            if i % 100 == 0:
+                print(f"{i} / {len(fps)}")
+    return results, broken
+
+
+@instrument.profiled
+def extract_texts(fps, max_workers=None, timeout=TIMEOUT):
+    """Extrait le texte de fichiers PDF, en parallèle.
+
+    Si un processus s'arrête brutalement (p. ex. mémoire épuisée), les
+    fichiers dont le traitement a été interrompu sont repris ensemble dans
+    un nouveau pool. Si ce pool s'arrête à son tour sans avoir traité aucun
+    fichier, les fichiers restants sont répartis en deux pools, et ainsi de
+    suite : le fichier en cause est isolé sans perdre les autres, et sans
+    renoncer au parallélisme.
+
+    Parameters
+    ----------
+    fps : List[str]
+        Chemins des fichiers PDF
+    max_workers : int, optional
+        Nombre de processus (par défaut : nombre de coeurs)
+    timeout : float, optional
+        Durée maximale de l'analyse d'un fichier, en secondes
+
+    Returns
+    -------
+    results : Dict[str, Tuple[str, str]]
+        Texte (ou None) et erreur (ou None) pour chaque fichier
+    """
+    results = {}
+    # groupes de fichiers à traiter, chacun dans un nouveau pool
+    groups = [list(fps)]
+    while groups:
+        group = groups.pop()
+        res_group, broken = _run_pool(group, max_workers, timeout)
+        results.update(res_group)
+        if not broken:
+            continue
+        if len(group) == 1:
+            results[group[0]] = (None, "BrokenProcessPool: arrêt brutal du processus")
+        elif len(broken) < len(group):
+            print(f"WARN: arrêt brutal d'un processus, {len(broken)} fichiers repris")
+            groups.append(broken)
+        else:
+            # aucun fichier traité : on coupe le groupe en deux
+            half = len(broken) // 2
+            groups.extend([broken[half:], broken[:half]])
+    return results
+
+
+@instrument.profiled
+def extract_liste(df, doc_dir, max_workers=None, cache_db=TEXT_DB, timeout=TIMEOUT):
+    """Extrait le texte des documents d'une liste.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste des documents, avec leurs URL
+    doc_dir : str
+        Dossier de stockage des documents
+    max_workers : int, optional
+        Nombre de processus (par défaut : nombre de coeurs)
+    cache_db : str
+        Fichier du cache des textes
+    timeout : float, optional
+        Durée maximale de l'analyse d'un fichier, en secondes
+
+    Returns
+    -------
+    df_text : DataFrame
+        Pour chaque URL : fichier local, empreinte SHA-256, texte et erreur
+        éventuelle.
+    """
+    if extract_text is None:
+        raise ImportError("L'extraction du texte des PDF nécessite pdfminer.six")
+    urls = df["url"].dropna().drop_duplicates()
+    df_text = pd.DataFrame(
+        {"url": urls.to_numpy(), "fichier": [doc_path(url) for url in urls]},
+        dtype="string",
+    )
+    fps = [os.path.join(doc_dir, fp) for fp in df_text["fichier"]]
+    exists = [os.path.isfile(fp) for fp in fps]
+    # empreinte de chaque fichier présent, lue dans l'index du stock si possible
+    index = doc_store.load_index(doc_dir)
+    df_text["sha256"] = pd.Series(
+        [
+            doc_store.known_digest(doc_dir, fp, index) if ok else None
+            for fp, ok in zip(df_text["fichier"], exists)
+        ],
+        dtype="string",
+    )
+    # textes en cache
+    with MemoCache(cache_db, max_entries=TEXT_MAX_ENTRIES) as cache:
+        digests = sorted(set(df_text["sha256"].dropna()))
+        known = cache.get_many(CACHE_NAME, EXTRACTOR, digests)
+        # textes à extraire : un seul fichier par empreinte
+        todo = {}
+        for fp, digest in zip(fps, df_text["sha256"]):
+            if pd.notna(digest) and digest not in known:
+                todo.setdefault(digest, fp)
+        print(f"{len(digests)} documents, {len(todo)} à analyser")
+        results = extract_texts(
+            list(todo.values()), max_workers=max_workers, timeout=timeout
+        )
+        errors = {}
+        new = {}
+        for digest, fp in todo.items():
+            text, errors[digest] = results[fp]
+            if text is None and errors[digest].startswith("TimeoutError"):
+                # une analyse trop longue pourrait aboutir avec plus de temps
+                continue
+            # un échec est aussi mis en cache (texte None) : le même fichier
+            # échouerait de nouveau
+            new[digest] = text
+        cache.put_many(CACHE_NAME, EXTRACTOR, new)
+        known.update(new)
+    #
+    df_text["texte"] = df_text["sha256"].map(known).astype("string")
+    df_text["erreur"] = pd.Series(pd.NA, index=df_text.index, dtype="string")
+    df_text.loc[[not ok for ok in exists], "erreur"] = "fichier absent"
+    failed = df_text["sha256"].notna() & df_text["texte"].isna()
+    df_text.loc[failed, "erreur"] = (
+        df_text.loc[failed, "sha256"]
+        .map(lambda digest: errors.get(digest) or "échec de l'analyse (en cache)")
+        .astype("string")
+    )
+    if failed.any():
+        print(f"WARN: échec de l'analyse de {failed.sum()} documents")
+    return df_text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--liste_csv",
+        help="Fichier CSV traité contenant la liste des documents",
+        default="data/processed/mrs-arretes-de-peril-{}.csv".format(
+            date.today().isoformat()
+        ),
+    )
+    parser.add_argument(
+        "--doc_dir", help="Dossier de stockage des documents", default="data/arretes"
+    )
+    parser.add_argument(
+        "--out_dir",
+        help="Dossier de sortie pour les textes (par défaut : celui de la liste)",
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Nombre de processus (par défaut : nombre de coeurs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--cache_db", help="Fichier du cache des textes", default=TEXT_DB
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Durée maximale de l'analyse d'un fichier, en secondes",
+        type=float,
+        default=TIMEOUT,
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args, "extract_text_arretes")
+    # fichier traité => fichier des textes
+    fp_in = Path(args.liste_csv).resolve()
+    out_dir = Path(args.out_dir) if args.out_dir else fp_in.parent
+    fp_out = out_dir / (fp_in.stem + "_text" + fp_in.suffix)
+    #
+    df = read_liste(fp_in)
+    df_text = extract_liste(
+        df,
+        os.path.abspath(args.doc_dir),
+        max_workers=args.max_workers,
+        cache_db=args.cache_db,
+        timeout=args.timeout,
+    )
+    write_liste(df_text, fp_out, fmt=args.format)
+    instrument.stop()
@@ -10,7 +10,10 @@ from datetime import date
 from pathlib import Path
 import os.path
 
-import pandas as pd
+from adresses import check_cp_conflicts, count_cp_pairs
+import instrument
+from rule_tables import apply_rule_table, composite_key, composite_table
+from storage import FORMATS, iter_liste, read_liste, write_liste, write_liste_chunks
 
 # chaque arrondissement a un code postal
 ART_CP = [("1er arrondissement", "13001")] + [
@@ -39,6 +42,7 @@ MANUAL_FIX_ADRESSE_NOMDOC_URL = {
 }
 
 # TODO correction d'adresses automatique ?
+# (les conflits adresse -> code postal sont repérés par adresses.check_cp_conflicts)
 MANUAL_FIX_ADRESSE = {
     "49 rue Pierre Albran": "49 rue Pierre Albrand",
 }
@@ -57,6 +61,9 @@ MANUAL_ADRESSE_TO_CP = {
     # 13004 (faux) et 13001 (vrai)
     "2 rue d'Anvers": "13001",
 }
+MANUAL_ADRESSE_TO_ART = {
+    e_adr: CP2ART[e_cp] for e_adr, e_cp in MANUAL_ADRESSE_TO_CP.items()
+}
 
 # dépendance manuelle item -> adresse
 MANUAL_ITEM_TO_ADRESSE = {
@@ -71,29 +78,60 @@ MANUAL_ITEM_TO_ADRESSE = {
 }
 
 
+@instrument.profiled
 def apply_manual_fixes(df, verbose=False):
     """Applique des corrections manuelles à certaines entrées.
 
     Idéalement, certaines corrections devraient être (semi-)automatisées.
     """
     # corrections directement dans une colonne (remplacement simple)
-    for adr_bad, adr_fix in MANUAL_FIX_ADRESSE.items():
-        df.loc[df["adresse"] == adr_bad, "adresse"] = adr_fix
-    for url_bad, url_fix in MANUAL_FIX_URL.items():
-        df.loc[df["url"] == url_bad, "url"] = url_fix
+    apply_rule_table(
+        df,
+        df["adresse"],
+        MANUAL_FIX_ADRESSE,
+        "adresse",
+        name="MANUAL_FIX_ADRESSE",
+        verbose=verbose,
+    )
+    apply_rule_table(
+        df, df["url"], MANUAL_FIX_URL, "url", name="MANUAL_FIX_URL", verbose=verbose
+    )
     # corrections dépendantes d'une autre colonne :
     # - correction dépendante manuelle (TODO vérifier si encore utile 2021-07)
-    for e_item, e_adrs in MANUAL_ITEM_TO_ADRESSE.items():
-        df.loc[df["item"] == e_item, "adresse"] = e_adrs
+    apply_rule_table(
+        df,
+        df["item"],
+        MANUAL_ITEM_TO_ADRESSE,
+        "adresse",
+        name="MANUAL_ITEM_TO_ADRESSE",
+        verbose=verbose,
+    )
     # - correction correspondant à une dépendance fonctionnelle
-    for e_adr, e_cp in MANUAL_ADRESSE_TO_CP.items():
-        df.loc[df["adresse"] == e_adr, "code_postal"] = e_cp
-        df.loc[df["adresse"] == e_adr, "arrondissement"] = CP2ART[e_cp]
+    apply_rule_table(
+        df,
+        df["adresse"],
+        MANUAL_ADRESSE_TO_CP,
+        "code_postal",
+        name="MANUAL_ADRESSE_TO_CP",
+        verbose=verbose,
+    )
+    apply_rule_table(
+        df,
+        df["adresse"],
+        MANUAL_ADRESSE_TO_ART,
+        "arrondissement",
+        name="MANUAL_ADRESSE_TO_ART",
+        verbose=verbose,
+    )
     # - adresse et nom_doc => URL
-    for (e_adr, e_nomdoc), url_fix in MANUAL_FIX_ADRESSE_NOMDOC_URL.items():
-        df.loc[
-            ((df["adresse"] == e_adr) & (df["nom_doc"] == e_nomdoc)), "url"
-        ] = url_fix
+    apply_rule_table(
+        df,
+        composite_key(df["adresse"], df["nom_doc"]),
+        composite_table(MANUAL_FIX_ADRESSE_NOMDOC_URL),
+        "url",
+        name="MANUAL_FIX_ADRESSE_NOMDOC_URL",
+        verbose=verbose,
+    )
     # corrections plus complexes :
     # - re-créer 1 ligne correcte à partir de 2 lignes incorrectes
     df.loc[
@@ -136,6 +174,7 @@ def apply_manual_fixes(df, verbose=False):
     return df
 
 
+@instrument.profiled
 def clean(df, verbose=False):
     """Nettoie le tableau de données"""
     # on supprime les URLs qui ne pointent pas vers le site de la ville
@@ -153,6 +192,67 @@ def clean(df, verbose=False):
     return df
 
 
+@instrument.profiled
+def fix_liste(df, verbose=False):
+    """Corrige la liste d'arrêtés : corrections manuelles puis nettoyage.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste brute des documents
+
+    Returns
+    -------
+    df : DataFrame
+        Liste corrigée
+    """
+    df = apply_manual_fixes(df, verbose=verbose)
+    df = clean(df, verbose=verbose)
+    if verbose:
+        print_cp_conflicts(df)
+    return df
+
+
+def print_cp_conflicts(df, count_col=None):
+    """Affiche les conflits adresse -> code postal restants (hors MANUAL_ADRESSE_TO_CP)"""
+    df_conflicts = check_cp_conflicts(df, count_col=count_col)
+    if not df_conflicts.empty:
+        print("WARN: adresses associées à plusieurs codes postaux")
+        print(df_conflicts[["variantes", "codes_postaux"]].to_string(index=False))
+
+
+def fix_liste_chunks(chunks, verbose=False):
+    """Corrige la liste d'arrêtés, morceau par morceau.
+
+    Les corrections ne portent que sur des lignes isolées : chaque morceau
+    est corrigé comme la liste entière le serait. Seuls les comptes des
+    couples (adresse, code postal) sont gardés d'un morceau à l'autre, pour
+    le contrôle des conflits de codes postaux.
+
+    Parameters
+    ----------
+    chunks : Iterable[DataFrame]
+        Morceaux de la liste brute des documents (voir `storage.iter_liste`)
+    verbose : bool
+        Si True, affiche les conflits adresse -> code postal, sur toute la
+        liste, une fois le dernier morceau corrigé. Les règles inutilisées
+        ne sont affichées qu'en traitant la liste entière.
+
+    Yields
+    ------
+    df : DataFrame
+        Morceau de la liste corrigée
+    """
+    counts = None
+    for df in chunks:
+        df = fix_liste(df, verbose=False)
+        if verbose:
+            counts = count_cp_pairs(df, counts)
+        yield df
+    if verbose and counts is not None:
+        print_cp_conflicts(counts.rename("n").reset_index(), count_col="n")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -161,15 +261,31 @@ if __name__ == "__main__":
         default="data/raw/mrs-arretes-de-peril-{}.csv".format(date.today().isoformat()),
     )
     parser.add_argument("--out_dir", help="Base output dir", default="data/interim")
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Traiter la liste par morceaux de N lignes, en mémoire constante",
+        type=int,
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args, "fix_liste_arretes")
     # fichier brut => fichier corrigé
     fp_raw = Path(args.liste_csv).resolve()
     fp_fix = Path(args.out_dir) / Path(fp_raw.stem + "_fix" + fp_raw.suffix)
-    # on ouvre le fichier bugué
-    df = pd.read_csv(fp_raw, dtype="string")
-    df = apply_manual_fixes(df, verbose=True)
-    df = clean(df, verbose=True)
-    # on exporte le dataframe corrigé, en gardant le même format que précemment
-    # y compris les retours à la ligne du dialecte Excel du CSV Writer :
-    # https://docs.python.org/3/library/csv.html#csv.Dialect.lineterminator
-    df.to_csv(fp_fix, sep=",", index=False, line_terminator="\r\n")
+    if args.chunksize:
+        # lecture, correction et écriture au fil des morceaux
+        chunks = fix_liste_chunks(iter_liste(fp_raw, args.chunksize), verbose=True)
+        write_liste_chunks(chunks, fp_fix, fmt=args.format)
+    else:
+        # on ouvre le fichier bugué
+        df = read_liste(fp_raw)
+        df = fix_liste(df, verbose=True)
+        # on exporte le dataframe corrigé, en gardant le même format que précemment
+        write_liste(df, fp_fix, fmt=args.format)
+    instrument.stop()
@@ -1,17 +1,26 @@
-"""Télécharger les arrêtés de péril depuis le site de la ville"""
+"""Télécharger les arrêtés de péril depuis le site de la ville
+
+Par défaut, la structure de la page (sections, accordéons, items et liens)
+est extraite par un unique script exécuté dans le navigateur, qui la renvoie
+en JSON ; l'analyse se fait ensuite en Python, sur ces données. L'option
+--dom_walk parcourt à la place le DOM élément par élément (un appel
+WebDriver par élément).
+"""
 
 
 import argparse
 import csv
 from datetime import date
 import os.path
-from pathlib import Path
 import re
 import unicodedata
 
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 
+import download_watch
+import instrument
+
 
 # page centralisant les arrêtés
 URL = "http://logement-urbanisme.marseille.fr/am%C3%A9lioration-de-lhabitat/arretes-de-peril"
@@ -27,6 +36,71 @@ ART2CP = dict(ART_CP)
 RE_CP = r"[^\d](?P<cp>\d{5})[^\d]"
 MATCH_CP = re.compile(RE_CP)
 
+# l'adresse s'arrête dès qu'on rencontre un de ces termes
+ADDRESS_LIMITS = [
+    "Arrêté",
+    "Arrrété",
+    "arreté",
+    "Arrété",
+    "Arrête",
+    "Main Levée",
+    "Main levée",
+    "Main-Levée",
+    "main levée",
+    "Mainlevée",
+    "Modification",
+    "Abrogation",
+    "abrogé",
+    "remplacé",
+    "Interdiction",
+]
+
+# script exécuté dans le navigateur : structure de la page en JSON, en un
+# seul appel WebDriver ; mêmes éléments que le parcours du DOM de
+# `parse_arretes` (titres h4 de sections, listes directes ou accordéons)
+JS_SECTIONS = """
+const items = (ul) => Array.from(ul.children)
+  .filter((li) => li.tagName === "LI")
+  .map((li) => ({
+    text: li.textContent,
+    links: Array.from(li.children)
+      .filter((a) => a.tagName === "A")
+      .map((a) => ({
+        text: a.textContent,
+        href: a.getAttribute("href") === null ? null : a.href,
+      })),
+  }));
+const conts = document.evaluate(
+  '//div[@class="field-items"]/div', document, null,
+  XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+const sections = [];
+if (conts.snapshotLength > 0) {
+  const cont = conts.snapshotItem(0);
+  for (const h4 of Array.from(cont.children).filter((e) => e.tagName === "H4")) {
+    const next = h4.nextElementSibling;
+    const section = {title: h4.innerText, tag: next.tagName.toLowerCase()};
+    if (section.tag === "ul") {
+      section.items = items(next);
+    } else if (section.tag === "p") {
+      let div = next.nextElementSibling;
+      while (div.tagName !== "DIV") {
+        div = div.nextElementSibling;
+      }
+      section.accordions = Array.from(div.children)
+        .filter((e) => e.tagName === "DIV")
+        .map((acc) => ({
+          key: acc.querySelector(':scope > div.head-acc > a').innerText.trim(),
+          lists: Array.from(acc.querySelectorAll(':scope > div > div > ul')).map(items),
+        }));
+    } else {
+      section.html = next.innerHTML;
+    }
+    sections.push(section);
+  }
+}
+return {containers: conts.snapshotLength, sections: sections};
+"""
+
 
 # selenium helpers
 def is_download_finished(temp_folder, fname=None):
@@ -42,24 +116,7 @@ def is_download_finished(temp_folder, fname=None):
 
     https://stackoverflow.com/a/53602937
     """
-    if fname is None:
-        firefox_temp_file = sorted(Path(temp_folder).glob("*.part"))
-        chrome_temp_file = sorted(Path(temp_folder).glob("*.crdownload"))
-        downloaded_files = sorted(Path(temp_folder).glob("*.*"))
-    else:
-        firefox_temp_file = sorted(Path(temp_folder).glob(fname + ".part"))
-        chrome_temp_file = sorted(Path(temp_folder).glob(fname + ".crdownload"))
-        downloaded_files = sorted(Path(temp_folder).glob(fname))
-    # do check
-    if (
-        (len(firefox_temp_file) == 0)
-        and (len(chrome_temp_file) == 0)
-        and (len(downloaded_files) >= 1)
-    ):
-        # all good
-        return True
-    else:
-        return False
+    return download_watch.is_download_finished(temp_folder, fname=fname)
 
 
 def _setup_browser(dl_dir, mime_type):
@@ -90,82 +147,88 @@ def _setup_browser(dl_dir, mime_type):
     return browser
 
 
-def parse_plain_list(driver, elt):
-    """Parse une liste d'items
+def extract_address(e_text):
+    """Extrait l'adresse et le code postal à partir du texte d'un item.
 
     Parameters
     ----------
-    driver : selenium.webdriver.firefox.webdriver.WebDriver
-        Driver selenium
-    elt : FirefoxWebElement
-        Element contenant la liste d'accordéons
-    outdir : string
-        Dossier de stockage des documents
+    e_text : str
+        Texte complet de l'item
 
     Returns
     -------
-    docs : List[(str, str, str, str)]
-        Liste des documents, décrits par l'adresse, le texte
-        complet de l'item (dont adresse), le texte du lien et
-        l'URL du lien.
+    e_addr : str
+        Adresse
+    e_cp : str
+        Code postal, chaîne vide s'il n'est pas dans le texte.
+    """
+    e_addr = e_text
+    # l'adresse s'arrête dès qu'on rencontre
+    # un de ces termes
+    for rlimit in ADDRESS_LIMITS:
+        if rlimit in e_addr:
+            e_addr = e_addr.split(rlimit)[0]
+    # on récupère le code postal si présent
+    m_cp = MATCH_CP.search(e_addr)
+    if m_cp is not None:
+        e_cp = m_cp.group("cp")
+        # et on le supprime du texte de l'adresse
+        # (redondant maintenant qu'on a un champ dédié)
+        e_addr = re.sub(RE_CP, "", e_addr)
+    else:
+        e_cp = ""
+    # nettoyage des caractères avant/après
+    e_addr = e_addr.lstrip().rstrip(" -:/+(")
+    return e_addr, e_cp
+
+
+def parse_plain_items(items):
+    """Parse les items d'une liste, extraits de la page.
+
+    Parameters
+    ----------
+    items : List[dict]
+        Items de la liste : texte complet ("text") et liens ("links",
+        avec leur texte "text" et leur URL "href").
+
+    Returns
+    -------
+    docs : List[(str, str, str, str, str)]
+        Liste des documents, décrits par le texte complet de l'item
+        (dont adresse), le texte du lien, l'URL du lien, l'adresse
+        et le code postal.
     """
     docs = []
-    for e_it in elt.find_elements_by_xpath("./li"):
-        e_text = e_it.get_attribute("textContent").strip()
-        e_text = unicodedata.normalize("NFKC", e_text)
+    for item in items:
+        e_text = unicodedata.normalize("NFKC", item["text"].strip())
         # extraction de l'adresse
-        e_addr = e_text
-        # l'adresse s'arrête dès qu'on rencontre
-        # un de ces termes
-        rlimits = [
-            "Arrêté",
-            "Arrrété",
-            "arreté",
-            "Arrété",
-            "Arrête",
-            "Main Levée",
-            "Main levée",
-            "Main-Levée",
-            "main levée",
-            "Mainlevée",
-            "Modification",
-            "Abrogation",
-            "abrogé",
-            "remplacé",
-            "Interdiction",
-        ]
-        for rlimit in rlimits:
-            if rlimit in e_addr:
-                e_addr = e_addr.split(rlimit)[0]
-        # on récupère le code postal si présent
-        m_cp = MATCH_CP.search(e_addr)
-        if m_cp is not None:
-            e_cp = m_cp.group("cp")
-            # et on le supprime du texte de l'adresse
-            # (redondant maintenant qu'on a un champ dédié)
-            e_addr = re.sub(RE_CP, "", e_addr)
-        else:
-            e_cp = ""
-        # nettoyage des caractères avant/après
-        e_addr = e_addr.lstrip().rstrip(" -:/+(")
+        e_addr, e_cp = extract_address(e_text)
         # item, texte du lien, URL du lien, adresse, code postal
         docs.extend(
-            [
-                (
-                    e_text,
-                    x.get_attribute("textContent"),
-                    x.get_attribute("href"),
-                    e_addr,
-                    e_cp,
-                )
-                for x in e_it.find_elements_by_xpath("./a")
-            ]
+            [(e_text, x["text"], x["href"], e_addr, e_cp) for x in item["links"]]
         )
     return docs
 
 
-def parse_accordion_list(driver, elt):
-    """Parse une liste d'accordéons
+def _dom_items(elt):
+    """Items d'une liste, lus élément par élément (voir `parse_plain_items`)"""
+    return [
+        {
+            "text": e_it.get_attribute("textContent"),
+            "links": [
+                {
+                    "text": x.get_attribute("textContent"),
+                    "href": x.get_attribute("href"),
+                }
+                for x in e_it.find_elements_by_xpath("./a")
+            ],
+        }
+        for e_it in elt.find_elements_by_xpath("./li")
+    ]
+
+
+def parse_plain_list(driver, elt):
+    """Parse une liste d'items
 
     Parameters
     ----------
@@ -173,24 +236,37 @@ def parse_accordion_list(driver, elt):
         Driver selenium
     elt : FirefoxWebElement
         Element contenant la liste d'accordéons
-    outdir : string
-        Dossier de stockage des documents
+
+    Returns
+    -------
+    docs : List[(str, str, str, str, str)]
+        Liste des documents, décrits par le texte complet de l'item
+        (dont adresse), le texte du lien, l'URL du lien, l'adresse
+        et le code postal.
+    """
+    return parse_plain_items(_dom_items(elt))
+
+
+def parse_accordion_items(accordions):
+    """Parse une liste d'accordéons, extraite de la page.
+
+    Parameters
+    ----------
+    accordions : List[dict]
+        Accordéons : arrondissement ("key") et listes d'items ("lists", une
+        seule attendue, voir `parse_plain_items`).
 
     Returns
     -------
     docs : List[]
         Liste des documents: arrondissement, texte de l'item,
-        texte du lien, URL du lien.
+        texte du lien, URL du lien, adresse, code postal.
     """
     docs = []
-    for e_acc in elt.find_elements_by_xpath("./div"):
-        # e_key = e_acc.find_element_by_xpath('./strong/div/h4/a').text  # 2020-02
-        # 2021-03
-        e_key = e_acc.find_element_by_xpath('./div[@class="head-acc"]/a').text
-        elts_ul = e_acc.find_elements_by_xpath("./div/div/ul")
-        assert len(elts_ul) == 1
-        elt_ul = elts_ul[0]
-        e_docs = parse_plain_list(driver, elt_ul)
+    for acc in accordions:
+        e_key = acc["key"]
+        assert len(acc["lists"]) == 1
+        e_docs = parse_plain_items(acc["lists"][0])
         # on définit le code postal à partir du numéro d'arrondissement
         elt_cp = ART2CP[e_key]
         # on vérifie qu'il n'y a pas de conflit entre ce code postal
@@ -209,7 +285,75 @@ def parse_accordion_list(driver, elt):
     return docs
 
 
-def parse_arretes(driver, url, outdir):
+def parse_accordion_list(driver, elt):
+    """Parse une liste d'accordéons
+
+    Parameters
+    ----------
+    driver : selenium.webdriver.firefox.webdriver.WebDriver
+        Driver selenium
+    elt : FirefoxWebElement
+        Element contenant la liste d'accordéons
+
+    Returns
+    -------
+    docs : List[]
+        Liste des documents: arrondissement, texte de l'item,
+        texte du lien, URL du lien, adresse, code postal.
+    """
+    accordions = []
+    for e_acc in elt.find_elements_by_xpath("./div"):
+        # e_key = e_acc.find_element_by_xpath('./strong/div/h4/a').text  # 2020-02
+        # 2021-03
+        e_key = e_acc.find_element_by_xpath('./div[@class="head-acc"]/a').text
+        elts_ul = e_acc.find_elements_by_xpath("./div/div/ul")
+        accordions.append({"key": e_key, "lists": [_dom_items(x) for x in elts_ul]})
+    return parse_accordion_items(accordions)
+
+
+def parse_sections(page):
+    """Parse les sections de la page, extraites par `JS_SECTIONS`.
+
+    Parameters
+    ----------
+    page : dict
+        Nombre de conteneurs de sections ("containers") et sections du
+        premier ("sections") : titre ("title"), balise de l'élément suivant
+        le titre ("tag") et liste directe ("items") ou liste d'accordéons
+        ("accordions").
+
+    Returns
+    -------
+    res : List[Tuple[str, str, str, str, str, str, str]]
+        Liste des documents: classe, arrondissement, texte de l'item,
+        texte du lien, URL du lien, adresse, code postal.
+    """
+    # les sections sont dans un unique <div class="field-item even">
+    assert page["containers"] == 1
+    res = []
+    for section in page["sections"]:
+        doc_class = (
+            section["title"]
+            .replace("Consultez les derniers ", "")
+            .replace(" par arrondissement (ordre chronologique)", "")
+        )
+        # on affiche la section pour suivre la progression du script
+        print(doc_class)
+        if section["tag"] == "ul":
+            docs = parse_plain_items(section["items"])
+            # on ne connaît pas l'arrondissement
+            res.extend([(doc_class, "", x[0], x[1], x[2], x[3], x[4]) for x in docs])
+        elif section["tag"] == "p":
+            docs = parse_accordion_items(section["accordions"])
+            res.extend([(doc_class, x[0], x[1], x[2], x[3], x[4], x[5]) for x in docs])
+        else:
+            e_html = section["tag"] + " " + section["html"]
+            raise ValueError("Structure de page inattendue\n{}".format(e_html))
+    return res
+
+
+@instrument.profiled
+def parse_arretes(driver, url, outdir, dom_walk=False):
     """Extraire les descriptions et liens des arrêtés depuis la page web.
 
     Parameters
@@ -220,10 +364,15 @@ def parse_arretes(driver, url, outdir):
         URL de la page listant les arrêtés de péril
     outdir : string
         Chemin vers le dossier où seront stockés les arrêtés téléchargés.
+    dom_walk : bool
+        Si True, parcourir le DOM élément par élément plutôt qu'extraire
+        la structure de la page en un seul appel (`JS_SECTIONS`).
     """
     driver.get(url)
     # on vérifie le titre de la page
     assert driver.title == "Arrêtés de péril | Ville de Marseille"
+    if not dom_walk:
+        return parse_sections(driver.execute_script(JS_SECTIONS))
     # la page est divisée en 8 sections (au 2020-02-26) correspondant chacune
     # à une classe de documents:
     # * Arrêtés de péril imminent, de Main Levée et de Réintégration partielle,
@@ -270,6 +419,7 @@ def parse_arretes(driver, url, outdir):
     return res
 
 
+@instrument.profiled
 def dump_doc_list(docs, fn_out):
     """Exporter la liste des documents dans un fichier CSV.
 
@@ -300,17 +450,25 @@ def dump_doc_list(docs, fn_out):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("out_dir", help="Base output dir")
+    parser.add_argument(
+        "--dom_walk",
+        help="Parcourir le DOM élément par élément (un appel WebDriver par élément)",
+        action="store_true",
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args, "get_liste_arretes_2020_2021-03")
     # dossier de base pour stocker les documents téléchargés
     dl_dir = os.path.abspath(args.out_dir)
     os.makedirs(dl_dir, exist_ok=True)
     # les arrêtés sont des PDFs
     driver = _setup_browser(dl_dir, "application/pdf")
     #
-    docs = parse_arretes(driver, URL, dl_dir)
+    docs = parse_arretes(driver, URL, dl_dir, dom_walk=args.dom_walk)
     # on ajoute la date du jour
     today = date.today().isoformat()
     # on écrit la liste dans un fichier CSV
     fn_out = f"mrs-arretes-de-peril-{today}.csv"
     fp_out = os.path.join(dl_dir, fn_out)
     dump_doc_list(docs, fp_out)
+    instrument.stop()
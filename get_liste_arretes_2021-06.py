@@ -2,8 +2,18 @@
 
 2021-06 : les arrêtés sont maintenant classés par arrondissement, puis par rue (par ordre alphabétique)
 
+Par défaut, la page est récupérée en une seule requête HTTP et analysée avec lxml.
+Selenium (Firefox headless) n'est utilisé qu'en repli, si cette analyse échoue :
+la structure des accordéons est alors extraite par un unique script exécuté dans
+le navigateur, qui la renvoie en JSON, plutôt qu'en parcourant le DOM élément
+par élément (option --dom_walk).
+
+Le HTML de chaque page récupérée est archivé, compressé et nommé par son empreinte
+SHA-256, dans data/raw/html. L'option --reparse reconstruit les CSV bruts à partir
+de ces archives, sans navigateur ni réseau : on peut ainsi ré-appliquer extract_address()
+(et, en aval, predict_doc_class()) à tout l'historique quand on les modifie.
+
 TODO
-- stocker chaque item en HTML et appliquer extract_address(), predict_doc_class() en post-traitement
 - sortir directement les classes finales
 """
 
@@ -11,14 +21,21 @@ TODO
 import argparse
 import csv
 from datetime import date
+import gzip
+import hashlib
+import json
 import os.path
-from pathlib import Path
 import re
+import sys
 import unicodedata
+from urllib.parse import urljoin
+
+import lxml.html
+import requests
 
-import selenium
-from selenium import webdriver
-from selenium.webdriver.firefox.options import Options
+from cache_utils import MemoCache, rules_version
+import download_watch
+import instrument
 
 
 # page centralisant les arrêtés
@@ -35,6 +52,48 @@ ART2CP = dict(ART_CP)
 RE_CP = r"[^\d](?P<cp>\d{5})[^\d]"
 MATCH_CP = re.compile(RE_CP)
 
+# titre attendu de la page
+PAGE_TITLE = "Arrêtés de péril | Ville de Marseille"
+# délai maximal d'attente d'une réponse du serveur (en secondes)
+TIMEOUT = 60
+
+# script exécuté dans le navigateur : structure des accordéons en JSON, en un
+# seul appel WebDriver ; mêmes éléments que le parcours du DOM de
+# `parse_accordion_list` (un accordéon par arrondissement, dont les enfants
+# alternent voies <p> et listes d'adresses <ul>)
+JS_ACCORDIONS = """
+const items = (elt) => Array.from(elt.children)
+  .filter((li) => li.tagName === "LI")
+  .map((li) => ({
+    text: li.textContent,
+    links: Array.from(li.children)
+      .filter((a) => a.tagName === "A")
+      .map((a) => ({
+        text: a.textContent,
+        href: a.getAttribute("href") === null ? null : a.href,
+      })),
+  }));
+const wrappers = document.evaluate(
+  '//div[@id="dexp-accordions-wrapper"]', document, null,
+  XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+let cards = [];
+if (wrappers.snapshotLength > 0) {
+  cards = Array.from(wrappers.snapshotItem(0).children)
+    .filter((e) => e.tagName === "DIV" && e.getAttribute("class") === "card")
+    .map((card) => ({
+      arrondissement: card.querySelector(':scope > div.head-acc > a').innerText.trim(),
+      bodies: Array.from(card.querySelectorAll(':scope > div > div'))
+        .filter((e) => e.getAttribute("class") === "card-body")
+        .map((body) => Array.from(body.children).map((kid) => ({
+          tag: kid.tagName.toLowerCase(),
+          text: kid.innerText,
+          items: items(kid),
+        }))),
+    }));
+}
+return {wrappers: wrappers.snapshotLength, cards: cards};
+"""
+
 
 # selenium helpers
 def is_download_finished(temp_folder, fname=None):
@@ -50,24 +109,7 @@ def is_download_finished(temp_folder, fname=None):
 
     https://stackoverflow.com/a/53602937
     """
-    if fname is None:
-        firefox_temp_file = sorted(Path(temp_folder).glob("*.part"))
-        chrome_temp_file = sorted(Path(temp_folder).glob("*.crdownload"))
-        downloaded_files = sorted(Path(temp_folder).glob("*.*"))
-    else:
-        firefox_temp_file = sorted(Path(temp_folder).glob(fname + ".part"))
-        chrome_temp_file = sorted(Path(temp_folder).glob(fname + ".crdownload"))
-        downloaded_files = sorted(Path(temp_folder).glob(fname))
-    # do check
-    if (
-        (len(firefox_temp_file) == 0)
-        and (len(chrome_temp_file) == 0)
-        and (len(downloaded_files) >= 1)
-    ):
-        # all good
-        return True
-    else:
-        return False
+    return download_watch.is_download_finished(temp_folder, fname=fname)
 
 
 def _setup_browser(dl_dir, mime_type):
@@ -85,6 +127,9 @@ def _setup_browser(dl_dir, mime_type):
     browser : selenium.webdriver.firefox.webdriver.WebDriver
         Firefox browser.
     """
+    from selenium import webdriver
+    from selenium.webdriver.firefox.options import Options
+
     # Headless Firefox
     options = Options()
     options.add_argument("--headless")
@@ -99,15 +144,21 @@ def _setup_browser(dl_dir, mime_type):
 
 
 # parsing du contenu
-def parse_accordion_list(driver, elt):
-    """Parse une liste d'accordéons, 1 par arrondissement.
+def parse_accordion_data(cards, address_fn=None):
+    """Parse une liste d'accordéons, 1 par arrondissement, extraite de la page.
+
+    Une structure de page inattendue lève une ValueError.
 
     Parameters
     ----------
-    driver : selenium.webdriver.firefox.webdriver.WebDriver
-        Driver selenium
-    elt : selenium.webdriver.firefox.webelement.FirefoxWebElement
-        Element <div> contenant la liste d'accordéons
+    cards : List[dict]
+        Accordéons : arrondissement ("arrondissement") et contenus
+        ("bodies", un seul attendu). Chaque contenu est la liste des
+        enfants de l'élément, décrits par leur balise ("tag"), leur texte
+        ("text") et leurs items ("items" : texte complet et liens, avec
+        leur texte et leur URL).
+    address_fn : Callable[[str], str], optional
+        Fonction d'extraction de l'adresse, par défaut `extract_address`.
 
     Returns
     -------
@@ -115,53 +166,100 @@ def parse_accordion_list(driver, elt):
         Liste des documents: arrondissement, texte de l'item,
         texte du lien, URL du lien, adresse, code postal.
     """
+    if address_fn is None:
+        address_fn = extract_address
     docs = []
-    # on itère sur des div[@class="card"]
-    for e_acc in elt.find_elements_by_xpath('./div[@class="card"]'):
-        # div[@class="head-acc"] : bouton arrondissement
-        a_head_acc = e_acc.find_element_by_xpath('./div[@class="head-acc"]/a')
-        nom_arr = a_head_acc.text
+    for card in cards:
+        nom_arr = card["arrondissement"]
         print(nom_arr)  # suivre la progression du script
         cp_arr = ART2CP[nom_arr]
-        # TODO clic a_head_acc ?
-        # div[@class="body-acc"]/div[@class="card-body"] : liste de (voie, liste d'adresses)
-        # il y a une unique telle liste par arrondissement
-        div_body_arr = e_acc.find_elements_by_xpath('./div/div[@class="card-body"]')
-        assert len(div_body_arr) == 1
-        div_body_arr = div_body_arr[0]
-        # on récupère la liste de voies et de listes d'adresses de cette voie
-        kids_arr = div_body_arr.find_elements_by_xpath("./*")
+        # liste de (voie, liste d'adresses) : il y a une unique telle liste par
+        # arrondissement
+        if len(card["bodies"]) != 1:
+            raise ValueError(f"{nom_arr} : {len(card['bodies'])} listes d'adresses")
+        kids_arr = list(card["bodies"][0])
         # le 1er et le dernier enfants sont des <p> supplémentaires, autour de paires
         # successives : <p><p><ul><p><ul>...<p><ul><p>
-        assert (
-            kids_arr[0].tag_name == kids_arr[1].tag_name == kids_arr[-1].tag_name == "p"
-        )
+        if len(kids_arr) < 2 or not (
+            kids_arr[0]["tag"] == kids_arr[1]["tag"] == kids_arr[-1]["tag"] == "p"
+        ):
+            raise ValueError(f"{nom_arr} : liste d'adresses inattendue")
         # on peut supprimer ces 1er et dernier <p> qui entourent la vraie liste
         kids_arr.pop(0)
         kids_arr.pop(-1)
         # on itère sur les couples (voie, liste d'adresses)
         for p_voie, ul_voie in zip(kids_arr[:-1], kids_arr[1:]):
-            # nom_voie : "Académie (rue de l')"
-            nom_voie = p_voie.text
             # itérer sur la liste d'adresses
-            for li_adr in ul_voie.find_elements_by_xpath("./li"):
+            for li_adr in ul_voie["items"]:
                 # adresse : <a>doc1</a> - <a>doc2</a> ...
-                li_txt = li_adr.get_attribute("textContent").strip()
-                li_txt = unicodedata.normalize("NFKC", li_txt)
-                # TODO stocker l'item en HTML (normalisé unicode?) sans l'analyser, et faire l'extraction d'adresse en post-traitement
-                # (raw -> interim ?)
-                adr_txt = extract_address(li_txt)
+                li_txt = unicodedata.normalize("NFKC", li_adr["text"].strip())
+                adr_txt = address_fn(li_txt)
                 #
-                adr_docs = li_adr.find_elements_by_xpath("./a")
-                for adr_doc in adr_docs:
-                    doc_title = adr_doc.get_attribute("textContent").strip()
-                    doc_title = unicodedata.normalize("NFKC", doc_title)
-                    doc_url = adr_doc.get_attribute("href")
+                for adr_doc in li_adr["links"]:
+                    doc_title = unicodedata.normalize("NFKC", adr_doc["text"].strip())
                     # arrondissement, item, texte du lien, URL du lien, adresse, code postal
-                    docs.append((nom_arr, li_txt, doc_title, doc_url, adr_txt, cp_arr))
+                    docs.append(
+                        (nom_arr, li_txt, doc_title, adr_doc["href"], adr_txt, cp_arr)
+                    )
     return docs
 
 
+def _dom_items(elt):
+    """Items d'un élément, lus élément par élément (voir `parse_accordion_data`)"""
+    return [
+        {
+            "text": li_adr.get_attribute("textContent"),
+            "links": [
+                {
+                    "text": adr_doc.get_attribute("textContent"),
+                    "href": adr_doc.get_attribute("href"),
+                }
+                for adr_doc in li_adr.find_elements_by_xpath("./a")
+            ],
+        }
+        for li_adr in elt.find_elements_by_xpath("./li")
+    ]
+
+
+def parse_accordion_list(driver, elt):
+    """Parse une liste d'accordéons, 1 par arrondissement.
+
+    Parcourt le DOM élément par élément (un appel WebDriver par élément) ;
+    `JS_ACCORDIONS` extrait les mêmes données en un seul appel.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver.firefox.webdriver.WebDriver
+        Driver selenium
+    elt : selenium.webdriver.firefox.webelement.FirefoxWebElement
+        Element <div> contenant la liste d'accordéons
+
+    Returns
+    -------
+    docs : List[Tuple[str, str, str, str, str, str]]
+        Liste des documents: arrondissement, texte de l'item,
+        texte du lien, URL du lien, adresse, code postal.
+    """
+    cards = []
+    # on itère sur des div[@class="card"]
+    for e_acc in elt.find_elements_by_xpath('./div[@class="card"]'):
+        # div[@class="head-acc"] : bouton arrondissement
+        a_head_acc = e_acc.find_element_by_xpath('./div[@class="head-acc"]/a')
+        # TODO clic a_head_acc ?
+        # div[@class="body-acc"]/div[@class="card-body"] : liste de (voie, liste d'adresses)
+        bodies = [
+            [
+                {"tag": kid.tag_name, "text": kid.text, "items": _dom_items(kid)}
+                for kid in div_body_arr.find_elements_by_xpath("./*")
+            ]
+            for div_body_arr in e_acc.find_elements_by_xpath(
+                './div/div[@class="card-body"]'
+            )
+        ]
+        cards.append({"arrondissement": a_head_acc.text, "bodies": bodies})
+    return parse_accordion_data(cards)
+
+
 def extract_address(li_txt):
     """Extrait l'adresse à partir du texte d'un list item"""
     # extraction de l'adresse, parfois un autre séparateur est utilisé
@@ -192,11 +290,12 @@ def extract_address(li_txt):
     return adr_txt
 
 
-def parse_arretes(
-    driver: selenium.webdriver.remote.webdriver.WebDriver, url: str, outdir: str
-):
+@instrument.profiled
+def parse_arretes(driver, url: str, outdir: str, dom_walk: bool = False):
     """Extraire les descriptions et liens des arrêtés depuis la page web.
 
+    Une page inattendue (titre, structure) lève une ValueError.
+
     Parameters
     ----------
     driver : selenium.webdriver
@@ -205,24 +304,304 @@ def parse_arretes(
         URL de la page listant les arrêtés de péril
     outdir : string
         Chemin vers le dossier où seront stockés les arrêtés téléchargés.
+    dom_walk : bool
+        Si True, parcourir le DOM élément par élément plutôt qu'extraire
+        la structure des accordéons en un seul appel (`JS_ACCORDIONS`).
     """
     driver.get(url)
     # on vérifie le titre de la page
-    assert driver.title == "Arrêtés de péril | Ville de Marseille"
+    if driver.title != PAGE_TITLE:
+        raise ValueError(f"Titre de page inattendu : {driver.title!r}")
+    if dom_walk:
+        # la page contient une (unique) liste d'accordéons
+        div_accordions_wrapper = driver.find_elements_by_xpath(
+            '//div[@id="dexp-accordions-wrapper"]'
+        )
+        if len(div_accordions_wrapper) != 1:
+            raise ValueError(f"{len(div_accordions_wrapper)} listes d'accordéons")
+        div_accordions_wrapper = div_accordions_wrapper[0]
+        # on extrait les documents des 16 accordéons
+        docs = parse_accordion_list(driver, div_accordions_wrapper)
+    else:
+        page = driver.execute_script(JS_ACCORDIONS)
+        # la page contient une (unique) liste d'accordéons
+        if page["wrappers"] != 1:
+            raise ValueError(f"{page['wrappers']} listes d'accordéons")
+        # on extrait les documents des 16 accordéons
+        docs = parse_accordion_data(page["cards"])
+    # 2021-06 la classe de documents n'est plus fournie, on garde le champ pour rétro-compatibilité
+    # mais on prédira sa valeur après (voir enrich_liste_arretes)
+    res = [("?", x[0], x[1], x[2], x[3], x[4], x[5]) for x in docs]
+    return res
+
+
+# analyse du HTML sans navigateur
+def _elt_text(elt):
+    """Texte d'un élément, avec les espaces normalisés comme dans le rendu du navigateur"""
+    return " ".join(elt.text_content().split())
+
+
+def parse_accordion_list_html(elt, base_url, address_fn=None):
+    """Parse une liste d'accordéons, 1 par arrondissement, à partir du HTML.
+
+    Variante sans navigateur de `parse_accordion_list`, qui produit les
+    mêmes documents. Une structure de page inattendue lève une ValueError
+    (et non une assertion, ignorée par `python -O`).
+
+    Parameters
+    ----------
+    elt : lxml.html.HtmlElement
+        Element <div> contenant la liste d'accordéons
+    base_url : str
+        URL de la page, pour résoudre les URLs relatives des liens
+    address_fn : Callable[[str], str], optional
+        Fonction d'extraction de l'adresse, par défaut `extract_address`.
+
+    Returns
+    -------
+    docs : List[Tuple[str, str, str, str, str, str]]
+        Liste des documents: arrondissement, texte de l'item,
+        texte du lien, URL du lien, adresse, code postal.
+    """
+    if address_fn is None:
+        address_fn = extract_address
+    docs = []
+    # on itère sur des div[@class="card"]
+    for e_acc in elt.xpath('./div[@class="card"]'):
+        # div[@class="head-acc"] : bouton arrondissement
+        a_head_acc = e_acc.xpath('./div[@class="head-acc"]/a')[0]
+        nom_arr = _elt_text(a_head_acc)
+        print(nom_arr)  # suivre la progression du script
+        cp_arr = ART2CP[nom_arr]
+        # div[@class="body-acc"]/div[@class="card-body"] : liste de (voie, liste d'adresses)
+        # il y a une unique telle liste par arrondissement
+        div_body_arr = e_acc.xpath('./div/div[@class="card-body"]')
+        if len(div_body_arr) != 1:
+            raise ValueError(f"{nom_arr} : {len(div_body_arr)} listes d'adresses")
+        div_body_arr = div_body_arr[0]
+        # on récupère la liste de voies et de listes d'adresses de cette voie
+        kids_arr = div_body_arr.xpath("./*")
+        # le 1er et le dernier enfants sont des <p> supplémentaires, autour de paires
+        # successives : <p><p><ul><p><ul>...<p><ul><p>
+        if len(kids_arr) < 2 or not (
+            kids_arr[0].tag == kids_arr[1].tag == kids_arr[-1].tag == "p"
+        ):
+            raise ValueError(f"{nom_arr} : liste d'adresses inattendue")
+        # on peut supprimer ces 1er et dernier <p> qui entourent la vraie liste
+        kids_arr.pop(0)
+        kids_arr.pop(-1)
+        # on itère sur les couples (voie, liste d'adresses)
+        for p_voie, ul_voie in zip(kids_arr[:-1], kids_arr[1:]):
+            # itérer sur la liste d'adresses
+            for li_adr in ul_voie.xpath("./li"):
+                # adresse : <a>doc1</a> - <a>doc2</a> ...
+                li_txt = li_adr.text_content().strip()
+                li_txt = unicodedata.normalize("NFKC", li_txt)
+                adr_txt = address_fn(li_txt)
+                #
+                for adr_doc in li_adr.xpath("./a"):
+                    doc_title = adr_doc.text_content().strip()
+                    doc_title = unicodedata.normalize("NFKC", doc_title)
+                    doc_url = adr_doc.get("href")
+                    if doc_url is not None:
+                        doc_url = urljoin(base_url, doc_url)
+                    # arrondissement, item, texte du lien, URL du lien, adresse, code postal
+                    docs.append((nom_arr, li_txt, doc_title, doc_url, adr_txt, cp_arr))
+    return docs
+
+
+@instrument.profiled
+def fetch_page(url):
+    """Récupère le HTML de la page listant les arrêtés de péril.
+
+    Parameters
+    ----------
+    url : str
+        URL de la page
+
+    Returns
+    -------
+    html : str
+        Contenu HTML de la page
+    """
+    res = requests.get(url, timeout=TIMEOUT)
+    res.raise_for_status()
+    if "charset" not in res.headers.get("Content-Type", ""):
+        # sans indication, requests suppose que le HTML est en ISO-8859-1
+        res.encoding = "utf-8"
+    return res.text
+
+
+@instrument.profiled
+def parse_arretes_html(html, url, memo=None):
+    """Extraire les descriptions et liens des arrêtés depuis le HTML de la page.
+
+    Variante sans navigateur de `parse_arretes`, qui produit les mêmes lignes.
+    Une page inattendue (titre, structure) lève une ValueError.
+
+    Parameters
+    ----------
+    html : str
+        Contenu HTML de la page
+    url : str
+        URL de la page listant les arrêtés de péril
+    memo : cache_utils.MemoCache, optional
+        Cache mémo des adresses déjà extraites.
+
+    Returns
+    -------
+    res : List[Tuple[str, str, str, str, str, str, str]]
+        Liste des documents: classe, arrondissement, texte de l'item,
+        texte du lien, URL du lien, adresse, code postal.
+    """
+    doc = lxml.html.document_fromstring(html)
+    # on vérifie le titre de la page
+    title = " ".join((doc.findtext(".//title") or "").split())
+    if title != PAGE_TITLE:
+        raise ValueError(f"Titre de page inattendu : {title!r}")
     # la page contient une (unique) liste d'accordéons
-    div_accordions_wrapper = driver.find_elements_by_xpath(
-        '//div[@id="dexp-accordions-wrapper"]'
-    )
-    assert len(div_accordions_wrapper) == 1
+    div_accordions_wrapper = doc.xpath('//div[@id="dexp-accordions-wrapper"]')
+    if len(div_accordions_wrapper) != 1:
+        raise ValueError(f"{len(div_accordions_wrapper)} listes d'accordéons")
     div_accordions_wrapper = div_accordions_wrapper[0]
+    if not div_accordions_wrapper.xpath('./div[@class="card"]'):
+        raise ValueError("Liste d'accordéons vide")
     # on extrait les documents des 16 accordéons
-    docs = parse_accordion_list(driver, div_accordions_wrapper)
+    address_fn = None
+    if memo is not None:
+        # le cache est invalidé dès que le code de ce module change
+        address_fn = memo.wrap(
+            "extract_address", rules_version(sys.modules[__name__]), extract_address
+        )
+    docs = parse_accordion_list_html(div_accordions_wrapper, url, address_fn)
     # 2021-06 la classe de documents n'est plus fournie, on garde le champ pour rétro-compatibilité
     # mais on prédira sa valeur après (voir enrich_liste_arretes)
     res = [("?", x[0], x[1], x[2], x[3], x[4], x[5]) for x in docs]
     return res
 
 
+# archive des pages
+def _archive_index_path(archive_dir):
+    """Chemin de l'index de l'archive: date de la liste -> empreinte de la page"""
+    return os.path.join(archive_dir, "index.json")
+
+
+def load_archive_index(archive_dir):
+    """Charge l'index de l'archive des pages.
+
+    Parameters
+    ----------
+    archive_dir : str
+        Dossier de l'archive des pages
+
+    Returns
+    -------
+    index : Dict[str, dict]
+        Pour chaque date de liste (YYYY-MM-DD) : URL et empreinte SHA-256
+        de la page archivée.
+    """
+    fp_index = _archive_index_path(archive_dir)
+    if not os.path.exists(fp_index):
+        return {}
+    with open(fp_index, encoding="utf-8") as f_in:
+        return json.load(f_in)
+
+
+@instrument.profiled
+def archive_page(html, archive_dir, snapshot, url):
+    """Archive le HTML d'une page, compressé et nommé par son empreinte.
+
+    Une page identique à une page déjà archivée n'est stockée qu'une fois.
+
+    Parameters
+    ----------
+    html : str
+        Contenu HTML de la page
+    archive_dir : str
+        Dossier de l'archive des pages
+    snapshot : str
+        Date de la liste (YYYY-MM-DD)
+    url : str
+        URL de la page
+
+    Returns
+    -------
+    digest : str
+        Empreinte SHA-256 de la page
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    content = html.encode("utf-8")
+    digest = hashlib.sha256(content).hexdigest()
+    fp_page = os.path.join(archive_dir, digest + ".html.gz")
+    if not os.path.exists(fp_page):
+        with gzip.open(fp_page + ".tmp", mode="wb") as f_out:
+            f_out.write(content)
+        os.replace(fp_page + ".tmp", fp_page)
+    # on met à jour l'index
+    index = load_archive_index(archive_dir)
+    index[snapshot] = {"url": url, "sha256": digest}
+    fp_index = _archive_index_path(archive_dir)
+    with open(fp_index + ".tmp", mode="w", encoding="utf-8") as f_out:
+        json.dump(index, f_out, indent=1, sort_keys=True)
+    os.replace(fp_index + ".tmp", fp_index)
+    return digest
+
+
+def load_archived_page(archive_dir, digest):
+    """Charge le HTML d'une page archivée.
+
+    Parameters
+    ----------
+    archive_dir : str
+        Dossier de l'archive des pages
+    digest : str
+        Empreinte SHA-256 de la page
+
+    Returns
+    -------
+    html : str
+        Contenu HTML de la page
+    """
+    fp_page = os.path.join(archive_dir, digest + ".html.gz")
+    with gzip.open(fp_page, mode="rb") as f_in:
+        return f_in.read().decode("utf-8")
+
+
+@instrument.profiled
+def reparse_snapshots(archive_dir, out_dir, snapshots=None, memo=None):
+    """Reconstruit les CSV bruts à partir des pages archivées.
+
+    Parameters
+    ----------
+    archive_dir : str
+        Dossier de l'archive des pages
+    out_dir : str
+        Dossier de sortie des CSV bruts
+    snapshots : List[str], optional
+        Dates des listes à reconstruire ; si None, toutes les listes archivées.
+    memo : cache_utils.MemoCache, optional
+        Cache mémo des adresses déjà extraites.
+
+    Returns
+    -------
+    fps_out : List[str]
+        Chemins des CSV reconstruits.
+    """
+    index = load_archive_index(archive_dir)
+    if snapshots is None:
+        snapshots = sorted(index)
+    fps_out = []
+    for snapshot in snapshots:
+        entry = index[snapshot]
+        html = load_archived_page(archive_dir, entry["sha256"])
+        docs = parse_arretes_html(html, entry["url"], memo=memo)
+        fp_out = os.path.join(out_dir, f"mrs-arretes-de-peril-{snapshot}.csv")
+        dump_doc_list(docs, fp_out)
+        fps_out.append(fp_out)
+    return fps_out
+
+
+@instrument.profiled
 def dump_doc_list(docs, fn_out):
     """Exporter la liste des documents dans un fichier CSV.
 
@@ -253,17 +632,75 @@ def dump_doc_list(docs, fn_out):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--out_dir", help="Base output dir", default="data/raw")
+    parser.add_argument(
+        "--backend",
+        help="Analyse du HTML de la page (html), ou pilotage d'un navigateur (selenium)",
+        choices=["html", "selenium"],
+        default="html",
+    )
+    parser.add_argument(
+        "--dom_walk",
+        help="selenium : parcourir le DOM élément par élément (un appel par élément)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--archive_dir",
+        help="Dossier de l'archive des pages (par défaut : <out_dir>/html)",
+    )
+    parser.add_argument(
+        "--reparse",
+        help=(
+            "Reconstruire les CSV bruts à partir des pages archivées, sans accès"
+            " au site (toutes les dates si aucune n'est précisée)"
+        ),
+        nargs="*",
+        metavar="YYYY-MM-DD",
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
+    instrument.start(args, "get_liste_arretes_2021-06")
     # dossier de base pour stocker les documents téléchargés
     dl_dir = os.path.abspath(args.out_dir)
     os.makedirs(dl_dir, exist_ok=True)
-    # les arrêtés sont des PDFs
-    driver = _setup_browser(dl_dir, "application/pdf")
-    #
-    docs = parse_arretes(driver, URL, dl_dir)
-    # on ajoute la date du jour
-    today = date.today().isoformat()
-    # on écrit la liste dans un fichier CSV
-    fn_out = f"mrs-arretes-de-peril-{today}.csv"
-    fp_out = os.path.join(dl_dir, fn_out)
-    dump_doc_list(docs, fp_out)
+    # dossier de l'archive des pages
+    archive_dir = args.archive_dir or os.path.join(dl_dir, "html")
+    memo = MemoCache()
+    if args.reparse is not None:
+        # ré-analyse des pages archivées
+        for fp_out in reparse_snapshots(
+            archive_dir, dl_dir, args.reparse or None, memo=memo
+        ):
+            print(fp_out)
+    else:
+        # on ajoute la date du jour
+        today = date.today().isoformat()
+        #
+        docs = None
+        if args.backend == "html":
+            try:
+                html = fetch_page(URL)
+                docs = parse_arretes_html(html, URL, memo=memo)
+                # on n'archive que les pages analysées avec succès : le repli
+                # sur selenium archive sa propre version de la page
+                archive_page(html, archive_dir, today, URL)
+            except (
+                requests.RequestException,
+                lxml.etree.LxmlError,
+                ValueError,
+                IndexError,
+                KeyError,
+            ) as e:
+                # structure de page inattendue : on se rabat sur selenium
+                print(f"WARN: Echec de l'analyse du HTML ({e!r}), repli sur selenium")
+        if docs is None:
+            # les arrêtés sont des PDFs
+            driver = _setup_browser(dl_dir, "application/pdf")
+            #
+            docs = parse_arretes(driver, URL, dl_dir, dom_walk=args.dom_walk)
+            archive_page(driver.page_source, archive_dir, today, URL)
+        # on écrit la liste dans un fichier CSV
+        fn_out = f"mrs-arretes-de-peril-{today}.csv"
+        fp_out = os.path.join(dl_dir, fn_out)
+        dump_doc_list(docs, fp_out)
+    memo.close()
+    instrument.stop()
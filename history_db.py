@@ -0,0 +1,641 @@
+"""Base SQLite de l'historique de toutes les listes d'arrêtés.
+
+Chaque liste traitée (data/processed) est chargée une fois dans une base
+unique, où chaque document est enregistré avec les dates de la première
+et de la dernière liste où il apparaît. Les recherches par adresse, code
+postal, classe, URL ou date d'arrêté passent par des index, sans relire
+tous les fichiers.
+
+La base tient aussi à jour l'état de chaque immeuble (adresse canonique,
+voir `adresses.py`) : l'historique de ses arrêtés, par date, et son statut
+courant (arrêté en vigueur, levé partiellement, levé, abrogé), donné par
+le dernier document qui change le statut. Seuls les immeubles des listes
+nouvellement chargées sont recalculés.
+
+Utilisation :
+    python history_db.py ingest
+    python history_db.py query --adresse "55 rue d'Aubagne"
+    python history_db.py query --code_postal 13001 --date_from 2021-01-01
+    python history_db.py buildings --statut "en vigueur" --code_postal 13001
+    python history_db.py timeline --adresse "55 rue d'Aubagne"
+"""
+
+import argparse
+from datetime import datetime
+import hashlib
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+from adresses import split_adresses
+from rule_tables import composite_key
+from storage import list_snapshots, read_liste
+
+# fichier de la base
+HISTORY_DB = "data/history.sqlite"
+# dossier des listes traitées
+PROCESSED_DIR = "data/processed"
+# colonnes qui identifient un document ; "item" n'en fait pas partie car il
+# énumère tous les documents de l'immeuble, donc change à chaque ajout
+KEY_COLS = ["url", "nom_doc", "adresse"]
+# colonnes d'un document
+DOC_COLS = [
+    "url",
+    "item",
+    "nom_doc",
+    "adresse",
+    "code_postal",
+    "arrondissement",
+    "classe",
+    "date_link",
+]
+# format des dates dans les listes
+DATE_FMT = "%d/%m/%Y"
+# statut de l'immeuble après chaque classe de document ; les autres classes
+# (arrêtés modificatifs, astreintes, ordonnances...) ne le changent pas
+CLASSE_STATUT = {
+    "Arrêtés de péril grave et imminent": "en vigueur",
+    "Arrêtés de péril imminent": "en vigueur",
+    "Arrêtés de péril non imminent": "en vigueur",
+    "Arrêtés de péril ordinaire": "en vigueur",
+    "Arrêtés de péril simple": "en vigueur",
+    "Arrêtés de mise en sécurité": "en vigueur",
+    "Arrêtés de mise en sécurité urgente": "en vigueur",
+    "Arrêtés d'insécurité imminente des équipements communs": "en vigueur",
+    "Arrêtés d'interdiction d'occuper": "en vigueur",
+    "Arrêtés d'évacuation": "en vigueur",
+    "Arrêtés de déconstruction": "en vigueur",
+    "Arrêtés de police générale": "en vigueur",
+    "Arrêtés de périmètres de sécurité sur voie publique": "en vigueur",
+    "Arrêtés de mainlevée partielle": "levé partiellement",
+    "Arrêtés de réintégration partielle": "levé partiellement",
+    "Arrêtés de mainlevée": "levé",
+    "Arrêtés de réintégration": "levé",
+    "Abrogations": "abrogé",
+}
+# statuts, dans l'ordre où ils s'appliquent pour des documents du même jour
+STATUTS = ["en vigueur", "levé partiellement", "levé", "abrogé"]
+# colonnes de l'état d'un immeuble
+BUILDING_COLS = [
+    "adresse_id",
+    "adresse_canon",
+    "adresse",
+    "code_postal",
+    "statut",
+    "statut_depuis",
+    "statut_classe",
+    "n_documents",
+    "premier_arrete",
+    "dernier_arrete",
+    "last_seen",
+]
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS snapshots ("
+    " snapshot TEXT PRIMARY KEY, fp TEXT, sha256 TEXT, n_rows INTEGER,"
+    " ingested TEXT)",
+    "CREATE TABLE IF NOT EXISTS documents ("
+    " doc_id INTEGER PRIMARY KEY, doc_key TEXT UNIQUE NOT NULL, "
+    + ", ".join(f"{col} TEXT" for col in DOC_COLS)
+    + ", first_seen TEXT, last_seen TEXT)",
+    "CREATE TABLE IF NOT EXISTS sightings ("
+    " doc_id INTEGER, snapshot TEXT, PRIMARY KEY (doc_id, snapshot))"
+    " WITHOUT ROWID",
+    "CREATE INDEX IF NOT EXISTS documents_url ON documents (url)",
+    # insensible à la casse, utilisable par LIKE 'préfixe%'
+    "CREATE INDEX IF NOT EXISTS documents_adresse"
+    " ON documents (adresse COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS documents_code_postal ON documents (code_postal)",
+    "CREATE INDEX IF NOT EXISTS documents_classe ON documents (classe)",
+    "CREATE INDEX IF NOT EXISTS documents_date_link ON documents (date_link)",
+    "CREATE INDEX IF NOT EXISTS sightings_snapshot ON sightings (snapshot)",
+    # historique des immeubles : immeuble de chaque document, et statut
+    # après ce document (NULL s'il ne change pas le statut)
+    "CREATE TABLE IF NOT EXISTS building_events ("
+    " doc_id INTEGER PRIMARY KEY, adresse_id TEXT NOT NULL, date_link TEXT,"
+    " classe TEXT, statut TEXT)",
+    "CREATE INDEX IF NOT EXISTS building_events_adresse_id"
+    " ON building_events (adresse_id, date_link)",
+    # état courant de chaque immeuble
+    "CREATE TABLE IF NOT EXISTS buildings ("
+    " adresse_id TEXT PRIMARY KEY, adresse_canon TEXT, adresse TEXT,"
+    " code_postal TEXT, statut TEXT, statut_depuis TEXT, statut_classe TEXT,"
+    " n_documents INTEGER, premier_arrete TEXT, dernier_arrete TEXT,"
+    " last_seen TEXT)",
+    "CREATE INDEX IF NOT EXISTS buildings_statut ON buildings (statut, code_postal)",
+    "CREATE INDEX IF NOT EXISTS buildings_adresse_canon ON buildings (adresse_canon)",
+]
+
+
+def connect(fp_db=HISTORY_DB):
+    """Ouvre la base de l'historique, en la créant si besoin.
+
+    Parameters
+    ----------
+    fp_db : str
+        Chemin du fichier SQLite
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connexion à la base
+    """
+    if os.path.dirname(fp_db):
+        os.makedirs(os.path.dirname(fp_db), exist_ok=True)
+    conn = sqlite3.connect(fp_db)
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    conn.commit()
+    return conn
+
+
+def _file_sha256(fp):
+    """Empreinte SHA-256 d'un fichier"""
+    h = hashlib.sha256()
+    with open(fp, mode="rb") as f_in:
+        for chunk in iter(lambda: f_in.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def ingest_snapshot(conn, snapshot, fp):
+    """Charge une liste traitée dans la base.
+
+    Les attributs d'un document déjà connu sont mis à jour si la liste est
+    plus récente que la dernière où il a été vu.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    snapshot : str
+        Date de la liste (AAAA-MM-JJ)
+    fp : Path
+        Fichier de la liste
+
+    Returns
+    -------
+    n_docs : int
+        Nombre de documents distincts de la liste
+    """
+    df = read_liste(fp)
+    df = df.reindex(columns=DOC_COLS)
+    # dates au format ISO, pour les comparaisons et l'index
+    df["date_link"] = pd.to_datetime(
+        df["date_link"], format=DATE_FMT, errors="coerce"
+    ).dt.strftime("%Y-%m-%d")
+    df["doc_key"] = composite_key(*(df[col].fillna("") for col in KEY_COLS))
+    df = df.drop_duplicates(subset="doc_key")
+    df = df.astype(object).where(df.notna(), None)
+    #
+    cols = ["doc_key"] + DOC_COLS + ["first_seen", "last_seen"]
+    updates = ", ".join(
+        f"{col} = CASE WHEN excluded.last_seen >= documents.last_seen"
+        f" THEN excluded.{col} ELSE documents.{col} END"
+        for col in DOC_COLS
+    )
+    with conn:
+        conn.executemany(
+            f"INSERT INTO documents ({', '.join(cols)})"
+            f" VALUES ({', '.join('?' * len(cols))})"
+            f" ON CONFLICT (doc_key) DO UPDATE SET {updates},"
+            " first_seen = min(documents.first_seen, excluded.first_seen),"
+            " last_seen = max(documents.last_seen, excluded.last_seen)",
+            [
+                [row.doc_key] + [getattr(row, col) for col in DOC_COLS] + [snapshot] * 2
+                for row in df.itertuples(index=False)
+            ],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO sightings"
+            " SELECT doc_id, ? FROM documents WHERE doc_key = ?",
+            [(snapshot, doc_key) for doc_key in df["doc_key"]],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)",
+            (
+                snapshot,
+                str(fp),
+                _file_sha256(fp),
+                len(df),
+                datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+    return len(df)
+
+
+def ingest(conn, data_dir=PROCESSED_DIR, rebuild=False):
+    """Charge dans la base les listes traitées qui n'y sont pas encore.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    data_dir : str
+        Dossier des listes traitées
+    rebuild : bool
+        Si True, vide la base et recharge toutes les listes.
+
+    Returns
+    -------
+    ingested : List[str]
+        Dates des listes chargées
+    """
+    if rebuild:
+        with conn:
+            for table in (
+                "buildings",
+                "building_events",
+                "sightings",
+                "documents",
+                "snapshots",
+            ):
+                conn.execute(f"DELETE FROM {table}")
+    known = dict(conn.execute("SELECT snapshot, sha256 FROM snapshots"))
+    ingested = []
+    for snapshot, fp in list_snapshots(data_dir).items():
+        if snapshot in known:
+            if known[snapshot] != _file_sha256(fp):
+                print(
+                    f"WARN: {fp} a changé depuis son chargement, relancer avec --rebuild"
+                )
+            continue
+        n_docs = ingest_snapshot(conn, snapshot, fp)
+        print(f"{snapshot} : {n_docs} documents")
+        ingested.append(snapshot)
+    if ingested:
+        n_buildings = refresh_buildings(conn, snapshots=ingested)
+        print(f"{n_buildings} immeubles mis à jour")
+    return ingested
+
+
+def building_status(df_events):
+    """Calcule l'état de chaque immeuble à partir de l'historique de ses documents.
+
+    Parameters
+    ----------
+    df_events : DataFrame
+        Documents de chaque immeuble : adresse_id, adresse_canon, adresse,
+        code_postal, date_link (AAAA-MM-JJ), classe, statut (après le
+        document, manquant s'il ne change pas le statut), first_seen,
+        last_seen.
+
+    Returns
+    -------
+    df_buildings : DataFrame
+        Etat de chaque immeuble (voir `BUILDING_COLS`) : le statut est
+        celui du dernier document daté qui change le statut, manquant si
+        aucun document ne le change.
+    """
+    df_events = df_events.astype("string")
+    # adresse, code postal : ceux du document le plus récent
+    df_last = df_events.sort_values(
+        ["date_link", "first_seen"], na_position="first", kind="stable"
+    )
+    df_buildings = df_last.groupby("adresse_id").agg(
+        adresse_canon=("adresse_canon", "last"),
+        adresse=("adresse", "last"),
+        code_postal=("code_postal", "last"),
+        n_documents=("adresse_id", "size"),
+        premier_arrete=("date_link", "min"),
+        dernier_arrete=("date_link", "max"),
+        last_seen=("last_seen", "max"),
+    )
+    # statut : dernier document daté qui change le statut ; le même jour,
+    # une mainlevée l'emporte sur l'arrêté
+    df_statut = df_events.dropna(subset=["statut", "date_link"]).assign(
+        rang=lambda df: df["statut"].map(STATUTS.index)
+    )
+    df_statut = (
+        df_statut.sort_values(["date_link", "rang"], kind="stable")
+        .groupby("adresse_id")
+        .last()[["statut", "date_link", "classe"]]
+        .rename(columns={"date_link": "statut_depuis", "classe": "statut_classe"})
+    )
+    df_buildings = df_buildings.join(df_statut)
+    return df_buildings.reset_index()[BUILDING_COLS]
+
+
+def refresh_buildings(conn, snapshots=None):
+    """Met à jour l'historique et l'état des immeubles.
+
+    Seuls les immeubles dont un document est nouveau, ou a changé
+    d'adresse, de classe ou de date, sont recalculés, à partir de tous leurs
+    documents ; pour les autres immeubles des listes chargées, seule la date
+    de dernière apparition est mise à jour. Un immeuble qui n'a plus aucun
+    document est supprimé.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    snapshots : List[str], optional
+        Dates des listes chargées depuis la dernière mise à jour ; par
+        défaut, toutes les listes (recalcul complet).
+
+    Returns
+    -------
+    n_buildings : int
+        Nombre d'immeubles recalculés
+    """
+    # documents des listes chargées, et leur immeuble actuel
+    sql = (
+        "SELECT d.doc_id, d.adresse, d.classe, d.date_link,"
+        " e.adresse_id AS old_adresse_id, e.classe AS old_classe,"
+        " e.date_link AS old_date_link"
+        " FROM documents d LEFT JOIN building_events e USING (doc_id)"
+    )
+    params = []
+    if snapshots is not None:
+        sql += (
+            " WHERE d.doc_id IN (SELECT doc_id FROM sightings WHERE snapshot IN"
+            f" ({', '.join('?' * len(snapshots))}))"
+        )
+        params = list(snapshots)
+    df_docs = pd.read_sql_query(sql, conn, params=params)
+    df_docs["adresse_id"] = split_adresses(df_docs["adresse"])["adresse_id"]
+    if snapshots is not None:
+        # documents nouveaux ou modifiés (valeurs manquantes comprises)
+        changed = pd.Series(False, index=df_docs.index)
+        for col in ("adresse_id", "classe", "date_link"):
+            s_new = df_docs[col].astype("string")
+            s_old = df_docs["old_" + col].astype("string")
+            changed |= (s_new != s_old).fillna(s_new.isna() != s_old.isna())
+        df_docs = df_docs[changed]
+    # documents sans adresse reconnue : rattachés à aucun immeuble
+    no_adr = df_docs["adresse_id"].isna()
+    df_gone = df_docs[no_adr & df_docs["old_adresse_id"].notna()]
+    df_docs = df_docs[~no_adr].assign(statut=lambda df: df["classe"].map(CLASSE_STATUT))
+    df_docs = df_docs.astype(object).where(df_docs.notna(), None)
+    with conn:
+        if snapshots is None:
+            # recalcul complet : on repart de zéro, sans immeuble ni document
+            # disparu (base reconstruite, adresse corrigée)
+            conn.execute("DELETE FROM building_events")
+            conn.execute("DELETE FROM buildings")
+        conn.executemany(
+            "DELETE FROM building_events WHERE doc_id = ?",
+            [(doc_id,) for doc_id in df_gone["doc_id"]],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO building_events"
+            " (doc_id, adresse_id, date_link, classe, statut) VALUES (?, ?, ?, ?, ?)",
+            df_docs[
+                ["doc_id", "adresse_id", "date_link", "classe", "statut"]
+            ].itertuples(index=False),
+        )
+        if snapshots is not None:
+            # immeubles inchangés : date de dernière apparition
+            conn.execute(
+                "UPDATE buildings SET last_seen = ("
+                " SELECT max(d.last_seen) FROM building_events e"
+                " JOIN documents d USING (doc_id)"
+                " WHERE e.adresse_id = buildings.adresse_id)"
+                " WHERE adresse_id IN (SELECT e.adresse_id FROM building_events e"
+                " JOIN sightings s USING (doc_id) WHERE s.snapshot IN"
+                f" ({', '.join('?' * len(snapshots))}))",
+                list(snapshots),
+            )
+        # immeubles à recalculer : ceux des documents modifiés, avant et après
+        touched = set(df_docs["adresse_id"]) | set(
+            pd.concat([df_docs["old_adresse_id"], df_gone["old_adresse_id"]]).dropna()
+        )
+        if not touched:
+            return 0
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched (adresse_id TEXT)")
+        conn.execute("DELETE FROM touched")
+        conn.executemany(
+            "INSERT INTO touched VALUES (?)", [(adr_id,) for adr_id in touched]
+        )
+        # immeubles qui n'ont plus de document
+        conn.execute(
+            "DELETE FROM buildings WHERE adresse_id IN (SELECT adresse_id FROM touched)"
+            " AND adresse_id NOT IN (SELECT adresse_id FROM building_events)"
+        )
+        df_events = pd.read_sql_query(
+            "SELECT e.adresse_id, e.date_link, e.classe, e.statut, d.adresse,"
+            " d.code_postal, d.first_seen, d.last_seen"
+            " FROM building_events e JOIN documents d USING (doc_id)"
+            " WHERE e.adresse_id IN (SELECT adresse_id FROM touched)"
+            " ORDER BY e.doc_id",
+            conn,
+        )
+        if df_events.empty:
+            return 0
+        df_events["adresse_canon"] = split_adresses(df_events["adresse"])[
+            "adresse_canon"
+        ]
+        df_buildings = building_status(df_events)
+        df_buildings = df_buildings.astype(object).where(df_buildings.notna(), None)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO buildings ({', '.join(BUILDING_COLS)})"
+            f" VALUES ({', '.join('?' * len(BUILDING_COLS))})",
+            df_buildings.itertuples(index=False),
+        )
+    return len(df_buildings)
+
+
+def _adresse_id(adresse):
+    """Identifiant de l'adresse canonique d'une adresse"""
+    return split_adresses(pd.Series([adresse], dtype="string"))["adresse_id"].iloc[0]
+
+
+def query_buildings(conn, adresse=None, code_postal=None, statut=None):
+    """Etat courant des immeubles, lu dans la base sans recalcul.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    adresse : str, optional
+        Adresse, quelle que soit son écriture ("60a Rue d Aubagne" ou
+        "60 A rue d'Aubagne")
+    code_postal : str, optional
+        Code postal
+    statut : str, optional
+        Statut : "en vigueur", "levé partiellement", "levé" ou "abrogé"
+
+    Returns
+    -------
+    df : DataFrame
+        Etat de chaque immeuble, par adresse canonique
+    """
+    where = []
+    params = []
+    if adresse is not None:
+        where.append("adresse_id = ?")
+        params.append(_adresse_id(adresse))
+    for col, value in (("code_postal", code_postal), ("statut", statut)):
+        if value is not None:
+            where.append(f"{col} = ?")
+            params.append(value)
+    sql = f"SELECT {', '.join(BUILDING_COLS)} FROM buildings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY code_postal, adresse_canon"
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+def building_timeline(conn, adresse):
+    """Historique des documents d'un immeuble, par date.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    adresse : str
+        Adresse de l'immeuble, quelle que soit son écriture
+
+    Returns
+    -------
+    df : DataFrame
+        Documents de l'immeuble, avec le statut après chaque document
+    """
+    return pd.read_sql_query(
+        "SELECT e.date_link, e.classe, e.statut, d.nom_doc, d.adresse, d.url,"
+        " d.first_seen, d.last_seen"
+        " FROM building_events e JOIN documents d USING (doc_id)"
+        " WHERE e.adresse_id = ? ORDER BY e.date_link, d.first_seen",
+        conn,
+        params=[_adresse_id(adresse)],
+    )
+
+
+def query_documents(
+    conn,
+    adresse=None,
+    code_postal=None,
+    classe=None,
+    url=None,
+    date_from=None,
+    date_to=None,
+    seen_on=None,
+):
+    """Recherche des documents dans l'historique.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à la base
+    adresse : str, optional
+        Adresse, sans distinction de casse ; peut contenir des jokers "%"
+        (p. ex. "55 rue d'Aubagne%").
+    code_postal : str, optional
+        Code postal
+    classe : str, optional
+        Classe du document
+    url : str, optional
+        URL du document
+    date_from, date_to : str, optional
+        Bornes (AAAA-MM-JJ, incluses) de la date de l'arrêté
+    seen_on : str, optional
+        Date (AAAA-MM-JJ) : documents présents dans la dernière liste
+        publiée à cette date.
+
+    Returns
+    -------
+    df : DataFrame
+        Documents trouvés, avec les dates de première et dernière
+        apparition, par adresse et date d'arrêté.
+    """
+    where = []
+    params = []
+    if adresse is not None:
+        op = "LIKE" if "%" in adresse else "="
+        where.append(f"adresse {op} ? COLLATE NOCASE")
+        params.append(adresse)
+    for col, value in (("code_postal", code_postal), ("classe", classe), ("url", url)):
+        if value is not None:
+            where.append(f"{col} = ?")
+            params.append(value)
+    if date_from is not None:
+        where.append("date_link >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        where.append("date_link <= ?")
+        params.append(date_to)
+    if seen_on is not None:
+        where.append(
+            "doc_id IN (SELECT doc_id FROM sightings WHERE snapshot ="
+            " (SELECT max(snapshot) FROM snapshots WHERE snapshot <= ?))"
+        )
+        params.append(seen_on)
+    sql = f"SELECT {', '.join(DOC_COLS)}, first_seen, last_seen FROM documents"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY adresse, date_link, first_seen"
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="Fichier de la base", default=HISTORY_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    # chargement
+    parser_ingest = subparsers.add_parser(
+        "ingest", help="Charger les listes traitées dans la base"
+    )
+    parser_ingest.add_argument(
+        "--data_dir", help="Dossier des listes traitées", default=PROCESSED_DIR
+    )
+    parser_ingest.add_argument(
+        "--rebuild", help="Vider la base et tout recharger", action="store_true"
+    )
+    # recherche
+    parser_query = subparsers.add_parser(
+        "query", help="Rechercher des documents, résultat en CSV"
+    )
+    parser_query.add_argument("--adresse", help="Adresse (jokers : %%)")
+    parser_query.add_argument("--code_postal", help="Code postal")
+    parser_query.add_argument("--classe", help="Classe du document")
+    parser_query.add_argument("--url", help="URL du document")
+    parser_query.add_argument("--date_from", help="Date d'arrêté minimale (AAAA-MM-JJ)")
+    parser_query.add_argument("--date_to", help="Date d'arrêté maximale (AAAA-MM-JJ)")
+    parser_query.add_argument(
+        "--seen_on", help="Documents présents dans la liste à cette date (AAAA-MM-JJ)"
+    )
+    # immeubles
+    parser_buildings = subparsers.add_parser(
+        "buildings", help="Etat courant des immeubles, résultat en CSV"
+    )
+    parser_buildings.add_argument("--adresse", help="Adresse de l'immeuble")
+    parser_buildings.add_argument("--code_postal", help="Code postal")
+    parser_buildings.add_argument("--statut", help="Statut", choices=STATUTS)
+    parser_buildings.add_argument(
+        "--refresh", help="Recalculer l'état de tous les immeubles", action="store_true"
+    )
+    parser_timeline = subparsers.add_parser(
+        "timeline", help="Historique des arrêtés d'un immeuble, résultat en CSV"
+    )
+    parser_timeline.add_argument(
+        "--adresse", help="Adresse de l'immeuble", required=True
+    )
+    args = parser.parse_args()
+    #
+    conn = connect(args.db)
+    if args.command == "ingest":
+        ingest(conn, data_dir=args.data_dir, rebuild=args.rebuild)
+    elif args.command == "buildings":
+        if args.refresh:
+            refresh_buildings(conn)
+        df = query_buildings(
+            conn, adresse=args.adresse, code_postal=args.code_postal, statut=args.statut
+        )
+        df.to_csv(sys.stdout, index=False)
+    elif args.command == "timeline":
+        building_timeline(conn, args.adresse).to_csv(sys.stdout, index=False)
+    else:
+        df = query_documents(
+            conn,
+            adresse=args.adresse,
+            code_postal=args.code_postal,
+            classe=args.classe,
+            url=args.url,
+            date_from=args.date_from,
+            date_to=args.date_to,
+            seen_on=args.seen_on,
+        )
+        df.to_csv(sys.stdout, index=False)
+    conn.close()
@@ -0,0 +1,278 @@
+"""Index plein texte (SQLite FTS5) des arrêtés.
+
+L'index est construit à partir des textes extraits des documents (fichiers
+"_text" produits par extract_text_arretes.py) et des listes traitées, pour
+rattacher chaque document à ses URL et à leur adresse, code postal et
+classe. Il est mis à jour de façon incrémentale : seuls les documents dont
+l'empreinte SHA-256 est nouvelle sont ajoutés.
+
+Les résultats d'une recherche sont rattachés aux lignes des listes traitées
+par la colonne `url`.
+
+Utilisation :
+    python index_arretes.py update
+    python index_arretes.py search "mise en sécurité urgente + cage d'escalier" \
+        --code_postal 13003
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+import instrument
+from storage import list_snapshots, read_liste
+
+# fichier de l'index
+INDEX_DB = "data/index.sqlite"
+# dossier des listes traitées et des textes
+PROCESSED_DIR = "data/processed"
+# fin du nom des fichiers de textes
+TEXT_SUFFIX = "_text"
+# colonnes des listes traitées gardées pour filtrer les recherches
+META_COLS = ["adresse", "code_postal", "classe"]
+# nombre maximal de résultats par défaut
+LIMIT = 50
+
+SCHEMA = [
+    # un document par contenu ; son rowid est celui de son texte dans l'index
+    "CREATE TABLE IF NOT EXISTS docs ("
+    " rowid INTEGER PRIMARY KEY, sha256 TEXT UNIQUE NOT NULL)",
+    # recherche insensible à la casse et aux accents
+    "CREATE VIRTUAL TABLE IF NOT EXISTS textes USING fts5("
+    " texte, tokenize = 'unicode61 remove_diacritics 2')",
+    # URL des documents, avec les colonnes de la dernière liste où elles sont
+    "CREATE TABLE IF NOT EXISTS urls ("
+    " url TEXT PRIMARY KEY, sha256 TEXT, adresse TEXT, code_postal TEXT,"
+    " classe TEXT, snapshot TEXT)",
+    "CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256)",
+    "CREATE INDEX IF NOT EXISTS urls_code_postal ON urls (code_postal)",
+    "CREATE INDEX IF NOT EXISTS urls_classe ON urls (classe)",
+    # fichiers de textes déjà indexés, avec leur date de modification
+    "CREATE TABLE IF NOT EXISTS snapshots (snapshot TEXT PRIMARY KEY, mtime REAL)",
+]
+
+
+def connect(fp_db=INDEX_DB):
+    """Ouvre l'index, en le créant si besoin.
+
+    Parameters
+    ----------
+    fp_db : str
+        Chemin du fichier SQLite
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connexion à l'index
+    """
+    if os.path.dirname(fp_db):
+        os.makedirs(os.path.dirname(fp_db), exist_ok=True)
+    conn = sqlite3.connect(fp_db)
+    for stmt in SCHEMA:
+        conn.execute(stmt)
+    conn.commit()
+    return conn
+
+
+@instrument.profiled
+def index_texts(conn, df_text, df_liste, snapshot, mtime=None):
+    """Ajoute à l'index les textes d'une liste.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à l'index
+    df_text : DataFrame
+        Textes des documents : url, sha256, texte
+    df_liste : DataFrame
+        Liste traitée des documents
+    snapshot : str
+        Date de la liste (AAAA-MM-JJ)
+    mtime : float, optional
+        Date de modification du fichier des textes
+
+    Returns
+    -------
+    n_new : int
+        Nombre de nouveaux documents indexés
+    """
+    df_text = df_text.dropna(subset=["sha256", "texte"])
+    known = {row[0] for row in conn.execute("SELECT sha256 FROM docs")}
+    df_new = df_text[~df_text["sha256"].isin(known)].drop_duplicates("sha256")
+    # colonnes de la liste, par URL
+    df_meta = (
+        df_liste.dropna(subset=["url"])
+        .drop_duplicates("url")
+        .set_index("url")
+        .reindex(columns=META_COLS)
+    )
+    df_urls = df_text[["url", "sha256"]].join(df_meta, on="url")
+    df_urls = df_urls.astype(object).where(df_urls.notna(), None)
+    with conn:
+        for digest, texte in zip(df_new["sha256"], df_new["texte"]):
+            rowid = conn.execute(
+                "INSERT INTO docs (sha256) VALUES (?)", (digest,)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO textes (rowid, texte) VALUES (?, ?)", (rowid, texte)
+            )
+        # une URL prend les colonnes de la liste la plus récente
+        conn.executemany(
+            "INSERT INTO urls VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO UPDATE"
+            " SET sha256 = excluded.sha256, adresse = excluded.adresse,"
+            " code_postal = excluded.code_postal, classe = excluded.classe,"
+            " snapshot = excluded.snapshot WHERE excluded.snapshot >= urls.snapshot",
+            [
+                (
+                    row.url,
+                    row.sha256,
+                    row.adresse,
+                    row.code_postal,
+                    row.classe,
+                    snapshot,
+                )
+                for row in df_urls.itertuples(index=False)
+            ],
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?)", (snapshot, mtime)
+        )
+    return len(df_new)
+
+
+def update(conn, processed_dir=PROCESSED_DIR):
+    """Indexe les textes des listes traitées, nouveaux ou modifiés.
+
+    Un fichier de textes déjà indexé n'est relu que s'il a été modifié
+    depuis (p. ex. extraction relancée après de nouveaux téléchargements).
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à l'index
+    processed_dir : str
+        Dossier des listes traitées et des textes
+
+    Returns
+    -------
+    indexed : List[str]
+        Dates des listes (re)lues
+    """
+    done = dict(conn.execute("SELECT snapshot, mtime FROM snapshots"))
+    fps_liste = list_snapshots(processed_dir)
+    indexed = []
+    for snapshot, fp_text in list_snapshots(processed_dir, suffix=TEXT_SUFFIX).items():
+        mtime = os.path.getmtime(fp_text)
+        if done.get(snapshot) == mtime or snapshot not in fps_liste:
+            continue
+        n_new = index_texts(
+            conn,
+            read_liste(fp_text, columns=["url", "sha256", "texte"]),
+            read_liste(fps_liste[snapshot]),
+            snapshot,
+            mtime=mtime,
+        )
+        print(f"{snapshot} : {n_new} nouveaux documents")
+        indexed.append(snapshot)
+    return indexed
+
+
+def to_fts_query(query):
+    """Traduit une recherche simple en requête FTS5.
+
+    Les expressions séparées par "+" doivent toutes figurer dans le texte,
+    chacune telle quelle (mots consécutifs), p. ex. :
+    "mise en sécurité urgente + cage d'escalier".
+    """
+    phrases = [phrase.strip() for phrase in query.split("+") if phrase.strip()]
+    return " AND ".join('"' + phrase.replace('"', '""') + '"' for phrase in phrases)
+
+
+def search(conn, query, code_postal=None, classe=None, limit=LIMIT, raw=False):
+    """Recherche des documents par leur texte.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connexion à l'index
+    query : str
+        Expressions recherchées, séparées par "+" (voir `to_fts_query`), ou
+        requête FTS5 si `raw`
+    code_postal : str, optional
+        Code postal des documents
+    classe : str, optional
+        Classe des documents
+    limit : int
+        Nombre maximal de résultats
+    raw : bool
+        Si True, `query` est une requête FTS5 (opérateurs AND, OR, NOT, NEAR...)
+
+    Returns
+    -------
+    df : DataFrame
+        URL des documents trouvés, avec adresse, code postal, classe et un
+        extrait du texte, du plus pertinent au moins pertinent.
+    """
+    where = ["textes MATCH ?"]
+    params = [query if raw else to_fts_query(query)]
+    for col, value in (("code_postal", code_postal), ("classe", classe)):
+        if value is not None:
+            where.append(f"urls.{col} = ?")
+            params.append(value)
+    sql = (
+        "SELECT urls.url, urls.adresse, urls.code_postal, urls.classe,"
+        " snippet(textes, 0, '[', ']', '…', 16) AS extrait, bm25(textes) AS score"
+        " FROM textes JOIN docs ON docs.rowid = textes.rowid"
+        " JOIN urls ON urls.sha256 = docs.sha256"
+        f" WHERE {' AND '.join(where)} ORDER BY score LIMIT ?"
+    )
+    return pd.read_sql_query(sql, conn, params=params + [limit])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", help="Fichier de l'index", default=INDEX_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    # mise à jour
+    parser_update = subparsers.add_parser(
+        "update", help="Indexer les textes des nouvelles listes traitées"
+    )
+    parser_update.add_argument(
+        "--processed_dir",
+        help="Dossier des listes traitées et des textes",
+        default=PROCESSED_DIR,
+    )
+    # recherche
+    parser_search = subparsers.add_parser(
+        "search", help="Rechercher des documents, résultat en CSV"
+    )
+    parser_search.add_argument(
+        "query", help="Expressions recherchées, séparées par '+'"
+    )
+    parser_search.add_argument("--code_postal", help="Code postal")
+    parser_search.add_argument("--classe", help="Classe du document")
+    parser_search.add_argument(
+        "--limit", help="Nombre maximal de résultats", type=int, default=LIMIT
+    )
+    parser_search.add_argument(
+        "--raw", help="La recherche est une requête FTS5", action="store_true"
+    )
+    args = parser.parse_args()
+    #
+    conn = connect(args.db)
+    if args.command == "update":
+        update(conn, processed_dir=args.processed_dir)
+    else:
+        df = search(
+            conn,
+            args.query,
+            code_postal=args.code_postal,
+            classe=args.classe,
+            limit=args.limit,
+            raw=args.raw,
+        )
+        df.to_csv(sys.stdout, index=False)
+    conn.close()
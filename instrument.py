@@ -0,0 +1,375 @@
+"""Mesures des étapes de traitement : temps, mémoire, lignes, règles appliquées.
+
+Désactivées par défaut, les mesures sont activées par l'option `--profile`
+des scripts. Pour chaque étape ou fonction instrumentée, on enregistre le
+nombre d'appels, le temps écoulé et le temps CPU, le pic de mémoire (RSS)
+et les nombres de lignes en entrée et en sortie ; pour chaque table de
+règles (corrections manuelles), le nombre de lignes concernées et modifiées.
+Chaque exécution produit un rapport JSON, complété si on le demande par un
+profil cProfile ou pyinstrument.
+
+Utilisation dans un script :
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args, "fix_liste_arretes")
+    ...
+    instrument.stop()
+
+Les mesures faites dans les processus d'un pool (fork) sont perdues si on
+ne les renvoie pas au processus principal : le pool est créé avec
+l'initialisation `init_worker`, chaque tâche renvoie ses mesures
+(`take_records`) avec son résultat, et le processus principal les ajoute à
+son rapport (`merge_records`).
+"""
+
+import atexit
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import io
+import json
+import os
+from pathlib import Path
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+# dossier des rapports
+PROFILE_DIR = ".cache/profile"
+# profileurs disponibles
+CAPTURES = ["cprofile", "pyinstrument"]
+# nombre de fonctions gardées dans le rapport, pour le profil cProfile
+CPROFILE_TOP = 30
+
+# rapport de l'exécution en cours (None : mesures désactivées)
+_report = None
+# pile des étapes en cours
+_stack = []
+# profileur en cours
+_profiler = None
+
+
+def enabled():
+    """True si les mesures sont activées"""
+    return _report is not None
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus depuis son lancement, en Mio"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sous macOS, en kibioctets sous Linux
+    if sys.platform == "darwin":
+        return max_rss / 2**20
+    return max_rss / 2**10
+
+
+def _len(obj):
+    """Nombre de lignes d'un objet (DataFrame, Series, liste...), ou None"""
+    if obj is None or isinstance(obj, (str, bytes)):
+        return None
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def add_arguments(parser):
+    """Ajoute les options de mesure à l'analyseur d'arguments d'un script"""
+    parser.add_argument(
+        "--profile",
+        help="Mesurer les étapes et écrire un rapport JSON",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile_dir", help="Dossier des rapports de mesure", default=PROFILE_DIR
+    )
+    parser.add_argument(
+        "--profile_capture",
+        help="Profil détaillé des appels de fonctions, joint au rapport",
+        choices=CAPTURES,
+    )
+
+
+def start(args, script):
+    """Active les mesures si le script est lancé avec `--profile`.
+
+    Le rapport est écrit par `stop`, ou à la sortie du programme si le script
+    s'interrompt avant (exception) : c'est souvent l'exécution qu'on voulait
+    mesurer.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Arguments du script (voir `add_arguments`)
+    script : str
+        Nom du script
+    """
+    global _report, _profiler
+    if not args.profile:
+        return
+    _report = {
+        "script": script,
+        "argv": sys.argv[1:],
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "profile_dir": args.profile_dir,
+        "stages": {},
+        "rule_tables": [],
+        "_t0": (time.perf_counter(), time.process_time()),
+    }
+    # sans effet si le script a appelé `stop`
+    atexit.register(stop)
+    if args.profile_capture == "cprofile":
+        import cProfile
+
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif args.profile_capture == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            print("WARN: pyinstrument n'est pas installé, pas de profil détaillé")
+        else:
+            _profiler = pyinstrument.Profiler()
+            _profiler.start()
+
+
+def _stage_record(path):
+    """Enregistrement d'une étape dans le rapport, créé au 1er appel"""
+    return _report["stages"].setdefault(
+        path,
+        {
+            "calls": 0,
+            "wall_s": 0.0,
+            "cpu_s": 0.0,
+            "rss_peak_mb": None,
+            "rss_growth_mb": 0.0,
+            "rows_in": None,
+            "rows_out": None,
+        },
+    )
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """Mesure une étape (bloc `with`), imbriquée dans les étapes en cours.
+
+    Parameters
+    ----------
+    name : str
+        Nom de l'étape
+    rows_in : int, optional
+        Nombre de lignes en entrée
+
+    Yields
+    ------
+    rows : Dict[str, int]
+        Nombres de lignes en entrée ("rows_in") et en sortie ("rows_out"),
+        que le bloc peut renseigner.
+    """
+    rows = {"rows_in": rows_in, "rows_out": None}
+    if not enabled():
+        yield rows
+        return
+    _stack.append(name)
+    rss0 = peak_rss_mb()
+    t0_wall, t0_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield rows
+    finally:
+        rec = _stage_record("/".join(_stack))
+        _stack.pop()
+        rec["calls"] += 1
+        rec["wall_s"] += time.perf_counter() - t0_wall
+        rec["cpu_s"] += time.process_time() - t0_cpu
+        rss = peak_rss_mb()
+        if rss is not None:
+            rec["rss_peak_mb"] = rss
+            rec["rss_growth_mb"] += rss - rss0
+        for key, value in rows.items():
+            if value is not None:
+                rec[key] = (rec[key] or 0) + value
+
+
+def profiled(func):
+    """Décorateur : mesure chaque appel d'une fonction comme une étape.
+
+    Les lignes en entrée sont celles du 1er argument, les lignes en sortie
+    celles du résultat, quand ce sont des tableaux ou des listes.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+        with stage(func.__name__, rows_in=_len(args[0]) if args else None) as rows:
+            result = func(*args, **kwargs)
+            rows["rows_out"] = _len(result)
+        return result
+
+    return wrapper
+
+
+def record_rule_table(name, col, n_rules, n_matched, n_changed, n_unused):
+    """Enregistre l'application d'une table de règles à une colonne.
+
+    Parameters
+    ----------
+    name : str
+        Nom de la table
+    col : str
+        Colonne corrigée
+    n_rules : int
+        Nombre de règles de la table
+    n_matched : int
+        Nombre de lignes concernées par une règle
+    n_changed : int
+        Nombre de lignes dont la valeur a effectivement changé
+    n_unused : int
+        Nombre de règles qui ne s'appliquent à aucune ligne
+    """
+    if not enabled():
+        return
+    _report["rule_tables"].append(
+        {
+            "stage": "/".join(_stack),
+            "name": name,
+            "col": col,
+            "rules": n_rules,
+            "rows_matched": n_matched,
+            "rows_changed": n_changed,
+            "rules_unused": n_unused,
+        }
+    )
+
+
+def init_worker():
+    """Initialise les mesures d'un processus d'un pool.
+
+    Le processus hérite (fork) du rapport du processus principal : ses
+    mesures déjà faites sont oubliées, pour ne pas être comptées deux fois,
+    et le profil détaillé est arrêté. Les étapes en cours du processus
+    principal restent le préfixe des étapes du processus.
+    """
+    global _profiler
+    if not enabled():
+        return
+    if _profiler is not None and hasattr(_profiler, "disable"):
+        _profiler.disable()
+    _profiler = None
+    _report["stages"] = {}
+    _report["rule_tables"] = []
+
+
+def take_records():
+    """Retire du rapport les mesures faites jusqu'ici, et les renvoie.
+
+    Returns
+    -------
+    records : dict or None
+        Mesures des étapes ("stages") et des tables de règles
+        ("rule_tables"), à passer à `merge_records` ; None si les mesures
+        sont désactivées.
+    """
+    if not enabled():
+        return None
+    records = {"stages": _report["stages"], "rule_tables": _report["rule_tables"]}
+    _report["stages"] = {}
+    _report["rule_tables"] = []
+    return records
+
+
+def merge_records(records):
+    """Ajoute au rapport les mesures renvoyées par `take_records`.
+
+    Parameters
+    ----------
+    records : dict or None
+        Mesures d'un processus d'un pool
+    """
+    if not enabled() or records is None:
+        return
+    for path, rec_in in records["stages"].items():
+        rec = _stage_record(path)
+        for key in ["calls", "wall_s", "cpu_s", "rss_growth_mb"]:
+            rec[key] += rec_in[key]
+        if rec_in["rss_peak_mb"] is not None:
+            rec["rss_peak_mb"] = max(rec["rss_peak_mb"] or 0, rec_in["rss_peak_mb"])
+        for key in ["rows_in", "rows_out"]:
+            if rec_in[key] is not None:
+                rec[key] = (rec[key] or 0) + rec_in[key]
+    _report["rule_tables"].extend(records["rule_tables"])
+
+
+def _capture_profile(report, fp_base):
+    """Arrête le profileur détaillé et joint son résultat au rapport"""
+    global _profiler
+    if _profiler is None:
+        return
+    if hasattr(_profiler, "disable"):
+        # cProfile : fichier .prof complet, et les fonctions les plus coûteuses
+        import pstats
+
+        _profiler.disable()
+        fp_prof = fp_base.with_suffix(".prof")
+        _profiler.dump_stats(fp_prof)
+        stats = pstats.Stats(_profiler, stream=io.StringIO())
+        top = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)
+        report["cprofile_file"] = str(fp_prof)
+        report["cprofile_top"] = [
+            {
+                "function": f"{fname}:{lineno}({funcname})",
+                "ncalls": ncalls,
+                "tottime_s": tottime,
+                "cumtime_s": cumtime,
+            }
+            for (fname, lineno, funcname), (_, ncalls, tottime, cumtime, _) in top[
+                :CPROFILE_TOP
+            ]
+        ]
+    else:
+        # pyinstrument : rapport HTML
+        _profiler.stop()
+        fp_html = fp_base.with_suffix(".html")
+        fp_html.write_text(_profiler.output_html(), encoding="utf-8")
+        report["pyinstrument_file"] = str(fp_html)
+    _profiler = None
+
+
+def stop():
+    """Termine les mesures et écrit le rapport JSON.
+
+    Returns
+    -------
+    fp_report : Path or None
+        Fichier du rapport, None si les mesures sont désactivées.
+    """
+    global _report
+    if not enabled():
+        return None
+    report = _report
+    _report = None
+    t0_wall, t0_cpu = report.pop("_t0")
+    report["wall_s"] = time.perf_counter() - t0_wall
+    report["cpu_s"] = time.process_time() - t0_cpu
+    report["rss_peak_mb"] = peak_rss_mb()
+    report["stages"] = [
+        dict(name=path, **rec) for path, rec in report["stages"].items()
+    ]
+    #
+    profile_dir = Path(report.pop("profile_dir"))
+    os.makedirs(profile_dir, exist_ok=True)
+    stamp = report["started"].replace(":", "-")
+    fp_base = profile_dir / f"{report['script']}-{stamp}"
+    _capture_profile(report, fp_base)
+    fp_report = fp_base.with_suffix(".json")
+    with open(fp_report, mode="w", encoding="utf-8") as f_out:
+        json.dump(report, f_out, ensure_ascii=False, indent=1)
+    print(f"Rapport de mesure : {fp_report}")
+    return fp_report
@@ -0,0 +1,100 @@
+"""Commande unique des étapes de traitement des listes d'arrêtés.
+
+Chaque sous-commande lance le script de son étape, avec les options qui
+suivent : `mrs-arretes fix --liste_csv ...` équivaut à
+`python fix_liste_arretes.py --liste_csv ...`. Le script (et ses imports :
+pandas, requests, selenium...) n'est chargé qu'au lancement de sa
+sous-commande : `mrs-arretes --help` ne charge que argparse.
+
+Installation (le dossier du dépôt reste celui des scripts) :
+    pip install -e .
+
+Utilisation :
+    mrs-arretes --help
+    mrs-arretes scrape --out_dir data/raw
+    mrs-arretes scrape --site 2020 data/raw
+    mrs-arretes run --liste_csv data/raw/mrs-arretes-de-peril-2021-08-05.csv
+    mrs-arretes fix --help
+"""
+
+import argparse
+from pathlib import Path
+import runpy
+import sys
+
+# dossier des scripts
+SCRIPT_DIR = Path(__file__).resolve().parent
+# sous-commandes : script lancé, aide
+COMMANDS = {
+    "scrape": (None, "Récupérer la liste des arrêtés sur le site de la ville"),
+    "fix": ("fix_liste_arretes.py", "Corriger une liste brute"),
+    "enrich": ("enrich_liste_arretes.py", "Ajouter la classe et la date des documents"),
+    "download": ("download_arretes.py", "Télécharger les documents d'une liste"),
+    "run": ("run_pipeline.py", "Enchaîner fix, enrich et download"),
+    "reprocess": (
+        "reprocess_snapshots.py",
+        "Retraiter (fix et enrich) toutes les listes brutes, en parallèle",
+    ),
+}
+# scripts de récupération de la liste, selon la version du site
+SCRAPERS = {
+    "2021-06": "get_liste_arretes_2021-06.py",
+    "2020": "get_liste_arretes_2020_2021-03.py",
+}
+
+
+def build_parser():
+    """Analyseur des arguments de la commande.
+
+    Les options de chaque sous-commande sont transmises telles quelles à
+    son script, qui les analyse (et affiche leur aide).
+    """
+    parser = argparse.ArgumentParser(
+        prog="mrs-arretes",
+        description="Traitement des listes d'arrêtés de péril de Marseille",
+        epilog="Options d'une commande : mrs-arretes <commande> --help",
+    )
+    subparsers = parser.add_subparsers(
+        dest="command", metavar="commande", required=True
+    )
+    for name, (_, help_text) in COMMANDS.items():
+        # pas d'aide ni d'abréviations : tout est transmis au script
+        subparser = subparsers.add_parser(
+            name, help=help_text, add_help=False, allow_abbrev=False
+        )
+        if name == "scrape":
+            subparser.add_argument(
+                "--site",
+                help="Version du site de la ville",
+                choices=SCRAPERS,
+                default="2021-06",
+            )
+    return parser
+
+
+def run_script(script, argv):
+    """Lance un script comme `python <script> <argv>`.
+
+    Les noms des scripts de récupération contiennent des tirets : ils sont
+    lancés par leur chemin, pas importés comme modules.
+    """
+    fp_script = SCRIPT_DIR / script
+    # les scripts importent les modules voisins
+    if str(SCRIPT_DIR) not in sys.path:
+        sys.path.insert(0, str(SCRIPT_DIR))
+    sys.argv = [str(fp_script)] + list(argv)
+    runpy.run_path(str(fp_script), run_name="__main__")
+
+
+def main(argv=None):
+    """Point d'entrée de la commande `mrs-arretes`"""
+    args, script_argv = build_parser().parse_known_args(argv)
+    if args.command == "scrape":
+        script = SCRAPERS[args.site]
+    else:
+        script = COMMANDS[args.command][0]
+    run_script(script, script_argv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Retraite toutes les listes brutes : correction (fix) puis enrichissement.
+
+Après une modification des règles (`apply_manual_fixes`, `FIX_DATE_LINK`,
+`predict_doc_class`...), les fichiers "_fix" et "_enr" de toutes les listes
+doivent être recalculés. Chaque liste est traitée par un processus d'un
+pool, sur tous les coeurs : l'historique complet est retraité à peu près
+dans le temps de la plus grosse liste.
+
+Les modules de règles (expressions régulières compilées, tables de
+corrections) sont chargés une seule fois, dans le processus principal, avant
+la création du pool : les processus du pool en héritent (fork) au lieu de
+les recompiler. Chaque fichier est écrit sous un nom temporaire puis renommé
+(voir `storage.write_liste`) : un retraitement interrompu ne laisse pas de
+fichier à moitié écrit. L'échec d'une liste est signalé sans interrompre le
+traitement des autres.
+
+Le cache mémo de l'enrichissement n'est pas utilisé : les règles ayant
+changé, ses entrées seraient de toute façon invalidées.
+
+Utilisation :
+    python reprocess_snapshots.py --raw_dir data/raw --interim_dir data/interim
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import os
+from pathlib import Path
+import sys
+import time
+
+from enrich_liste_arretes import enrich_liste
+from fix_liste_arretes import fix_liste
+import instrument
+from storage import (
+    FORMATS,
+    as_read_from_csv,
+    list_snapshots,
+    read_liste,
+    write_liste,
+)
+
+
+def reprocess_one(fp_raw, interim_dir, fmt="csv"):
+    """Corrige puis enrichit une liste brute ; appelée dans un processus du pool.
+
+    Parameters
+    ----------
+    fp_raw : str or Path
+        Fichier de la liste brute
+    interim_dir : str or Path
+        Dossier des fichiers "_fix" et "_enr"
+    fmt : str
+        Format de sortie : "csv", "parquet" ou "both" (les deux).
+
+    Returns
+    -------
+    n_rows : int
+        Nombre de lignes de la liste enrichie
+    duration : float
+        Durée du traitement, en secondes
+    records : dict or None
+        Mesures faites par le processus (voir `instrument.take_records`)
+    """
+    t_start = time.perf_counter()
+    fp_raw = Path(fp_raw)
+    interim_dir = Path(interim_dir)
+    df = fix_liste(read_liste(fp_raw))
+    write_liste(df, interim_dir / (fp_raw.stem + "_fix"), fmt=fmt)
+    # même entrée que si l'enrichissement relisait le fichier "_fix"
+    df = enrich_liste(as_read_from_csv(df))
+    write_liste(df, interim_dir / (fp_raw.stem + "_enr"), fmt=fmt)
+    return len(df), time.perf_counter() - t_start, instrument.take_records()
+
+
+@instrument.profiled
+def reprocess_snapshots(fps_raw, interim_dir, fmt="csv", max_workers=None):
+    """Retraite des listes brutes, en parallèle.
+
+    Parameters
+    ----------
+    fps_raw : Dict[str, Path]
+        Fichier de chaque liste brute, par date (voir `storage.list_snapshots`)
+    interim_dir : str or Path
+        Dossier des fichiers "_fix" et "_enr"
+    fmt : str
+        Format de sortie : "csv", "parquet" ou "both" (les deux).
+    max_workers : int, optional
+        Nombre de processus (par défaut : nombre de coeurs)
+
+    Returns
+    -------
+    results : Dict[str, Tuple[int, float]]
+        Nombre de lignes et durée du traitement de chaque liste réussie
+    errors : Dict[str, str]
+        Message d'erreur de chaque liste en échec
+    """
+    os.makedirs(interim_dir, exist_ok=True)
+    # les plus grosses listes d'abord, pour ne pas finir par elles
+    snapshots = sorted(fps_raw, key=lambda s: os.path.getsize(fps_raw[s]), reverse=True)
+    results = {}
+    errors = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=instrument.init_worker
+    ) as pool:
+        futures = {}
+        for snapshot in snapshots:
+            future = pool.submit(reprocess_one, fps_raw[snapshot], interim_dir, fmt)
+            futures[future] = snapshot
+        for future in as_completed(futures):
+            snapshot = futures[future]
+            try:
+                n_rows, duration, records = future.result()
+            except BrokenProcessPool:
+                errors[snapshot] = "BrokenProcessPool: arrêt brutal du processus"
+            except Exception as exc:
+                errors[snapshot] = f"{type(exc).__name__}: {exc}"
+            else:
+                results[snapshot] = (n_rows, duration)
+                instrument.merge_records(records)
+                print(f"{snapshot} : {n_rows} lignes en {duration:.1f} s")
+                continue
+            print(f"ERR: {snapshot} : {errors[snapshot]}")
+    return results, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--raw_dir", help="Dossier des listes brutes", default="data/raw"
+    )
+    parser.add_argument(
+        "--interim_dir",
+        help="Dossier de sortie des fichiers _fix et _enr",
+        default="data/interim",
+    )
+    parser.add_argument(
+        "--max_workers",
+        help="Nombre de processus (par défaut : nombre de coeurs)",
+        type=int,
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args, "reprocess_snapshots")
+    #
+    fps_raw = list_snapshots(args.raw_dir)
+    t_start = time.perf_counter()
+    results, errors = reprocess_snapshots(
+        fps_raw, args.interim_dir, fmt=args.format, max_workers=args.max_workers
+    )
+    print(
+        f"{len(results)} / {len(fps_raw)} listes retraitées en "
+        f"{time.perf_counter() - t_start:.1f} s"
+    )
+    instrument.stop()
+    if errors:
+        sys.exit(1)
@@ -0,0 +1,77 @@
+"""Application des tables de corrections manuelles.
+
+Chaque table associe une clé (URL, nom de fichier, adresse, couple adresse
+et nom du document...) à une valeur corrigée. Plutôt que de parcourir toute
+la colonne pour chaque règle, on calcule une fois la clé de chaque ligne puis
+on applique toute la table en une seule jointure (`Series.map`) : le coût ne
+dépend plus du nombre de règles.
+
+Les règles qui ne s'appliquent à aucune ligne sont signalées, pour pouvoir
+alléger les tables quand le site est corrigé.
+"""
+
+import instrument
+
+# séparateur des éléments d'une clé composite
+KEY_SEP = "\x1f"
+
+
+def url_basename(s_url):
+    """Nom du fichier de chaque URL (dernier segment)"""
+    return s_url.str.rsplit("/", n=1).str[-1]
+
+
+def composite_key(*cols):
+    """Clé composite formée de plusieurs colonnes, p. ex. (adresse, nom_doc)"""
+    s_key = cols[0]
+    for col in cols[1:]:
+        s_key = s_key + KEY_SEP + col
+    return s_key
+
+
+def composite_table(table):
+    """Table dont les clés sont des tuples, réindexée par clés composites"""
+    return {KEY_SEP.join(key): value for key, value in table.items()}
+
+
+def apply_rule_table(df, s_key, table, col, name=None, verbose=False):
+    """Applique une table de règles clé -> valeur à une colonne, en place.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Tableau de données
+    s_key : Series
+        Clé de chaque ligne, alignée sur `df`
+    table : Dict[str, str]
+        Table de règles : clé -> valeur corrigée
+    col : str
+        Colonne corrigée
+    name : str, optional
+        Nom de la table, pour l'affichage
+    verbose : bool
+        Si True, affiche les règles inutilisées.
+
+    Returns
+    -------
+    unused : List[str]
+        Clés des règles qui ne s'appliquent à aucune ligne.
+    """
+    s_new = s_key.map(table)
+    hit = s_new.notna()
+    # règles inutilisées, avant la correction : la clé peut être la colonne
+    # corrigée elle-même
+    used = set(s_key[hit])
+    unused = [key for key in table if key not in used]
+    if instrument.enabled():
+        n_changed = int((s_new[hit] != df.loc[hit, col]).fillna(True).sum())
+    df.loc[hit, col] = s_new[hit]
+    if instrument.enabled():
+        instrument.record_rule_table(
+            name or col, col, len(table), int(hit.sum()), n_changed, len(unused)
+        )
+    if verbose and unused:
+        print(f"Règles inutilisées ({name or col})")
+        for key in unused:
+            print("  " + key.replace(KEY_SEP, " | "))
+    return unused
@@ -0,0 +1,519 @@
+"""Enchaîne les étapes de traitement d'une liste d'arrêtés, en mémoire.
+
+raw -> correction (fix) -> enrichissement (enrich) -> téléchargement (download) -> processed
+
+La liste passe d'une étape à l'autre sous forme de DataFrame, sans être
+ré-écrite puis relue en CSV. Les fichiers intermédiaires "_fix" et "_enr"
+ne sont écrits que si on le demande (--checkpoints).
+
+Le résultat des étapes fix et enrich est mis en cache, sous une clé qui
+combine l'empreinte de son entrée et celle de ses règles : une étape dont
+ni l'entrée ni les règles n'ont changé n'est pas relancée. L'étape download,
+dont le résultat dépend du réseau, est toujours relancée.
+
+En mode incrémental (--incremental), la liste est comparée à la précédente,
+ligne à ligne (clé : url + item) : seules les lignes ajoutées ou modifiées
+passent par les étapes, les autres reprennent le résultat du traitement
+précédent (sauf les lignes dont le document n'avait pas pu être téléchargé,
+qui sont retentées). Un traitement précédent fait avec d'autres règles, ou
+avec ou sans téléchargement à l'inverse du traitement courant, n'est pas
+réutilisé.
+Les différences sont décrites dans un fichier JSON "_delta".
+"""
+
+import argparse
+from datetime import date
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from cache_utils import MemoCache, hash_df, hash_str, rules_version
+import download_arretes
+import enrich_liste_arretes
+import fix_liste_arretes
+import instrument
+from rule_tables import KEY_SEP
+from storage import FORMATS, as_read_from_csv, read_liste, write_liste
+
+# dossier du cache des étapes
+CACHE_DIR = ".cache/pipeline"
+# nombre de résultats gardés en cache pour chaque étape
+CACHE_KEEP = 10
+# dossier des états du mode incrémental : résultat du traitement de chaque liste
+STATE_DIR = ".cache/incremental"
+# colonne technique : clé de la ligne de la liste brute
+KEY_COL = "_key"
+
+
+def write_output(df, fp_out, fmt="csv"):
+    """Exporte la liste, au même format que les scripts"""
+    write_liste(df.drop(columns=KEY_COL, errors="ignore"), fp_out, fmt=fmt)
+
+
+def run_stage(name, func, df, rules_key, cache_dir=CACHE_DIR, force=False):
+    """Lance une étape de traitement, sauf si son résultat est déjà en cache.
+
+    Parameters
+    ----------
+    name : str
+        Nom de l'étape
+    func : Callable[[DataFrame], DataFrame]
+        Fonction de l'étape
+    df : DataFrame
+        Entrée de l'étape
+    rules_key : str
+        Empreinte des règles de l'étape
+    cache_dir : str
+        Dossier du cache des étapes
+    force : bool
+        Si True, l'étape est relancée même si son résultat est en cache.
+
+    Returns
+    -------
+    df : DataFrame
+        Sortie de l'étape
+    """
+    key = hash_str(name, hash_df(df), rules_key)
+    fp_cache = Path(cache_dir) / f"{name}-{key}.pkl"
+    if fp_cache.exists() and not force:
+        print(f"{name} : entrée et règles inchangées, étape sautée")
+        return pd.read_pickle(fp_cache)
+    print(name)
+    with instrument.stage(name, rows_in=len(df)) as rows:
+        df = as_read_from_csv(func(df.copy()))
+        rows["rows_out"] = len(df)
+    # on met le résultat en cache, de façon atomique
+    os.makedirs(cache_dir, exist_ok=True)
+    fp_tmp = fp_cache.with_suffix(".tmp")
+    df.to_pickle(fp_tmp)
+    os.replace(fp_tmp, fp_cache)
+    # on ne garde que les résultats les plus récents de l'étape
+    fps_old = sorted(
+        Path(cache_dir).glob(f"{name}-*.pkl"), key=os.path.getmtime, reverse=True
+    )
+    for fp_old in fps_old[CACHE_KEEP:]:
+        fp_old.unlink()
+    return df
+
+
+def pipeline_version(doc_dir, download=True):
+    """Version des règles de l'ensemble des étapes, et des étapes lancées"""
+    return hash_str(
+        rules_version(fix_liste_arretes, enrich_liste_arretes, download_arretes),
+        os.path.abspath(doc_dir),
+        f"download={download}",
+    )
+
+
+def process_liste(
+    df,
+    doc_dir="data/arretes",
+    download=True,
+    force=False,
+    cache_dir=CACHE_DIR,
+    memo=True,
+    verbose=False,
+    fp_fix=None,
+    fp_enr=None,
+    fmt="csv",
+    failed=None,
+):
+    """Fait passer une liste par les étapes fix, enrich et download.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste brute des documents
+    doc_dir : str
+        Dossier de stockage des documents
+    download : bool
+        Si True, télécharge les documents.
+    force : bool
+        Si True, relance toutes les étapes même si leur résultat est en cache.
+    cache_dir : str
+        Dossier du cache des étapes
+    memo : bool
+        Si True, utilise le cache mémo des classes et dates déjà calculées.
+    verbose : bool
+        Si True, affiche les diagnostics des étapes.
+    fp_fix, fp_enr : str or Path, optional
+        Si précisés, fichiers intermédiaires à écrire après fix et enrich.
+    fmt : str
+        Format des fichiers intermédiaires : "csv", "parquet" ou "both".
+    failed : List[str], optional
+        Clés (colonne `KEY_COL`) des lignes dont le document n'a pas pu être
+        téléchargé, complétée en place.
+
+    Returns
+    -------
+    df : DataFrame
+        Liste traitée
+    """
+    df = run_stage(
+        "fix",
+        lambda x: fix_liste_arretes.fix_liste(x, verbose=verbose),
+        df,
+        rules_version(fix_liste_arretes),
+        cache_dir=cache_dir,
+        force=force,
+    )
+    if fp_fix is not None:
+        write_output(df, fp_fix, fmt=fmt)
+    #
+    memo_cache = MemoCache() if memo else None
+    try:
+        df = run_stage(
+            "enrich",
+            lambda x: enrich_liste_arretes.enrich_liste(
+                x, verbose=verbose, memo=memo_cache
+            ),
+            df,
+            rules_version(enrich_liste_arretes),
+            cache_dir=cache_dir,
+            force=force,
+        )
+    finally:
+        if memo_cache is not None:
+            memo_cache.close()
+    if fp_enr is not None:
+        write_output(df, fp_enr, fmt=fmt)
+    #
+    if download:
+        # pas de cache : le résultat dépend du réseau, une URL injoignable
+        # lors d'un traitement peut répondre au suivant
+        dl_dir = os.path.abspath(doc_dir)
+        print("download")
+        has_url = df["url"].notna().to_numpy()
+        with instrument.stage("download", rows_in=len(df)) as rows:
+            df = as_read_from_csv(download_arretes.download_liste(df.copy(), dl_dir))
+            rows["rows_out"] = len(df)
+        if failed is not None and KEY_COL in df:
+            # URL effacée par download : document injoignable
+            failed.extend(df.loc[has_url & df["url"].isna().to_numpy(), KEY_COL])
+    return df
+
+
+# mode incrémental
+def row_keys(df):
+    """Clé stable de chaque ligne d'une liste brute : url + item.
+
+    Une même paire (url, item) peut apparaître plusieurs fois : on ajoute
+    son numéro d'occurrence pour que la clé soit unique.
+    """
+    s_url = df["url"].fillna("").astype(str)
+    s_item = df["item"].fillna("").astype(str)
+    s_occ = df.groupby([s_url, s_item], sort=False).cumcount().astype(str)
+    return s_url + KEY_SEP + s_item + KEY_SEP + s_occ
+
+
+def diff_snapshots(df_prev, df_curr):
+    """Compare deux listes brutes, ligne à ligne.
+
+    Parameters
+    ----------
+    df_prev : DataFrame
+        Clé (index) et empreinte ("row_hash") de chaque ligne de la liste précédente
+    df_curr : DataFrame
+        Clé (index) et empreinte ("row_hash") de chaque ligne de la nouvelle liste
+
+    Returns
+    -------
+    delta : Dict[str, List[str]]
+        Clés des lignes ajoutées ("added"), supprimées ("removed"),
+        modifiées ("changed") et inchangées ("unchanged").
+    """
+    common = df_curr.index.intersection(df_prev.index)
+    same = (
+        df_curr.loc[common, "row_hash"].to_numpy()
+        == df_prev.loc[common, "row_hash"].to_numpy()
+    )
+    return {
+        "added": list(df_curr.index.difference(df_prev.index, sort=False)),
+        "removed": list(df_prev.index.difference(df_curr.index, sort=False)),
+        "changed": list(common[~same]),
+        "unchanged": list(common[same]),
+    }
+
+
+def write_delta_report(delta, fp_prev, fp_curr, fp_report):
+    """Ecrit le rapport des différences entre deux listes brutes, en JSON"""
+
+    def _rows(keys):
+        return [dict(zip(["url", "item"], key.split(KEY_SEP)[:2])) for key in keys]
+
+    report = {
+        "previous": Path(fp_prev).name,
+        "current": Path(fp_curr).name,
+        "counts": {kind: len(keys) for kind, keys in delta.items()},
+        "added": _rows(delta["added"]),
+        "removed": _rows(delta["removed"]),
+        "changed": _rows(delta["changed"]),
+    }
+    os.makedirs(Path(fp_report).parent, exist_ok=True)
+    with open(fp_report, mode="w", encoding="utf-8") as f_out:
+        json.dump(report, f_out, ensure_ascii=False, indent=1)
+
+
+def load_state(state_dir, stem):
+    """Charge le résultat du traitement d'une liste, s'il existe"""
+    fp_state = Path(state_dir) / f"{stem}.pkl"
+    if not fp_state.exists():
+        return None
+    return pd.read_pickle(fp_state)
+
+
+def save_state(state, state_dir, stem):
+    """Enregistre le résultat du traitement d'une liste, de façon atomique"""
+    os.makedirs(state_dir, exist_ok=True)
+    fp_state = Path(state_dir) / f"{stem}.pkl"
+    fp_tmp = fp_state.with_suffix(".tmp")
+    pd.to_pickle(state, fp_tmp)
+    os.replace(fp_tmp, fp_state)
+
+
+def previous_snapshot(fp_raw):
+    """Liste brute précédente, dans le même dossier (None s'il n'y en a pas)"""
+    fp_raw = Path(fp_raw)
+    fps = sorted(
+        fp
+        for fp in fp_raw.parent.glob("mrs-arretes-de-peril-*" + fp_raw.suffix)
+        if fp.name < fp_raw.name
+    )
+    return fps[-1] if fps else None
+
+
+def run_pipeline(
+    fp_raw,
+    interim_dir="data/interim",
+    out_dir="data/processed",
+    doc_dir="data/arretes",
+    checkpoints=False,
+    download=True,
+    force=False,
+    cache_dir=CACHE_DIR,
+    memo=True,
+    verbose=False,
+    incremental=False,
+    fp_previous=None,
+    state_dir=STATE_DIR,
+    fmt="csv",
+    extract_text=False,
+):
+    """Traite une liste brute d'arrêtés, de bout en bout.
+
+    Parameters
+    ----------
+    fp_raw : str or Path
+        Fichier CSV raw contenant la liste des documents
+    interim_dir : str
+        Dossier des fichiers intermédiaires
+    out_dir : str
+        Dossier de sortie pour le CSV traité
+    doc_dir : str
+        Dossier de stockage des documents
+    checkpoints : bool
+        Si True, écrit les fichiers intermédiaires "_fix" et "_enr"
+        (traitement complet seulement).
+    download : bool
+        Si True, télécharge les documents.
+    force : bool
+        Si True, relance toutes les étapes même si leur résultat est en cache.
+    cache_dir : str
+        Dossier du cache des étapes
+    memo : bool
+        Si True, utilise le cache mémo des classes et dates déjà calculées.
+    verbose : bool
+        Si True, affiche les diagnostics des étapes.
+    incremental : bool
+        Si True, ne traite que les lignes ajoutées ou modifiées depuis la
+        liste précédente.
+    fp_previous : str or Path, optional
+        Liste brute précédente ; par défaut, la plus récente du même dossier.
+    state_dir : str
+        Dossier des états du mode incrémental
+    fmt : str
+        Format des fichiers écrits : "csv", "parquet" ou "both".
+    extract_text : bool
+        Si True, extrait le texte des documents téléchargés, dans un fichier
+        "_text" à côté de la liste traitée.
+
+    Returns
+    -------
+    df : DataFrame
+        Liste traitée
+    """
+    fp_raw = Path(fp_raw).resolve()
+    df = read_liste(fp_raw)
+    # clé et empreinte de chaque ligne brute
+    df_keys = pd.DataFrame(
+        {"row_hash": pd.util.hash_pandas_object(df, index=False).to_numpy()},
+        index=pd.Index(row_keys(df), name=KEY_COL),
+    )
+    df[KEY_COL] = df_keys.index
+    version = pipeline_version(doc_dir, download=download)
+    kwargs = dict(
+        doc_dir=doc_dir,
+        download=download,
+        force=force,
+        cache_dir=cache_dir,
+        memo=memo,
+        verbose=verbose,
+    )
+    # clés des lignes dont le document n'a pas pu être téléchargé
+    failed = []
+    # état du traitement de la liste précédente
+    state_prev = None
+    if incremental:
+        if fp_previous is None:
+            fp_previous = previous_snapshot(fp_raw)
+        if fp_previous is not None:
+            state_prev = load_state(state_dir, Path(fp_previous).stem)
+        if state_prev is None or state_prev["version"] != version:
+            print("Pas de traitement précédent réutilisable : traitement complet")
+            state_prev = None
+    #
+    if state_prev is not None:
+        delta = diff_snapshots(state_prev["keys"], df_keys)
+        write_delta_report(
+            delta,
+            fp_previous,
+            fp_raw,
+            Path(interim_dir) / (fp_raw.stem + "_delta.json"),
+        )
+        print({kind: len(keys) for kind, keys in delta.items()})
+        df_prev = state_prev["processed"]
+        # lignes inchangées dont le document n'avait pas pu être téléchargé :
+        # on réessaie
+        unchanged = set(delta["unchanged"])
+        retry = [key for key in state_prev["failed"] if key in unchanged]
+        if retry:
+            print(f"{len(retry)} URL(s) injoignable(s) au traitement précédent")
+        # lignes à (re)traiter
+        df_todo = df[df[KEY_COL].isin(delta["added"] + delta["changed"] + retry)]
+        # lignes dont on reprend le résultat précédent
+        df_done = df_prev[
+            df_prev[KEY_COL].isin(delta["unchanged"]) & ~df_prev[KEY_COL].isin(retry)
+        ]
+        if len(df_todo):
+            df_new = process_liste(df_todo, failed=failed, **kwargs)
+            df_out = pd.concat([df_done, df_new], ignore_index=True)
+        else:
+            df_out = df_done.reset_index(drop=True)
+        # on remet les lignes dans l'ordre de la liste brute
+        s_pos = pd.Series(range(len(df)), index=df[KEY_COL])
+        df_out = df_out.iloc[
+            df_out[KEY_COL].map(s_pos).argsort(kind="stable")
+        ].reset_index(drop=True)
+    else:
+        fp_fix = fp_enr = None
+        if checkpoints:
+            fp_fix = Path(interim_dir) / (fp_raw.stem + "_fix" + fp_raw.suffix)
+            fp_enr = Path(interim_dir) / (fp_raw.stem + "_enr" + fp_raw.suffix)
+        df_out = process_liste(
+            df, fp_fix=fp_fix, fp_enr=fp_enr, fmt=fmt, failed=failed, **kwargs
+        )
+    # on garde le résultat pour le prochain traitement incrémental
+    save_state(
+        {"version": version, "keys": df_keys, "processed": df_out, "failed": failed},
+        state_dir,
+        fp_raw.stem,
+    )
+    write_output(df_out, Path(out_dir) / fp_raw.name, fmt=fmt)
+    if extract_text:
+        # import tardif : l'extraction nécessite pdfminer.six
+        import extract_text_arretes
+
+        df_text = extract_text_arretes.extract_liste(df_out, os.path.abspath(doc_dir))
+        write_liste(df_text, Path(out_dir) / (fp_raw.stem + "_text"), fmt=fmt)
+    return df_out.drop(columns=KEY_COL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--liste_csv",
+        help="Fichier CSV raw contenant la liste des documents",
+        default="data/raw/mrs-arretes-de-peril-{}.csv".format(date.today().isoformat()),
+    )
+    parser.add_argument(
+        "--interim_dir",
+        help="Dossier des fichiers intermédiaires",
+        default="data/interim",
+    )
+    parser.add_argument(
+        "--out_dir",
+        help="Dossier de sortie pour le CSV traité",
+        default="data/processed",
+    )
+    parser.add_argument(
+        "--doc_dir", help="Dossier de stockage des documents", default="data/arretes"
+    )
+    parser.add_argument(
+        "--checkpoints",
+        help="Ecrire les fichiers intermédiaires _fix et _enr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_download",
+        help="Ne pas télécharger les documents",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force",
+        help="Relancer toutes les étapes, même si leur entrée n'a pas changé",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache_dir", help="Dossier du cache des étapes", default=CACHE_DIR
+    )
+    parser.add_argument(
+        "--no_memo",
+        help="Ne pas utiliser le cache mémo des classes et dates déjà calculées",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Ne traiter que les lignes ajoutées ou modifiées depuis la liste précédente",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--previous_csv",
+        help="Liste brute précédente (par défaut : la plus récente du même dossier)",
+    )
+    parser.add_argument(
+        "--format",
+        help="Format de sortie : CSV, Parquet ou les deux",
+        choices=FORMATS,
+        default="csv",
+    )
+    parser.add_argument(
+        "--extract_text",
+        help="Extraire le texte des documents téléchargés",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verbose", help="Afficher les diagnostics des étapes", action="store_true"
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    instrument.start(args, "run_pipeline")
+    #
+    run_pipeline(
+        args.liste_csv,
+        interim_dir=args.interim_dir,
+        out_dir=args.out_dir,
+        doc_dir=args.doc_dir,
+        checkpoints=args.checkpoints,
+        download=not args.no_download,
+        force=args.force,
+        cache_dir=args.cache_dir,
+        memo=not args.no_memo,
+        verbose=args.verbose,
+        incremental=args.incremental,
+        fp_previous=args.previous_csv,
+        fmt=args.format,
+        extract_text=args.extract_text,
+    )
+    instrument.stop()
@@ -0,0 +1,363 @@
+"""Lecture et écriture des listes d'arrêtés, en CSV ou en Parquet.
+
+Le CSV (retours à la ligne du dialecte Excel, toutes les colonnes en texte)
+reste le format d'échange. Le format Parquet, écrit à côté du CSV ou à sa
+place, garde les types des colonnes : catégories pour les colonnes à
+faible cardinalité (classe, arrondissement, code postal, provenance de la
+date), date pour `date_link`. Les analyses qui chargent de nombreuses
+listes le font ainsi plus vite et avec moins de mémoire.
+
+Les scripts lisent les listes par `read_liste`, qui renvoie par défaut les
+colonnes en texte, comme `pd.read_csv(fp, dtype="string")`, quel que soit
+le format du fichier. Pour les listes trop volumineuses (historiques
+fusionnés sur plusieurs années...), `iter_liste` et `write_liste_chunks`
+lisent et écrivent une liste par morceaux, en mémoire constante.
+"""
+
+import os
+from pathlib import Path
+import re
+
+import pandas as pd
+
+import instrument
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+# formats de sortie
+FORMATS = ["csv", "parquet", "both"]
+# colonnes à faible cardinalité, stockées comme catégories
+CATEGORY_COLS = ["classe", "arrondissement", "code_postal", "date_source"]
+# colonnes de dates, et leur format dans le CSV
+DATE_COLS = {"date_link": "%d/%m/%Y"}
+# début du nom des fichiers des listes, suivi de la date
+LISTE_PREFIX = "mrs-arretes-de-peril-"
+# date de la liste, dans le nom du fichier
+RE_SNAPSHOT = re.compile(r"\d{4}-\d{2}-\d{2}")
+# retours à la ligne du dialecte Excel du CSV Writer :
+# https://docs.python.org/3/library/csv.html#csv.Dialect.lineterminator
+CSV_EOL = "\r\n"
+
+
+def to_typed(df):
+    """Convertit les colonnes d'une liste vers leurs types.
+
+    Une colonne de dates dont une valeur n'est pas au format attendu reste
+    en texte, pour ne perdre aucune information. Une chaîne vide devient une
+    valeur manquante, comme à la lecture du CSV.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste des documents, colonnes en texte
+
+    Returns
+    -------
+    df : DataFrame
+        Liste des documents, colonnes typées
+    """
+    df = df.mask(df == "")
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col, date_fmt in DATE_COLS.items():
+        if col in df.columns:
+            s_date = pd.to_datetime(df[col], format=date_fmt, errors="coerce")
+            if (s_date.isna() & df[col].notna()).any():
+                print(f"WARN: {col} : dates au format inattendu, gardées en texte")
+                continue
+            df[col] = s_date
+    return df
+
+
+def to_text(df):
+    """Reconvertit en texte les colonnes d'une liste typée (inverse de `to_typed`)
+
+    Une chaîne vide (fichier Parquet écrit avant `to_typed` la remplace)
+    devient une valeur manquante, comme à la lecture du CSV.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste des documents, colonnes typées
+
+    Returns
+    -------
+    df : DataFrame
+        Liste des documents, colonnes en texte
+    """
+    df = df.copy()
+    for col, date_fmt in DATE_COLS.items():
+        if col in df.columns and pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime(date_fmt)
+    df = df.astype("string")
+    return df.mask(df == "")
+
+
+def as_read_from_csv(df):
+    """Donne au DataFrame les valeurs qu'il aurait après un aller-retour CSV.
+
+    Une chaîne vide est relue comme une valeur manquante : on garde ainsi
+    exactement le comportement des scripts qui s'échangent des fichiers CSV.
+    """
+    df = df.mask(df == "")
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def write_liste(df, fp_out, fmt="csv"):
+    """Exporte une liste de documents.
+
+    Chaque fichier est écrit sous un nom temporaire, renommé une fois
+    complet : un fichier de sortie n'est jamais lu à moitié écrit.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Liste des documents, colonnes en texte
+    fp_out : str or Path
+        Fichier de sortie ; son extension est remplacée selon le format.
+    fmt : str
+        Format de sortie : "csv", "parquet" ou "both" (les deux).
+
+    Returns
+    -------
+    fps_out : List[Path]
+        Fichiers écrits
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format inconnu : {fmt}")
+    fp_out = Path(fp_out)
+    fps_out = []
+    with instrument.stage("write_liste", rows_in=len(df)):
+        if fmt in ("csv", "both"):
+            fp_csv = fp_out.with_suffix(".csv")
+            # on garde les retours à la ligne du dialecte Excel du CSV Writer
+            df.to_csv(f"{fp_csv}.tmp", sep=",", index=False, lineterminator=CSV_EOL)
+            os.replace(f"{fp_csv}.tmp", fp_csv)
+            fps_out.append(fp_csv)
+        if fmt in ("parquet", "both"):
+            if not HAS_PARQUET:
+                raise ImportError("Le format parquet nécessite pyarrow")
+            fp_pq = fp_out.with_suffix(".parquet")
+            to_typed(df).to_parquet(f"{fp_pq}.tmp", index=False)
+            os.replace(f"{fp_pq}.tmp", fp_pq)
+            fps_out.append(fp_pq)
+    return fps_out
+
+
+def write_liste_chunks(chunks, fp_out, fmt="csv"):
+    """Exporte une liste de documents produite par morceaux.
+
+    Chaque morceau est écrit dès qu'il est produit ; le fichier est écrit
+    sous un nom temporaire, renommé une fois complet. Le CSV est identique
+    à celui qu'écrirait `write_liste` pour la liste entière.
+
+    Parameters
+    ----------
+    chunks : Iterable[DataFrame]
+        Morceaux de la liste, colonnes en texte, dans le même ordre
+    fp_out : str or Path
+        Fichier de sortie ; son extension est remplacée selon le format.
+    fmt : str
+        Format de sortie : "csv", "parquet" ou "both" (les deux).
+
+    Returns
+    -------
+    fps_out : List[Path]
+        Fichiers écrits
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format inconnu : {fmt}")
+    if fmt != "csv" and not HAS_PARQUET:
+        raise ImportError("Le format parquet nécessite pyarrow")
+    fp_out = Path(fp_out)
+    fp_csv = fp_out.with_suffix(".csv") if fmt in ("csv", "both") else None
+    fp_pq = fp_out.with_suffix(".parquet") if fmt in ("parquet", "both") else None
+    pq_writer = None
+    columns = None
+    try:
+        for i, df in enumerate(chunks):
+            if columns is None:
+                columns = list(df.columns)
+            elif list(df.columns) != columns:
+                raise ValueError("Colonnes différentes d'un morceau à l'autre")
+            with instrument.stage("write_liste", rows_in=len(df)):
+                if fp_csv is not None:
+                    df.to_csv(
+                        f"{fp_csv}.tmp",
+                        sep=",",
+                        index=False,
+                        header=(i == 0),
+                        mode="w" if i == 0 else "a",
+                        lineterminator=CSV_EOL,
+                    )
+                if fp_pq is not None:
+                    table = pa.Table.from_pandas(to_typed(df), preserve_index=False)
+                    if pq_writer is None:
+                        pq_writer = pq.ParquetWriter(f"{fp_pq}.tmp", table.schema)
+                    # types du 1er morceau (une date au format inattendu
+                    # dans un morceau suivant lève une erreur)
+                    pq_writer.write_table(table.cast(pq_writer.schema))
+    finally:
+        if pq_writer is not None:
+            pq_writer.close()
+    fps_out = []
+    for fp in (fp_csv, fp_pq):
+        if fp is not None and os.path.exists(f"{fp}.tmp"):
+            os.replace(f"{fp}.tmp", fp)
+            fps_out.append(fp)
+    return fps_out
+
+
+def _find_liste(fp_in):
+    """Fichier d'une liste, dans l'autre format si le fichier demandé n'existe pas"""
+    fp_in = Path(fp_in)
+    if not fp_in.exists():
+        for suffix in (".parquet", ".csv"):
+            if fp_in.with_suffix(suffix).exists():
+                return fp_in.with_suffix(suffix)
+    return fp_in
+
+
+@instrument.profiled
+def read_liste(fp_in, typed=False, columns=None):
+    """Charge une liste de documents, au format CSV ou Parquet.
+
+    Si le fichier demandé n'existe pas, on cherche le même fichier dans
+    l'autre format.
+
+    Parameters
+    ----------
+    fp_in : str or Path
+        Fichier CSV ou Parquet
+    typed : bool
+        Si True, renvoie les colonnes typées (catégories, dates), sinon
+        les colonnes en texte.
+    columns : List[str], optional
+        Colonnes à charger (par défaut : toutes)
+
+    Returns
+    -------
+    df : DataFrame
+        Liste des documents
+    """
+    fp_in = _find_liste(fp_in)
+    if fp_in.suffix == ".parquet":
+        df = pd.read_parquet(fp_in, columns=columns)
+        return df.mask(df == "") if typed else to_text(df)
+    df = pd.read_csv(fp_in, dtype="string", usecols=columns)
+    return to_typed(df) if typed else df
+
+
+def iter_liste(fp_in, chunksize, typed=False, columns=None):
+    """Charge une liste de documents par morceaux, au format CSV ou Parquet.
+
+    Mêmes colonnes et types que `read_liste`, en mémoire constante.
+
+    Parameters
+    ----------
+    fp_in : str or Path
+        Fichier CSV ou Parquet
+    chunksize : int
+        Nombre de lignes par morceau
+    typed : bool
+        Si True, renvoie les colonnes typées (catégories, dates), sinon
+        les colonnes en texte.
+    columns : List[str], optional
+        Colonnes à charger (par défaut : toutes)
+
+    Yields
+    ------
+    df : DataFrame
+        Morceau de la liste, indexé par le numéro de ligne dans la liste
+    """
+    fp_in = _find_liste(fp_in)
+    start = 0
+    if fp_in.suffix == ".parquet":
+        for batch in pq.ParquetFile(fp_in).iter_batches(
+            batch_size=chunksize, columns=columns
+        ):
+            df = batch.to_pandas()
+            df.index += start
+            start += len(df)
+            yield df.mask(df == "") if typed else to_text(df)
+        return
+    for df in pd.read_csv(fp_in, dtype="string", usecols=columns, chunksize=chunksize):
+        yield to_typed(df) if typed else df
+
+
+def list_snapshots(data_dir, prefix=LISTE_PREFIX, suffix=""):
+    """Fichiers des listes d'un dossier, par date de liste.
+
+    Pour chaque liste, le fichier Parquet est préféré au CSV s'il existe.
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Dossier des listes, p. ex. "data/processed"
+    prefix : str
+        Début des noms de fichiers, avant la date
+    suffix : str
+        Fin des noms de fichiers, après la date et sans extension, p. ex.
+        "_enr" ou "_text" ; les fichiers avec une autre fin sont ignorés.
+
+    Returns
+    -------
+    fps : Dict[str, Path]
+        Fichier de chaque liste, par date (AAAA-MM-JJ) croissante.
+    """
+    re_name = re.compile(
+        re.escape(prefix) + "(" + RE_SNAPSHOT.pattern + ")" + re.escape(suffix)
+    )
+    fps = {}
+    for ext in (".csv", ".parquet"):
+        for fp in Path(data_dir).glob(prefix + "*" + suffix + ext):
+            m_name = re_name.fullmatch(fp.stem)
+            if m_name is not None:
+                # le parquet remplace le CSV de la même liste
+                fps[m_name.group(1)] = fp
+    return dict(sorted(fps.items()))
+
+
+def read_snapshots(data_dir, prefix=LISTE_PREFIX, suffix="", typed=True, columns=None):
+    """Charge toutes les listes d'un dossier, dans une seule table.
+
+    Pour chaque liste, le fichier Parquet est préféré au CSV s'il existe
+    (voir `list_snapshots`).
+
+    Parameters
+    ----------
+    data_dir : str or Path
+        Dossier des listes, p. ex. "data/processed"
+    prefix, suffix : str
+        Début et fin des noms de fichiers (voir `list_snapshots`)
+    typed : bool
+        Si True, renvoie les colonnes typées (catégories, dates).
+    columns : List[str], optional
+        Colonnes à charger (par défaut : toutes)
+
+    Returns
+    -------
+    df : DataFrame
+        Listes des documents, avec la date de chaque liste dans la colonne
+        "snapshot".
+    """
+    dfs = []
+    for snapshot, fp in list_snapshots(data_dir, prefix=prefix, suffix=suffix).items():
+        df = read_liste(fp, typed=typed, columns=columns)
+        df.insert(0, "snapshot", pd.Timestamp(snapshot))
+        dfs.append(df)
+    df_all = pd.concat(dfs, ignore_index=True)
+    if typed:
+        # les catégories de chaque liste sont réunies
+        for col in CATEGORY_COLS:
+            if col in df_all.columns:
+                df_all[col] = df_all[col].astype("category")
+    return df_all